@@ -149,3 +149,60 @@ def compile_protocol_string(string):
     mc.compile_string(string)
     return "\n".join(mc.code_lines)
 
+
+def patch(data,typcls,changes):
+    """Replace field values in a serialized message without decoding it.
+
+    This function takes the serialized form of a 'typcls' message and a
+    dict mapping dotted field paths to new values, and returns the modified
+    serialized message.  Only the new values are encoded; the rest of the
+    message is copied through unchanged.  For example:
+
+        data = extprot.patch(data,person,{"address.city":"Melbourne"})
+
+    See the module extprot.edit for more details.
+    """
+    from extprot.edit import patch
+    return patch(data,typcls,changes)
+
+
+def resolve(reader,writer):
+    """Get a plan for reading values written as a different type.
+
+    This function takes the type class you want to read and the type class
+    from the protocol version that wrote the data, and returns an object
+    whose from_string() and from_file() methods parse the data as 'reader'
+    values.  Defaults for missing fields and promotions of primitive values
+    are worked out once in advance rather than for every value:
+
+        plan = extprot.resolve(person,old_person)
+        p = plan.from_string(data)
+
+    See the module extprot.resolution for more details.
+    """
+    from extprot.resolution import resolve
+    return resolve(reader,writer)
+
+
+def fingerprint(value,typcls,algorithm="sha1"):
+    """Calculate a digest of the given value of type 'typcls'.
+
+    The digest is calculated over the canonical serialized form of the
+    value, so equal values always have the same fingerprint.  The value is
+    fed into the hash incrementally rather than being serialized in full,
+    making this suitable for use on very large values.
+    """
+    from extprot.types import serialize
+    return serialize.fingerprint(value,typcls,algorithm)
+
+
+def to_buffers(value,typcls,threshold=4096):
+    """Encode the given value of type 'typcls' as a list of buffers.
+
+    The buffers joined together give the same data as to_string(), but any
+    String values at least 'threshold' bytes long are included in the list
+    as-is rather than being copied, ready to be sent with os.writev() or
+    socket.sendmsg().  See the module extprot.buffers for more details.
+    """
+    from extprot.buffers import to_buffers
+    return to_buffers(value,typcls,threshold)
@@ -9,9 +9,12 @@ working for you, just use the pure-python "serialize" module instead.
 """
 
 import struct
+import hashlib
+from operator import itemgetter
+from timeit import default_timer
 
 from extprot.errors import *
-from extprot.utils import TypedList, TypedDict
+from extprot.utils import TypedList, TypedDict, Blob, _view, _blob_data
 
 cdef extern from "stdlib.h":
     ctypedef unsigned long size_t
@@ -23,6 +26,16 @@ cdef extern from "stdlib.h":
 cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *s, Py_ssize_t len)
     char* PyString_AsString(object string)
+    bint PyString_Check(object o)
+    bint PyString_CheckExact(object o)
+    bint PyUnicode_Check(object o)
+    int PyObject_AsReadBuffer(object o,void **buffer,Py_ssize_t *length) except -1
+    bint PyInt_CheckExact(object o)
+    bint PyTuple_CheckExact(object o)
+    bint PyList_CheckExact(object o)
+    bint PyDict_CheckExact(object o)
+    int PyList_Append(object list, object item) except -1
+    int PyDict_SetItem(object p, object key, object val) except -1
 
 
 #  We expose the various TYPE_* constants as Python ingtegers for other
@@ -39,6 +52,10 @@ TYPE_BYTES = 3
 TYPE_HTUPLE = 5
 TYPE_ASSOC = 7
 
+#  This is a pseudo-type that can be returned by TypeDesc.render_value to
+#  write a string of already-serialized data directly into the stream.
+TYPE_PRERENDERED = 16
+
 cdef enum TypeID:
     _E_TYPE_VINT = 0
     _E_TYPE_BITS8 = 2
@@ -50,6 +67,7 @@ cdef enum TypeID:
     _E_TYPE_BYTES = 3
     _E_TYPE_HTUPLE = 5
     _E_TYPE_ASSOC = 7
+    _E_TYPE_PRERENDERED = 16
 
 
 # TODO: pack/unpack floats natively instead of shelling out to struct module.
@@ -57,6 +75,86 @@ _S_BITS64_FLOAT = struct.Struct("<d")
 
 
 
+cdef class Stream
+
+
+#  The object used to record serialization activity, if any.  When this
+#  is None the only cost of instrumentation is a single pointer comparison
+#  for each value.  See extprot.instrument for the details.
+cdef object _instrument = None
+
+def set_instrumentation(instrument):
+    """Set the object used to record serialization activity.
+
+    The object must have a method record(typcls,event,nbytes,elapsed,failed)
+    as described in extprot.instrument.  Passing None switches off
+    instrumentation.
+    """
+    global _instrument
+    _instrument = instrument
+
+cdef inline bint _is_instrumented(TypeDesc typdesc):
+    """Check whether values of the given typedesc should be recorded."""
+    return isinstance(typdesc,(MessageTypeDesc,UnionTypeDesc))
+
+
+def _has_native_render(cls):
+    """Check whether a TypeDesc class uses a built-in render_value method.
+
+    If render_value has been overridden in python code, it must be called
+    to render each value and its result written using the tuple protocol.
+    """
+    native_type = type(TypeDesc.__dict__["render_value"])
+    for c in cls.__mro__:
+        if "render_value" in c.__dict__:
+            return isinstance(c.__dict__["render_value"],native_type)
+    return False
+
+
+cdef class _TagTable(object):
+    """C-level lookup table mapping (type,tag) pairs to values.
+
+    This wraps the dicts in TypeDesc.subtypes and collection_constructor
+    so that the parser can look up entries without building a tuple and
+    hashing it.  If the dict has a single key, its value is kept in a
+    dedicated slot.  Otherwise the values for TYPE_TUPLE keys, which are
+    the options of a Union, are kept in a list indexed by tag.  Any other
+    lookups fall back to the dict itself.
+    """
+
+    cdef readonly dict mapping
+    cdef int single_type
+    cdef long long single_tag
+    cdef object single_value
+    cdef list tuple_values
+
+    def __init__(self,dict mapping not None):
+        self.mapping = mapping
+        self.single_type = -1
+        self.tuple_values = []
+        if len(mapping) == 1:
+            for ((type,tag),value) in mapping.iteritems():
+                self.single_type = type
+                self.single_tag = tag
+                self.single_value = value
+        else:
+            for ((type,tag),value) in mapping.iteritems():
+                if type == _E_TYPE_TUPLE and 0 <= tag < 256:
+                    while len(self.tuple_values) <= tag:
+                        self.tuple_values.append(None)
+                    self.tuple_values[tag] = value
+
+    cdef object lookup(self,int type,long long tag):
+        """Get the value for the given (type,tag), raising KeyError."""
+        if type == self.single_type and tag == self.single_tag:
+            return self.single_value
+        if type == _E_TYPE_TUPLE and 0 <= tag < len(self.tuple_values):
+            value = self.tuple_values[tag]
+            if value is not None:
+                return value
+        return self.mapping[(type,tag)]
+
+
 cdef class TypeDesc(object):
     """Object used to direct the serialization process.
 
@@ -70,16 +168,43 @@ cdef class TypeDesc(object):
 
     This is broken off into a separate class so that the cython-based parser
     can implement the common methods in C.
+
+    The dicts in the 'subtypes' and 'collection_constructor' attributes are
+    compiled into C-level lookup tables when they are assigned.  To change
+    them, assign a new dict rather than modifying them in-place.
+
+    The built-in subclasses can also write values directly to the stream,
+    without allocating the tuple returned by render_value().  This is used
+    unless render_value() has been overridden in python code.
     """
 
-    cdef public dict collection_constructor
-    cdef public dict subtypes
+    cdef _TagTable _subtypes
+    cdef _TagTable _constructors
+    cdef int _native
+
+    def __cinit__(self):
+        self._subtypes = _TagTable({})
+        self._constructors = _TagTable({})
+        self._native = -1
 
     def __init__(self):
-        if self.collection_constructor is None:
-            self.collection_constructor = {}
-        if self.subtypes is None:
-            self.subtypes = {}
+        pass
+
+    property subtypes:
+        def __get__(self):
+            return self._subtypes.mapping
+        def __set__(self,value):
+            if value is None:
+                value = {}
+            self._subtypes = _TagTable(value)
+
+    property collection_constructor:
+        def __get__(self):
+            return self._constructors.mapping
+        def __set__(self,value):
+            if value is None:
+                value = {}
+            self._constructors = _TagTable(value)
 
     cpdef parse_value(self,value,TypeID type,long long tag):
         """Finalize parsing of a value from the extprot bytestream.
@@ -96,6 +221,9 @@ cdef class TypeDesc(object):
         This method will be called when a value is about to be written out.
         It must convert the value to something renderable, and return a
         3-tuple giving the value, type and tag.
+
+        If the type is given as TYPE_PRERENDERED, the value must be a string
+        of already-serialized data that will be written out unchanged.
         """
         raise NotImplementedError
 
@@ -107,6 +235,20 @@ cdef class TypeDesc(object):
         """
         raise UndefinedDefaultError
 
+    cdef bint _is_native(self):
+        """Check whether render_value() is the built-in implementation."""
+        if self._native < 0:
+            self._native = _has_native_render(self.__class__)
+        return self._native
+
+    cdef int _write_direct(self,Stream s,value) except -1:
+        """Write the given value directly to the stream, if possible.
+
+        This returns 1 if the value was written, or 0 if the caller must
+        fall back to using render_value().
+        """
+        return 0
+
 
 
 cdef class SingleTypeDesc(TypeDesc):
@@ -118,6 +260,11 @@ cdef class SingleTypeDesc(TypeDesc):
 
     cdef public int type
     cdef public long long tag
+    #  Optional tuple of precomputed defaults for the subtypes of composed
+    #  types, as used by _fill_defaults().
+    cdef public tuple defaults
+    cdef bytes _header
+    cdef long long _header_prefix
 
     cpdef parse_value(self,value,TypeID type,long long tag):
         if type != self.type:
@@ -127,6 +274,46 @@ cdef class SingleTypeDesc(TypeDesc):
     cpdef tuple render_value(self,value):
         return (value,self.type,self.tag)
 
+    cdef bytes _get_header(self):
+        """Get the encoded prefix for values of this type."""
+        cdef long long prefix
+        prefix = self.tag << 4 | self.type
+        if self._header is None or prefix != self._header_prefix:
+            self._header = encode_vint(prefix)
+            self._header_prefix = prefix
+        return self._header
+
+    cdef int _write_direct(self,Stream s,value) except -1:
+        if not self._is_native():
+            return 0
+        s._write(self._get_header())
+        s._write_body(value,<TypeID>self.type,self.tag,self)
+        return 1
+
+
+cdef int _fill_defaults(SingleTypeDesc typdesc,values,tuple subtypes) except -1:
+    """Append default values for the items missing from a parsed value.
+
+    The typedesc may have a tuple of precomputed 'defaults', one for each
+    subtype, giving either a (value,None) pair for a default that can be
+    shared or a (None,typdesc) pair for one that must be created each time.
+    Otherwise default_value() is called on each missing subtype.
+    """
+    cdef TypeDesc t
+    cdef tuple default
+    cdef Py_ssize_t i
+    if typdesc.defaults is None:
+        for t in subtypes[len(values):]:
+            values.append(t.default_value())
+    else:
+        for i in range(len(values),len(typdesc.defaults)):
+            default = typdesc.defaults[i]
+            if default[1] is None:
+                values.append(default[0])
+            else:
+                values.append((<TypeDesc>default[1]).default_value())
+    return 0
+
 
 cdef class BoolTypeDesc(SingleTypeDesc):
     """TypeDesc class for boolean-like types."""
@@ -145,6 +332,16 @@ cdef class BoolTypeDesc(SingleTypeDesc):
     cpdef default_value(self):
         return False
 
+    cdef int _write_direct(self,Stream s,value) except -1:
+        if not self._is_native():
+            return 0
+        s._write(self._get_header())
+        if value:
+            s._write_char(1)
+        else:
+            s._write_char(0)
+        return 1
+
 
 cdef class IntTypeDesc(SingleTypeDesc):
     """TypeDesc class for integer-like types."""
@@ -163,6 +360,19 @@ cdef class IntTypeDesc(SingleTypeDesc):
             value = (value * -2) - 1
         return SingleTypeDesc.render_value(self,value)
 
+    cdef int _write_direct(self,Stream s,value) except -1:
+        cdef long long v
+        if not self._is_native():
+            return 0
+        if not PyInt_CheckExact(value):
+            #  Python longs may be too big for C arithmetic.
+            return 0
+        v = value
+        s._write(self._get_header())
+        #  This is the same zig-zag encoding as render_value.
+        s._write_uint((<unsigned long long>v << 1) ^ <unsigned long long>(v >> 63))
+        return 1
+
 
 
 cdef class TupleTypeDesc(SingleTypeDesc):
@@ -172,11 +382,10 @@ cdef class TupleTypeDesc(SingleTypeDesc):
         cdef TypeDesc t
         cdef tuple subtypes
         #  Try to parse it as a proper tuple type
-        subtypes = self.subtypes[(self.type,self.tag)]
+        subtypes = self._subtypes.lookup(self.type,self.tag)
         if type == self.type:
             if len(value) < len(subtypes):
-                for t in subtypes[len(value):]:
-                    value.append(t.default_value())
+                _fill_defaults(self,value,subtypes)
             return tuple(value)
         #  Try to promote it from a primitive type to the first tuple item.
         if not subtypes:
@@ -184,15 +393,14 @@ cdef class TupleTypeDesc(SingleTypeDesc):
             raise ParseError(err)
         else:
             values = [subtypes[0].parse_value(value,type,tag)]
-            for t in subtypes[1:]:
-                values.append(t.default_value())
+            _fill_defaults(self,values,subtypes)
             return tuple(values)
 
     cpdef default_value(self):
         cdef TypeDesc t
         cdef tuple subtypes
         values = []
-        subtypes = self.subtypes[(self.type,self.tag)]
+        subtypes = self._subtypes.lookup(self.type,self.tag)
         for t in subtypes:
             values.append(t.default_value())
         return tuple(values)
@@ -202,23 +410,148 @@ cdef class MessageTypeDesc(TupleTypeDesc):
     """TypeDesc class for message types."""
 
     cpdef parse_value(self,value,TypeID type,long long tag):
-        cdef int i
-        value = TupleTypeDesc.parse_value(self,value,type,tag)
-        #  Bypass typechecking by initialising the values before calling
-        #  __init__.  We already know the types are valid.
-        inst = self.type_class.__new__(self.type_class)
-        for i in xrange(min(len(inst._ep_fields),len(value))):
-            inst.__dict__[inst._ep_fields[i]._ep_name] = value[i]
-        inst._ep_initialized = True
-        inst.__init__(*value)
+        cdef TypeDesc t
+        cdef tuple subtypes
+        if type != self.type:
+            value = list(TupleTypeDesc.parse_value(self,value,type,tag))
+        else:
+            subtypes = self._subtypes.lookup(self.type,self.tag)
+            if len(value) < len(subtypes):
+                if self.defaults is None:
+                    self.defaults = self.type_class._ep_make_defaults()
+                _fill_defaults(self,value,subtypes)
+        #  Bypass typechecking and __init__ by filling in the values
+        #  directly.  We already know the types are valid.
+        cls = self.type_class
+        inst = cls.__new__(cls)
+        cls._ep_setvalues(inst,value)
+        if cls._ep_post_parse is not None:
+            inst._ep_post_parse()
         return inst
 
     cpdef tuple render_value(self,value):
-        value = [value.__dict__[f._ep_name] for f in self.type_class._ep_fields]
+        encoded = value._ep_encoded
+        if encoded is not None:
+            return (encoded,TYPE_PRERENDERED,0)
+        if value._ep_incremental:
+            encoded = value._ep_render_incremental()
+            return (encoded,TYPE_PRERENDERED,0)
+        try:
+            value = self.type_class._ep_getvalues(value)
+        except AttributeError:
+            #  Some fields are unset, have them filled in with defaults.
+            value = [f.__get__(value) for f in self.type_class._ep_fields]
         return TupleTypeDesc.render_value(self,value)
 
     cpdef default_value(self):
         return self.type_class()
+
+    cdef int _write_direct(self,Stream s,value) except -1:
+        if not self._is_native():
+            return 0
+        encoded = value._ep_encoded
+        if encoded is None and value._ep_incremental:
+            encoded = value._ep_render_incremental()
+        if encoded is not None:
+            s._write_prerendered(encoded)
+            return 1
+        try:
+            values = self.type_class._ep_getvalues(value)
+        except AttributeError:
+            #  Some fields are unset, have them filled in with defaults.
+            values = [f.__get__(value) for f in self.type_class._ep_fields]
+        s._write(self._get_header())
+        s._write_Tuple(values,self._subtypes.lookup(self.type,self.tag))
+        return 1
+
+
+cdef class OptionTypeDesc(SingleTypeDesc):
+    """TypeDesc class for the options of a Union type."""
+
+    cpdef parse_value(self,value,TypeID type,long long tag):
+        cdef TypeDesc t
+        cdef tuple subtypes
+        if type != self.type:
+            raise UnexpectedWireTypeError(type,self.type)
+        cls = self.type_class
+        if type == _E_TYPE_ENUM:
+            return cls
+        subtypes = self._subtypes.lookup(self.type,self.tag)
+        if len(value) < len(subtypes):
+            _fill_defaults(self,value,subtypes)
+        #  Bypass typechecking and __init__ by filling in the values
+        #  directly.  We already know the types are valid.
+        inst = object.__new__(cls)
+        inst._ep_values = tuple(value)
+        return inst
+
+    cpdef tuple render_value(self,value):
+        if self.type == _E_TYPE_ENUM:
+            return (value,self.type,self.tag)
+        return (value._ep_values,self.type,self.tag)
+
+    cdef int _write_direct(self,Stream s,value) except -1:
+        if not self._is_native():
+            return 0
+        s._write(self._get_header())
+        if self.type != _E_TYPE_ENUM:
+            subtypes = self._subtypes.lookup(self.type,self.tag)
+            s._write_Tuple(value._ep_values,subtypes)
+        return 1
+
+
+cdef class UnionTypeDesc(TypeDesc):
+    """TypeDesc class for Union types.
+
+    The typedescs for the options of the union are kept in a list for each
+    wire type, indexed by tag.  Values that don't match any option are
+    passed to the _ep_promote() method of the type class.
+    """
+
+    cdef readonly list enum_options
+    cdef readonly list tuple_options
+
+    def __init__(self):
+        super(UnionTypeDesc,self).__init__()
+        self.enum_options = []
+        self.tuple_options = []
+
+    def set_options(self,options):
+        """Set the list of typedescs for the options of this union."""
+        cdef SingleTypeDesc t
+        cdef list opts
+        self.enum_options = []
+        self.tuple_options = []
+        for t in options:
+            if t.type == _E_TYPE_ENUM:
+                opts = self.enum_options
+            else:
+                opts = self.tuple_options
+            while len(opts) <= t.tag:
+                opts.append(None)
+            opts[t.tag] = t
+
+    cpdef parse_value(self,value,TypeID type,long long tag):
+        cdef list options
+        if type == _E_TYPE_TUPLE:
+            options = self.tuple_options
+        elif type == _E_TYPE_ENUM:
+            options = self.enum_options
+        else:
+            options = None
+        if options is not None and 0 <= tag < len(options):
+            t = options[tag]
+            if t is not None:
+                return (<TypeDesc>t).parse_value(value,type,tag)
+        return self.type_class._ep_promote(value,type,tag)
+
+    cpdef tuple render_value(self,value):
+        return (<TypeDesc>value._ep_typedesc).render_value(value)
+
+    cdef int _write_direct(self,Stream s,value) except -1:
+        if not self._is_native():
+            return 0
+        return (<TypeDesc>value._ep_typedesc)._write_direct(s,value)
         
 
 
@@ -228,12 +561,65 @@ cdef class Stream(object):
     Instances of this class are used to read or write objects to a generic
     filelike object.  A specialized subclass StringString is used when
     writing to an in-memory string.
+
+    If the optional argument 'interner' is given, it must be an InternTable
+    instance that will be used to de-duplicate the values read from the
+    stream.  If the optional argument 'canonical' is true, values will be
+    written in canonical form.  If the optional argument 'blob_threshold' is
+    given, String values at least that long will be returned as Blob handles
+    into the file, or as views into the string being parsed.
     """
 
     cdef object file
-
-    def __init__(self,file):
+    cdef readonly object interner
+    cdef readonly bint canonical
+    cdef readonly object blob_threshold
+    #  The blob threshold as a C integer, or -1 if it's not set.
+    cdef long long _blob_min
+    cdef dict _intern_table
+    cdef long long _intern_maxsize
+    cdef long long _intern_maxlength
+    cdef bint _intern_tuples
+
+    def __init__(self,file,interner=None,canonical=False,blob_threshold=None):
         self.file = file
+        self.canonical = canonical
+        self._set_interner(interner)
+        self.blob_threshold = blob_threshold
+        if blob_threshold is None:
+            self._blob_min = -1
+        else:
+            self._blob_min = blob_threshold
+
+    cdef _set_interner(self,interner):
+        """Set the InternTable used to de-duplicate parsed values.
+
+        The details of the table are cached on the stream so that we can
+        do the lookups in C.
+        """
+        self.interner = interner
+        if interner is None:
+            self._intern_table = None
+        else:
+            self._intern_table = interner.table
+            self._intern_maxsize = interner.maxsize
+            self._intern_maxlength = interner.maxlength
+            self._intern_tuples = interner.tuples
+
+    cdef _intern(self,value,key=None):
+        """Get the canonical instance of the given value.
+
+        Values are looked up by 'key' if given, otherwise by the value
+        itself.  Tuples are keyed on their typedesc as well as their value.
+        """
+        if key is None:
+            key = value
+        found = self._intern_table.get(key)
+        if found is not None:
+            return found
+        if len(self._intern_table) < self._intern_maxsize:
+            self._intern_table[key] = value
+        return value
 
     def read_value(self,TypeDesc typdesc):
         """Read a generic value from the stream.
@@ -275,6 +661,17 @@ cdef class Stream(object):
         if len(data) < size:
             raise UnexpectedEOFError
 
+    cdef _read_blob(self,long long size):
+        """Read a large string as a Blob recording its position in the file.
+
+        If the file can't report its position, the data is read as usual.
+        """
+        offset = self._tell()
+        if offset is None:
+            return self._read(size)
+        self.file.seek(offset + size)
+        return Blob(self.file,offset,size)
+
     cdef void _write(self,data):
         """Write a Python string to the stream."""
         self.file.write(data)
@@ -284,12 +681,57 @@ cdef class Stream(object):
         s = PyString_FromStringAndSize(&c,1)
         self.file.write(s)
 
+    cdef _write_prerendered(self,data):
+        """Write a string of already-serialized data to the stream."""
+        self._write(data)
+
+    cdef object _tell(self):
+        """Get the current position in the stream, or None if unknown."""
+        try:
+            return self.file.tell()
+        except (AttributeError,IOError):
+            return None
+
+    cdef _instrumented(self,event,TypeDesc typdesc,bint write,value=None):
+        """Read or write a value and record it with the instrumentation.
+
+        The number of bytes is measured as the change in the position of the
+        stream, and is zero if the position is not available.
+        """
+        instrument = _instrument
+        typcls = getattr(typdesc,"type_class",None)
+        startpos = self._tell()
+        start = default_timer()
+        try:
+            if write:
+                self._write_plain_value(value,typdesc)
+            else:
+                value = self._read_plain_value(typdesc)
+        except EOFError:
+            raise
+        except Exception:
+            instrument.record(typcls,event,0,default_timer() - start,True)
+            raise
+        elapsed = default_timer() - start
+        endpos = self._tell()
+        if startpos is None or endpos is None:
+            nbytes = 0
+        else:
+            nbytes = endpos - startpos
+        instrument.record(typcls,event,nbytes,elapsed,False)
+        return value
+
     cdef _read_value(self,TypeDesc typdesc):
+        if _instrument is not None and _is_instrumented(typdesc):
+            return self._instrumented("read",typdesc,False)
+        return self._read_plain_value(typdesc)
+
+    cdef _read_plain_value(self,TypeDesc typdesc):
         cdef long long prefix, tag, length, nitems
         cdef TypeID type
         cdef long vi32
         cdef long long vi64
-        cdef char* data
+        cdef unsigned char* data
         cdef Stream s
         try:
             prefix = self._read_small_int()
@@ -304,15 +746,21 @@ cdef class Stream(object):
         if type & 0x01:
             length = self._read_small_int()
             if type == _E_TYPE_BYTES:
-                value = self._read(length)
+                if self._blob_min >= 0 and length >= self._blob_min:
+                    value = self._read_blob(length)
+                else:
+                    value = self._read(length)
+                    if self._intern_table is not None:
+                        if length <= self._intern_maxlength:
+                            value = self._intern(value)
             else:
                 s = self._get_substream(length)
                 try:
-                    items = typdesc.collection_constructor[(type,tag)]()
+                    items = typdesc._constructors.lookup(type,tag)()
                 except KeyError:
                     raise UnexpectedWireTypeError((type,tag))
                 try:
-                    subtypes = typdesc.subtypes[(type,tag)]
+                    subtypes = typdesc._subtypes.lookup(type,tag)
                 except KeyError:
                     raise UnexpectedWireTypeError
                 if type == _E_TYPE_TUPLE:
@@ -358,24 +806,46 @@ cdef class Stream(object):
             else:
                 raise UnexpectedWireTypeError
         value = typdesc.parse_value(value,type,tag)
+        if type == _E_TYPE_TUPLE and self._intern_tuples:
+            if self._intern_table is not None and PyTuple_CheckExact(value):
+                try:
+                    value = self._intern(value,(typdesc,value))
+                except TypeError:
+                    pass
         return value
 
     cdef _write_value(self,value,TypeDesc typdesc):
+        if _instrument is not None and _is_instrumented(typdesc):
+            self._instrumented("write",typdesc,True,value)
+        else:
+            self._write_plain_value(value,typdesc)
+
+    cdef _write_plain_value(self,value,TypeDesc typdesc):
         cdef long long tag
         cdef TypeID type
-        cdef long long vi64
-        cdef long vi32
-        orig_value = value
+        if typdesc._write_direct(self,value):
+            return
         (value,type,tag) = typdesc.render_value(value)
+        if type == _E_TYPE_PRERENDERED:
+            self._write_prerendered(value)
+            return
         self._write_small_int(tag << 4 | type)
+        self._write_body(value,type,tag,typdesc)
+
+    cdef _write_body(self,value,TypeID type,long long tag,TypeDesc typdesc):
+        """Write a value of the given type, excluding its prefix."""
+        cdef long long vi64
+        cdef long vi32
         if type == _E_TYPE_VINT:
             self._write_int(value)
         elif type == _E_TYPE_TUPLE:
-            subtypes = typdesc.subtypes[(type,tag)]
+            subtypes = typdesc._subtypes.lookup(type,tag)
             self._write_Tuple(value,subtypes)
         elif type == _E_TYPE_BITS8:
             self._write(value)
         elif type == _E_TYPE_BYTES:
+            if not PyString_CheckExact(value):
+                value = _blob_data(value)
             self._write_int(len(value))
             self._write(value)
         elif type == _E_TYPE_BITS32:
@@ -385,7 +855,7 @@ cdef class Stream(object):
             self._write_char((vi32 >> 16) & 0xff)
             self._write_char((vi32 >> 24) & 0xff)
         elif type == _E_TYPE_HTUPLE:
-            subtypes = typdesc.subtypes[(type,tag)]
+            subtypes = typdesc._subtypes.lookup(type,tag)
             self._write_HTuple(value,subtypes)
         elif type == _E_TYPE_BITS64_LONG:
             vi64 = value
@@ -398,7 +868,7 @@ cdef class Stream(object):
             self._write_char((vi64 >> 48) & 0xff)
             self._write_char((vi64 >> 56) & 0xff)
         elif type == _E_TYPE_ASSOC:
-            subtypes = typdesc.subtypes[(type,tag)]
+            subtypes = typdesc._subtypes.lookup(type,tag)
             self._write_Assoc(value,subtypes)
         elif type == TYPE_BITS64_FLOAT:
             data = _S_BITS64_FLOAT.pack(value)
@@ -409,6 +879,13 @@ cdef class Stream(object):
             raise UnexpectedWireTypeError
 
 
+    def skip_value(self):
+        """Efficiently skip over the next value in the stream.
+
+        If there is no value left on the stream, EOFError is raised.
+        """
+        self._skip_value()
+
     cdef _skip_value(self):
         """Efficiently skip over the next value in the stream.
 
@@ -537,6 +1014,13 @@ cdef class Stream(object):
             lx = lx >> 7
         self._write_char(lx)
 
+    cdef _write_uint(self,unsigned long long x):
+        """Write an unsigned C integer encoded in vint format."""
+        while x >= 128:
+            self._write_char((x & 127) | 128)
+            x = x >> 7
+        self._write_char(x)
+
     cdef _write_small_int(self,long long x):
         """Write a small integer encoded in vint format.
 
@@ -557,7 +1041,7 @@ cdef class Stream(object):
         bytes into a StringStream and parse them in memory.
         """
         if length < 4096:
-            return StringStream(self._read(length))
+            return StringStream(self._read(length),self.interner)
         return self
 
     cdef _read_Tuple(self,items,tuple subtypes):
@@ -580,6 +1064,7 @@ cdef class Stream(object):
         cdef long long nitems, i
         cdef Stream s
         s = StringStream()
+        s.canonical = self.canonical
         nitems = len(value)
         s._write_small_int(nitems)
         for i in xrange(nitems):
@@ -593,8 +1078,14 @@ cdef class Stream(object):
         cdef long long ntypes, nitems, i
         nitems = self._read_small_int()
         ntypes = len(subtypes)
-        for i in xrange(nitems):
-            items.append(self._read_value(subtypes[i % ntypes]))
+        if PyList_CheckExact(items) or type(items) is TypedList:
+            #  The parsed values are already of the correct type, so we
+            #  can bypass the conversion done by TypedList.append.
+            for i in xrange(nitems):
+                PyList_Append(items,self._read_value(subtypes[i % ntypes]))
+        else:
+            for i in xrange(nitems):
+                items.append(self._read_value(subtypes[i % ntypes]))
         return items
 
     cdef _write_HTuple(self,value,subtypes):
@@ -602,6 +1093,7 @@ cdef class Stream(object):
         cdef long long nitems, ntypes, i
         cdef Stream s
         s = StringStream()
+        s.canonical = self.canonical
         nitems = len(value)
         s._write_small_int(nitems)
         ntypes = len(subtypes)
@@ -616,13 +1108,27 @@ cdef class Stream(object):
 
         These are encoded as [length][num pairs]<pairs>.
         """
-        cdef long long ntypes, nitems, i
+        cdef long long ntypes, nitems, i, blob_min
+        cdef bint trusted
         nitems = self._read_small_int()
         ntypes = len(subtypes)
-        for i in xrange(nitems):
-            key = self._read_value(subtypes[(2*i) % ntypes])
-            val = self._read_value(subtypes[(2*i + 1) % ntypes])
-            items[key] = val
+        #  The parsed values are already of the correct type, so we
+        #  can bypass the conversion done by TypedDict.__setitem__.
+        trusted = PyDict_CheckExact(items) or type(items) is TypedDict
+        #  Keys must be hashable, so they are never returned as views.
+        blob_min = self._blob_min
+        try:
+            for i in xrange(nitems):
+                self._blob_min = -1
+                key = self._read_value(subtypes[(2*i) % ntypes])
+                self._blob_min = blob_min
+                val = self._read_value(subtypes[(2*i + 1) % ntypes])
+                if trusted:
+                    PyDict_SetItem(items,key,val)
+                else:
+                    items[key] = val
+        finally:
+            self._blob_min = blob_min
         return items
 
     cdef _write_Assoc(self,value,subtypes):
@@ -630,18 +1136,42 @@ cdef class Stream(object):
         cdef long long npairs, i
         cdef Stream s
         s = StringStream()
+        s.canonical = self.canonical
         npairs = len(value)
         s._write_int(npairs)
         ntypes = len(subtypes)
         i = 0
-        for key,val in value.iteritems():
-            s._write_value(key,subtypes[(2*i) % ntypes])
-            s._write_value(val,subtypes[(2*i + 1) % ntypes])
-            i += 1
+        if self.canonical:
+            for (_,key,val) in self._sorted_items(value,subtypes):
+                s._write_value(key,subtypes[(2*i) % ntypes])
+                s._write_value(val,subtypes[(2*i + 1) % ntypes])
+                i += 1
+        else:
+            for key,val in value.iteritems():
+                s._write_value(key,subtypes[(2*i) % ntypes])
+                s._write_value(val,subtypes[(2*i + 1) % ntypes])
+                i += 1
         data = s._getstring()
         self._write_int(len(data))
         self._write(data)
 
+    cdef list _sorted_items(self,value,subtypes):
+        """Get the items of an Assoc in canonical order.
+
+        This returns a list of (data,key,value) tuples sorted by 'data',
+        the canonical serialized form of the key.
+        """
+        cdef list items
+        cdef StringStream s
+        items = []
+        for (key,val) in value.iteritems():
+            s = StringStream()
+            s.canonical = True
+            s._write_value(key,subtypes[0])
+            items.append((s._getstring(),key,val))
+        items.sort(key=itemgetter(0))
+        return items
+
 #  This is a simple cache of the most recently allocated StringStream
 #  buffer, so that it can be re-used without constant mallocing.
 cdef char* _spare_stringstream_buffer
@@ -660,11 +1190,13 @@ cdef class StringStream(Stream):
     cdef long long curpos
     cdef long long length
 
-    def __init__(self,value=None):
+    def __init__(self,value=None,interner=None,canonical=False,
+                 blob_threshold=None):
         global _spare_stringstream_buffer
         global _spare_stringstream_length
         cdef char* spare_buffer
         cdef long long spare_length
+        cdef Py_ssize_t buflen
         self.curpos = 0
         if value is None:
 #  TODO: make this thread-safe, or discard it.
@@ -680,10 +1212,21 @@ cdef class StringStream(Stream):
 #                _spare_stringstream_length = 0
 #                self.length = spare_length
 #                self.buffer = spare_buffer
-        else:
+        elif PyString_Check(value) or PyUnicode_Check(value):
+            value = str(value)
             self.length = len(value)
             self.buffer = PyString_AsString(value)
-        super(StringStream,self).__init__(value)
+        else:
+            #  Other buffers such as mmap are parsed in place.  We keep a
+            #  reference to them in self.file, like we do for strings.
+            try:
+                PyObject_AsReadBuffer(value,<void**>&self.buffer,&buflen)
+            except TypeError:
+                value = _blob_data(_view(value,0,len(value)))
+                PyObject_AsReadBuffer(value,<void**>&self.buffer,&buflen)
+            self.length = buflen
+        super(StringStream,self).__init__(value,interner,canonical,
+                                          blob_threshold)
 
     def __dealloc__(self):
         global _spare_stringstream_buffer
@@ -715,6 +1258,14 @@ cdef class StringStream(Stream):
             raise UnexpectedEOFError
         self.curpos += size
 
+    cdef _read_blob(self,long long size):
+        """Read a large string as a view into the string being parsed."""
+        if self.curpos + size > self.length:
+            raise UnexpectedEOFError
+        value = _view(self.file,self.curpos,size)
+        self.curpos += size
+        return value
+
     cdef _growbuffer(self,long long dlen):
         self.length = self.length * 2
         while self.curpos + dlen > self.length:
@@ -745,32 +1296,213 @@ cdef class StringStream(Stream):
     cdef _getstring(self):
         return PyString_FromStringAndSize(self.buffer,self.curpos)
 
+    cdef object _tell(self):
+        return self.curpos
+
+
+cdef class HashStream(StringStream):
+    """Special-purpose implementation of Stream for hashing values.
+
+    Values written to this stream are fed into the given hash object in
+    canonical form, but without the length prefix of each Tuple, HTuple or
+    Assoc.  Since the items in these types are self-delimiting, the output
+    is still unambiguous, and it can be generated without buffering more
+    than a small chunk of data at a time.
+    """
+
+    cdef readonly object hash
+
+    def __init__(self,hash):
+        super(HashStream,self).__init__(None,None,True)
+        self.hash = hash
+
+    cdef void _write(self,data):
+        StringStream._write(self,data)
+        if self.curpos >= 65536:
+            self._flush()
+
+    cdef void _write_char(self,char c):
+        StringStream._write_char(self,c)
+        if self.curpos >= 65536:
+            self._flush()
 
+    cdef _flush(self):
+        """Feed the buffered data into the hash."""
+        self.hash.update(PyString_FromStringAndSize(self.buffer,self.curpos))
+        self.curpos = 0
 
+    cdef _getstring(self):
+        raise NotImplementedError
 
-def from_string(string,typcls):
-    """Parse an instance of the given typeclass from the given string."""
+    cdef object _tell(self):
+        return None
+
+    def digest(self):
+        """Get the digest of all data written to the stream."""
+        self._flush()
+        return self.hash.digest()
+
+    cdef _write_prerendered(self,data):
+        cdef StringStream s
+        s = StringStream(data)
+        self._write_unframed(s)
+
+    cdef _write_unframed(self,StringStream s):
+        """Copy a value from the given stream, removing length prefixes."""
+        cdef long long prefix, length, nitems, i
+        cdef int type
+        prefix = s._read_small_int()
+        self._write_small_int(prefix)
+        type = prefix & 0xf
+        if type == _E_TYPE_BYTES:
+            length = s._read_small_int()
+            self._write_small_int(length)
+            self._write(s._read(length))
+        elif type & 0x01:
+            s._read_small_int()
+            nitems = s._read_small_int()
+            self._write_small_int(nitems)
+            if type == _E_TYPE_ASSOC:
+                nitems = nitems * 2
+            for i in xrange(nitems):
+                self._write_unframed(s)
+        elif type == _E_TYPE_VINT:
+            self._write_int(s._read_int())
+        elif type == _E_TYPE_BITS8:
+            self._write(s._read(1))
+        elif type == _E_TYPE_BITS32:
+            self._write(s._read(4))
+        elif type == _E_TYPE_BITS64_LONG:
+            self._write(s._read(8))
+        elif type == _E_TYPE_BITS64_FLOAT:
+            self._write(s._read(8))
+        elif type == _E_TYPE_ENUM:
+            pass
+        else:
+            raise UnexpectedWireTypeError
+
+    cdef _write_Tuple(self,value,subtypes):
+        cdef long long nitems, i
+        nitems = len(value)
+        self._write_small_int(nitems)
+        for i in xrange(nitems):
+            self._write_value(value[i],subtypes[i])
+
+    cdef _write_HTuple(self,value,subtypes):
+        cdef long long nitems, ntypes, i
+        nitems = len(value)
+        self._write_small_int(nitems)
+        ntypes = len(subtypes)
+        for i in xrange(nitems):
+            self._write_value(value[i],subtypes[i % ntypes])
+
+    cdef _write_Assoc(self,value,subtypes):
+        cdef long long ntypes, i
+        self._write_small_int(len(value))
+        ntypes = len(subtypes)
+        i = 0
+        for (_,key,val) in self._sorted_items(value,subtypes):
+            self._write_value(key,subtypes[(2*i) % ntypes])
+            self._write_value(val,subtypes[(2*i + 1) % ntypes])
+            i += 1
+
+
+
+
+def from_string(string,typcls,interner=None,blob_threshold=None):
+    """Parse an instance of the given typeclass from the given string.
+
+    If an InternTable is given as 'interner', parsed values will be
+    de-duplicated using that table.  If 'blob_threshold' is given, String
+    values at least that long are returned as zero-copy views into the
+    string, which may also be an mmap or other buffer object.
+    """
     cdef StringStream s
-    s = StringStream(string)
+    s = StringStream(string,interner,blob_threshold=blob_threshold)
+    if _instrument is not None:
+        return s._instrumented("from_string",typcls._ep_typedesc,False)
     return s._read_value(typcls._ep_typedesc)
 
-def from_file(file,typcls):
-    """Parse an instance of the given typeclass from the given file."""
+def from_file(file,typcls,interner=None,blob_threshold=None):
+    """Parse an instance of the given typeclass from the given file.
+
+    If an InternTable is given as 'interner', parsed values will be
+    de-duplicated using that table.  If 'blob_threshold' is given, String
+    values at least that long are returned as lazy Blob handles giving
+    their position in the file.
+    """
     cdef Stream s
-    s = Stream(file)
+    s = Stream(file,interner,blob_threshold=blob_threshold)
+    if _instrument is not None:
+        return s._instrumented("from_file",typcls._ep_typedesc,False)
     return s._read_value(typcls._ep_typedesc)
 
-def to_string(value,typcls):
-    """Render an instance of the given typeclass into a string."""
+def to_string(value,typcls,canonical=False):
+    """Render an instance of the given typeclass into a string.
+
+    If 'canonical' is true, the entries of each Assoc are written in order
+    of their serialized keys, so that equal values always produce the same
+    string.
+    """
     cdef StringStream s
-    s = StringStream()
+    s = StringStream(None,None,canonical)
+    if _instrument is not None:
+        s._instrumented("to_string",typcls._ep_typedesc,True,value)
+    else:
+        s._write_value(value,typcls._ep_typedesc)
+    return s._getstring()
+
+def _to_string(value,typcls,canonical=False):
+    """Render a value into a string as part of rendering a larger value.
+
+    This is like to_string(), but doesn't record a top-level event with the
+    active instrumentation.  It's used to render the fields of incremental
+    messages and the pieces of a list written by extprot.streaming, whose
+    output is covered by the event for the value as a whole, if any.
+    """
+    cdef StringStream s
+    s = StringStream(None,None,canonical)
     s._write_value(value,typcls._ep_typedesc)
     return s._getstring()
 
-def to_file(file,value,typcls):
+def to_file(file,value,typcls,canonical=False):
     """Render an instance of the given typeclass into a file."""
     cdef Stream s
-    s = Stream(file)
+    s = Stream(file,None,canonical)
+    if _instrument is not None:
+        s._instrumented("to_file",typcls._ep_typedesc,True,value)
+    else:
+        s._write_value(value,typcls._ep_typedesc)
+
+def fingerprint(value,typcls,algorithm="sha1"):
+    """Calculate a digest of the canonical form of the given value.
+
+    Equal values always have the same fingerprint, regardless of the order
+    of any Assoc entries.  The value is fed into the hash incrementally, so
+    its serialized form is never built in memory.  To make this possible,
+    the length prefixes of Tuples, Lists and Assocs are omitted from the
+    hashed data.
+    """
+    cdef HashStream s
+    s = HashStream(hashlib.new(algorithm))
     s._write_value(value,typcls._ep_typedesc)
+    return s.digest()
 
+def encode_vint(x):
+    """Encode an integer in vint format, returning a string."""
+    cdef StringStream s
+    s = StringStream()
+    s._write_int(x)
+    return s._getstring()
+
+def decode_vint(string,long long offset=0):
+    """Decode a vint from the given string, starting at the given offset.
 
+    The return value is a tuple giving the decoded integer and the offset
+    just past its end.
+    """
+    cdef StringStream s
+    s = StringStream(string)
+    s.curpos = offset
+    x = s._read_int()
+    return (x,s.curpos)
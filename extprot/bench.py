@@ -0,0 +1,516 @@
+"""
+
+  extprot.bench:  benchmark suite for the extprot serialization engines
+
+This module measures the speed of building, encoding, decoding and skipping
+over a range of extprot messages, using both the pure-python and the cython
+serialization engines.  Run it from the command-line like so:
+
+    $ python -m extprot.bench
+
+and it will print a table of results.  The messages are built from the
+protocols in the "examples" directory along with some synthetic schemas:
+
+    small:         a single person from examples/address_book.proto
+    address_book:  an address book from examples/address_book.proto
+    wide:          a message with many primitive fields
+    deep:          a deeply-nested chain of messages
+    lists:         a message with long lists of ints, strings and tuples
+    unions:        a list of union messages from examples/tst.proto
+
+For each message we time these operations:
+
+    build:             construct the message with full validation
+    build-shallow:     construct the message with shallow validation
+    build-none:        construct the message without validation
+    encode:            serialize the message to a string
+    decode:            parse the message from a string
+    decode-interned:   parse the message using a shared InternTable
+    skip:              skip over the serialized message in a stream
+
+Each result reports operations per second, bytes of serialized data per
+second, and the number of objects allocated per operation.  Python 2 has no
+hooks for tracing individual allocations, so the latter is measured as the
+number of new garbage-collected objects that are alive after the operation,
+including those that make up its result.
+
+Each result also reports the memory used by the results of the operation,
+as calculated by utils.deep_sizeof() over a batch of results so that any
+shared values are counted only once.  If the tracemalloc module is available
+the peak memory allocated while producing the batch is reported as well.
+
+Use the --json option to write the results in JSON format, and --compare to
+show the speed of each operation relative to an earlier JSON report.
+
+"""
+
+import os
+import sys
+import gc
+import time
+import json
+import optparse
+import platform
+import itertools
+import subprocess
+from timeit import default_timer
+
+import extprot
+from extprot.utils import deep_sizeof
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+ENGINES = ("pure","cython")
+OPERATIONS = ("build","build-shallow","build-none","encode","decode",
+              "decode-interned","skip")
+
+_EXAMPLES_DIR = os.path.join(os.path.dirname(__file__),"..","examples")
+
+
+class EngineUnavailableError(Exception):
+    """Raised when the requested serialization engine can't be used."""
+    pass
+
+
+def use_engine(engine):
+    """Select the serialization engine to be used by extprot.types.
+
+    This works by controlling which engine module extprot.types imports,
+    so it must be called before that module is loaded.
+    """
+    if engine not in ENGINES:
+        raise ValueError("unknown engine: " + repr(engine))
+    if "extprot.types" not in sys.modules:
+        if engine == "pure":
+            sys.modules["extprot._serialize"] = None
+        else:
+            try:
+                from extprot import _serialize
+            except ImportError, e:
+                raise EngineUnavailableError(str(e))
+    if current_engine() != engine:
+        msg = "extprot.types is already using the %s engine"
+        raise EngineUnavailableError(msg % (current_engine(),))
+
+
+def current_engine():
+    """Get the name of the serialization engine used by extprot.types."""
+    from extprot import types
+    if types.serialize.__name__ == "extprot._serialize":
+        return "cython"
+    return "pure"
+
+
+##
+##  Benchmark cases.
+##
+##  Each case is a function taking a dict of example protocol namespaces, and
+##  returning a tuple (typcls,build) where 'build' is a function that
+##  constructs the message to be benchmarked.
+##
+
+CASES = []
+
+def case(func):
+    """Decorator to register a benchmark case."""
+    CASES.append(func)
+    return func
+
+
+def load_examples():
+    """Load the example protocols into a dict of namespaces.
+
+    Examples that can't be loaded (for example, because pyparsing is not
+    installed or the examples directory is not available) are omitted.
+    """
+    examples = {}
+    for name in ("address_book","tst"):
+        ns = {}
+        try:
+            extprot.import_protocol(os.path.join(_EXAMPLES_DIR,name+".proto"),ns)
+        except (ImportError,EnvironmentError):
+            continue
+        examples[name] = ns
+    return examples
+
+
+def _message_class(name,fields):
+    """Build a Message subclass with the given (name,type) pairs as fields.
+
+    The Field objects are created in the order given, which determines the
+    order of the fields in the message.
+    """
+    from extprot import types
+    attrs = {}
+    for (fname,ftype) in fields:
+        attrs[fname] = types.Field(ftype)
+    return type(name,(types.Message,),attrs)
+
+
+@case
+def small(examples):
+    ns = examples["address_book"]
+    person = ns["person"]
+    optional = ns["optional"]
+    phone_type = ns["phone_type"]
+    def build():
+        return person("Ryan Kelly",12345678,optional.Set("ryan@rfk.id.au"),
+                      [("0400 123 456",phone_type.Mobile)])
+    return (person,build)
+
+
+@case
+def address_book(examples):
+    ns = examples["address_book"]
+    person = ns["person"]
+    optional = ns["optional"]
+    phone_type = ns["phone_type"]
+    phone_types = (phone_type.Mobile,phone_type.Home,phone_type.Work)
+    def build():
+        persons = []
+        for i in xrange(100):
+            if i % 3:
+                email = optional.Set("person%d@example.com" % (i,))
+            else:
+                email = optional.Unset
+            phones = [("555 %04d" % (i+j,),phone_types[j]) for j in xrange(i%4)]
+            persons.append(person("Person %d" % (i,),i,email,phones))
+        return ns["address_book"](persons)
+    return (ns["address_book"],build)
+
+
+@case
+def wide(examples):
+    from extprot import types
+    ftypes = (types.Int,types.String,types.Bool,types.Float,types.Long)
+    fvalues = (-123456,"hello world",True,3.14159,2**40)
+    fields = [("f%d" % (i,),ftypes[i%5]) for i in xrange(64)]
+    wide = _message_class("wide",fields)
+    def build():
+        return wide(*[fvalues[i%5] for i in xrange(64)])
+    return (wide,build)
+
+
+@case
+def deep(examples):
+    from extprot import types
+    levels = [_message_class("deep",[("value",types.Int)])]
+    for _ in xrange(31):
+        fields = [("value",types.Int),("child",levels[-1])]
+        levels.append(_message_class("deep",fields))
+    def build():
+        value = levels[0](0)
+        for (i,msg) in enumerate(levels[1:]):
+            value = msg(i+1,value)
+        return value
+    return (levels[-1],build)
+
+
+@case
+def lists(examples):
+    from extprot import types
+    point = types.Tuple.build(types.Int,types.Int)
+    lists = _message_class("lists",[("ints",types.List.build(types.Int)),
+                                    ("strings",types.List.build(types.String)),
+                                    ("points",types.Array.build(point))])
+    def build():
+        return lists(range(-500,500),
+                     ["item %d" % (i,) for i in xrange(100)],
+                     [(i,i*i) for i in xrange(200)])
+    return (lists,build)
+
+
+@case
+def unions(examples):
+    from extprot import types
+    ns = examples["tst"]
+    doc = ns["doc"]
+    dim = ns["dim"]
+    meta = ns["meta"]
+    source = ns["source"]
+    metadata = ns["metadata"]
+    docs = _message_class("docs",[("docs",types.List.build(doc))])
+    def build():
+        items = []
+        for i in xrange(200):
+            if i % 2:
+                items.append(doc.Simple(i,"simple %d" % (i,)))
+            else:
+                md = metadata(meta.Set(source.One,"author %d" % (i,)),meta.Unset)
+                d = (dim.A(i),dim.B(i/7.0),dim.D(i))[i%3]
+                items.append(doc.Normal(i,d,"normal %d" % (i,),md))
+        return docs(items)
+    return (docs,build)
+
+
+##
+##  Benchmark runner.
+##
+
+def _time_loop(func,number):
+    """Time 'number' calls to the given function, with gc disabled."""
+    loop = itertools.repeat(None,number)
+    gcold = gc.isenabled()
+    gc.disable()
+    try:
+        start = default_timer()
+        for _ in loop:
+            func()
+        return default_timer() - start
+    finally:
+        if gcold:
+            gc.enable()
+
+
+def measure_rate(func,min_time=0.2,repeat=3):
+    """Measure the number of calls per second to the given function.
+
+    The number of calls in each timing loop is increased until the loop
+    takes at least 'min_time' seconds, and the best of 'repeat' such loops
+    is used to calculate the rate.
+    """
+    number = 1
+    while True:
+        t = _time_loop(func,number)
+        if t >= min_time:
+            break
+        if t <= min_time / 100:
+            number *= 10
+        else:
+            number = int(number * min_time * 1.2 / t) + 1
+    best = t
+    for _ in xrange(repeat - 1):
+        best = min(best,_time_loop(func,number))
+    return number / best
+
+
+def measure_objects(func,number=100):
+    """Measure the number of new gc-tracked objects per call to 'func'.
+
+    The results of each call are kept alive until after counting, so any
+    objects that make up the result are included.
+    """
+    gc.collect()
+    before = len(gc.get_objects())
+    results = [func() for _ in xrange(number)]
+    gc.collect()
+    after = len(gc.get_objects())
+    #  Don't count the list holding the results.
+    return (after - before - 1) / float(number)
+
+
+def measure_memory(func,number=100):
+    """Measure the memory used by the results of calls to 'func'.
+
+    This returns a tuple (retained,peak) giving the average memory per call
+    used by the results, and the average peak memory allocated per call
+    while producing them.  The peak is measured using tracemalloc, and is
+    None if that module is not available.
+    """
+    gc.collect()
+    if tracemalloc is None:
+        results = [func() for _ in xrange(number)]
+        peak = None
+    else:
+        tracemalloc.start()
+        try:
+            results = [func() for _ in xrange(number)]
+            peak = tracemalloc.get_traced_memory()[1] / float(number)
+        finally:
+            tracemalloc.stop()
+    #  Don't count the list holding the results.
+    retained = deep_sizeof(results) - sys.getsizeof(results)
+    retained = retained / float(number)
+    return (retained,peak)
+
+
+def _operations(typcls,build):
+    """Get a dict mapping operation names to benchmark functions."""
+    from extprot import types
+    from extprot.utils import validation, InternTable
+    serialize = types.serialize
+    value = build()
+    data = serialize.to_string(value,typcls)
+    interner = InternTable()
+    def build_with(level):
+        def build_func():
+            with validation(level):
+                return build()
+        return build_func
+    return (data,{
+        "build": build,
+        "build-shallow": build_with(types.VALIDATE_SHALLOW),
+        "build-none": build_with(types.VALIDATE_NONE),
+        "encode": lambda: serialize.to_string(value,typcls),
+        "decode": lambda: serialize.from_string(data,typcls),
+        "decode-interned": lambda: serialize.from_string(data,typcls,interner),
+        "skip": lambda: serialize.StringStream(data).skip_value(),
+    })
+
+
+def run(cases=None,operations=None,min_time=0.2,repeat=3):
+    """Run the benchmarks using the current engine.
+
+    The arguments 'cases' and 'operations' can be used to restrict the names
+    of the benchmarks to be run.  A list of result dicts is returned.
+    """
+    engine = current_engine()
+    examples = load_examples()
+    results = []
+    for casefunc in CASES:
+        if cases and casefunc.__name__ not in cases:
+            continue
+        try:
+            (typcls,build) = casefunc(examples)
+        except KeyError:
+            #  The example protocol couldn't be loaded.
+            continue
+        (data,funcs) = _operations(typcls,build)
+        for op in OPERATIONS:
+            if operations and op not in operations:
+                continue
+            rate = measure_rate(funcs[op],min_time,repeat)
+            (retained,peak) = measure_memory(funcs[op])
+            results.append({
+                "engine": engine,
+                "case": casefunc.__name__,
+                "op": op,
+                "size": len(data),
+                "ops_per_sec": rate,
+                "bytes_per_sec": rate * len(data),
+                "objects_per_op": measure_objects(funcs[op]),
+                "retained_bytes": retained,
+                "peak_bytes": peak,
+            })
+    return results
+
+
+def run_engine(engine,args=()):
+    """Run the benchmarks for the given engine in a subprocess.
+
+    Since the engine used by extprot.types is fixed when it is imported,
+    each engine must be run in a separate process.  If the engine is not
+    available then EngineUnavailableError is raised.
+    """
+    env = os.environ.copy()
+    pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pypath = [pkgdir]
+    if env.get("PYTHONPATH"):
+        pypath.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(pypath)
+    cmd = [sys.executable,"-m","extprot.bench","--engine",engine,"--json","-"]
+    cmd.extend(args)
+    proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,env=env)
+    (out,err) = proc.communicate()
+    if proc.returncode == 2:
+        raise EngineUnavailableError(err.strip())
+    if proc.returncode != 0:
+        raise RuntimeError("benchmark subprocess failed:\n" + err)
+    return json.loads(out)["results"]
+
+
+def make_report(results):
+    """Make a JSON-compatible report from a list of results."""
+    return {
+        "version": extprot.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime()),
+        "results": results,
+    }
+
+
+def format_results(results,baseline=None):
+    """Format a list of results as a human-readable table.
+
+    If a baseline report is given, each result is also shown as a ratio
+    to the speed of the matching operation in the baseline.
+    """
+    base_rates = {}
+    if baseline is not None:
+        for r in baseline["results"]:
+            base_rates[(r["engine"],r["case"],r["op"])] = r["ops_per_sec"]
+    header = "%-7s %-13s %-15s %12s %10s %9s %10s %10s" % ("engine","case",
+                   "op","ops/sec","MB/sec","objs/op","mem/op","peak/op")
+    if baseline is not None:
+        header += " %8s" % ("vs base",)
+    lines = [header]
+    for r in results:
+        ln = "%-7s %-13s %-15s %12.1f %10.2f %9.1f %10.0f" % (r["engine"],
+                    r["case"],r["op"],r["ops_per_sec"],
+                    r["bytes_per_sec"] / 1e6,r["objects_per_op"],
+                    r["retained_bytes"])
+        if r.get("peak_bytes") is None:
+            ln += " %10s" % ("-",)
+        else:
+            ln += " %10.0f" % (r["peak_bytes"],)
+        if baseline is not None:
+            base = base_rates.get((r["engine"],r["case"],r["op"]))
+            if base:
+                ln += " %7.2fx" % (r["ops_per_sec"] / base,)
+            else:
+                ln += " %8s" % ("-",)
+        lines.append(ln)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Command-line entry point for the benchmark suite."""
+    parser = optparse.OptionParser(usage="python -m extprot.bench [options]")
+    parser.add_option("--engine",choices=ENGINES+("all",),default="all",
+                      help="serialization engine to benchmark (default: all)")
+    parser.add_option("--case",action="append",dest="cases",
+                      help="run only the named case (may be repeated)")
+    parser.add_option("--op",action="append",dest="operations",
+                      help="run only the named operation (may be repeated)")
+    parser.add_option("--min-time",type="float",default=0.2,
+                      help="minimum time for each timing loop, in seconds")
+    parser.add_option("--repeat",type="int",default=3,
+                      help="number of timing loops for each benchmark")
+    parser.add_option("--json",metavar="FILE",
+                      help="write the results as JSON to FILE ('-' for stdout)")
+    parser.add_option("--compare",metavar="FILE",
+                      help="compare against results from an earlier --json run")
+    (opts,args) = parser.parse_args(argv)
+    if opts.engine == "all":
+        run_args = ["--min-time",str(opts.min_time),"--repeat",str(opts.repeat)]
+        for c in (opts.cases or ()):
+            run_args.extend(("--case",c))
+        for op in (opts.operations or ()):
+            run_args.extend(("--op",op))
+        results = []
+        for engine in ENGINES:
+            try:
+                results.extend(run_engine(engine,run_args))
+            except EngineUnavailableError, e:
+                print >>sys.stderr, "skipping %s engine: %s" % (engine,e)
+    else:
+        try:
+            use_engine(opts.engine)
+        except EngineUnavailableError, e:
+            print >>sys.stderr, e
+            return 2
+        results = run(opts.cases,opts.operations,opts.min_time,opts.repeat)
+    if opts.json:
+        report = json.dumps(make_report(results),indent=2,sort_keys=True)
+        if opts.json == "-":
+            print report
+        else:
+            with open(opts.json,"w") as f:
+                f.write(report)
+    if opts.json != "-":
+        baseline = None
+        if opts.compare:
+            with open(opts.compare,"r") as f:
+                baseline = json.load(f)
+        print format_results(results,baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
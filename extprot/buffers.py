@@ -0,0 +1,119 @@
+"""
+
+  extprot.buffers:  scatter-gather encoding for writev and sendmsg
+
+Encoding a value with to_string() copies every String into a single output
+buffer, which is wasteful for messages carrying large payloads that are only
+going to be written straight out to a file or socket.  The to_buffers()
+function in this module instead returns a list of buffers whose contents,
+taken together, are the encoded value.  Headers and small fields are gathered
+into small strings, while large String values appear in the list as the
+original objects, so they can be handed to a call such as socket.sendmsg()
+or os.writev() without being copied at all:
+
+    for buf in to_buffers(msg,attachment):
+        sock.sendall(buf)
+
+Values are walked in Python using the type descriptions of the active
+engine, so this is slower than to_string() for values made up of many small
+fields.  Frozen and incrementally-encoded messages are written out in their
+already-serialized form.
+
+"""
+
+from extprot.errors import *
+from extprot.types import serialize
+from extprot.utils import Blob
+from extprot.serialize import _write_vint, _pack_bits32, _pack_bits64_long
+from extprot.serialize import _pack_bits64_float
+
+
+#  Strings at least this long are referenced in place by default.
+DEFAULT_THRESHOLD = 4096
+
+
+def to_buffers(value,typcls,threshold=DEFAULT_THRESHOLD):
+    """Encode a value as a list of buffers, without copying large strings.
+
+    This returns a list of string or buffer objects that, joined together,
+    give the same data as to_string(value,typcls).  String values at least
+    'threshold' bytes long, including any already-serialized messages and
+    any views of a buffer returned by from_string(), are included in the
+    list as-is.  Everything else is coalesced into strings between them.
+    Blob handles are read into memory in order to be included.
+    """
+    pieces = [bytearray()]
+    _render(pieces,value,typcls._ep_typedesc,threshold)
+    buffers = []
+    for piece in pieces:
+        if piece.__class__ is bytearray:
+            if piece:
+                buffers.append(str(piece))
+        else:
+            buffers.append(piece)
+    return buffers
+
+
+def _render(pieces,value,typdesc,threshold):
+    """Render a value onto the end of a list of pieces.
+
+    The last item of 'pieces' is always a bytearray, onto which small items
+    are written.  Large strings are appended to the list directly, followed
+    by a new bytearray for the data that comes after them.
+    """
+    (value,type,tag) = typdesc.render_value(value)
+    if type == serialize.TYPE_PRERENDERED:
+        _append_data(pieces,value,threshold)
+        return
+    out = pieces[-1]
+    _write_vint(out,tag << 4 | type)
+    if type == serialize.TYPE_VINT:
+        _write_vint(out,value)
+    elif type == serialize.TYPE_BYTES:
+        if value.__class__ is Blob:
+            value = value.tobytes()
+        _write_vint(out,len(value))
+        _append_data(pieces,value,threshold)
+    elif type & 0x01:
+        subtypes = typdesc.subtypes[(type,tag)]
+        ntypes = len(subtypes)
+        #  The items are rendered into a separate list of pieces so that we
+        #  can find their total size, then spliced onto the end of ours.
+        items = [bytearray()]
+        _write_vint(items[0],len(value))
+        if type == serialize.TYPE_TUPLE:
+            for i in xrange(len(value)):
+                _render(items,value[i],subtypes[i],threshold)
+        elif type == serialize.TYPE_HTUPLE:
+            for (i,item) in enumerate(value):
+                _render(items,item,subtypes[i % ntypes],threshold)
+        elif type == serialize.TYPE_ASSOC:
+            for (i,(key,val)) in enumerate(value.iteritems()):
+                _render(items,key,subtypes[(2*i) % ntypes],threshold)
+                _render(items,val,subtypes[(2*i + 1) % ntypes],threshold)
+        else:
+            raise UnexpectedWireTypeError
+        _write_vint(out,sum(len(piece) for piece in items))
+        out += items[0]
+        pieces.extend(items[1:])
+    elif type == serialize.TYPE_BITS8:
+        out += value
+    elif type == serialize.TYPE_BITS32:
+        out += _pack_bits32(value)
+    elif type == serialize.TYPE_BITS64_LONG:
+        out += _pack_bits64_long(value)
+    elif type == serialize.TYPE_BITS64_FLOAT:
+        out += _pack_bits64_float(value)
+    elif type == serialize.TYPE_ENUM:
+        pass
+    else:
+        raise UnexpectedWireTypeError
+
+
+def _append_data(pieces,data,threshold):
+    """Append string data to a list of pieces, in place if it's large."""
+    if len(data) >= threshold:
+        pieces.append(data)
+        pieces.append(bytearray())
+    else:
+        pieces[-1] += data
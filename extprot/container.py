@@ -0,0 +1,365 @@
+"""
+
+  extprot.container:  block-compressed container files for extprot records
+
+This module implements a simple container file format for storing large
+numbers of extprot values of a single type.  Concatenating the output of
+to_file() works fine for small files, but it has no structure that can be
+used to compress the data, to skip over regions of the file, or to split it
+up for parallel processing.  A container file looks like this:
+
+    <magic> <header> <block> <block> ...
+
+The header is an extprot-encoded message giving the fingerprint of the
+schema used to write the file, the name of the compression codec, a random
+sync marker and any user-supplied metadata.  Each block looks like this:
+
+    <sync marker> <block header> <compressed data>
+
+where the block header is an extprot-encoded message giving the number of
+records in the block, the length of the compressed data and a checksum of
+the compressed data.  The records themselves are the standard extprot
+encoding of each value, concatenated and compressed as a unit.
+
+Since the block header gives the length of the compressed data, readers can
+skip whole blocks without decompressing them.  Since each block starts with
+the sync marker, readers can recover from a corrupted region by scanning
+ahead for the next marker, and a file can be split at arbitrary byte offsets
+by having each reader start at the first marker after its offset.  You'd
+use it like so:
+
+    w = ContainerWriter(open("people.epc","wb"),person)
+    for p in people:
+        w.write(p)
+    w.close()
+
+    for p in ContainerReader(open("people.epc","rb"),person):
+        print p.name
+
+The reader needs a seekable file, the writer does not.
+
+"""
+
+import os
+import zlib
+import hashlib
+
+from extprot.errors import *
+from extprot import types
+from extprot.types import serialize
+
+
+MAGIC = "EPC\x01"
+SYNC_SIZE = 16
+
+
+CODECS = {}
+
+def register_codec(name,compress,decompress):
+    """Register a compression codec for use in container files.
+
+    The arguments 'compress' and 'decompress' must be functions that take
+    a string and return a string.  The codec name is recorded in the file
+    header, so the same codec must be registered when reading the file.
+    """
+    CODECS[name] = (compress,decompress)
+
+register_codec("null",str,str)
+register_codec("zlib",zlib.compress,zlib.decompress)
+try:
+    import bz2
+except ImportError:
+    pass
+else:
+    register_codec("bz2",bz2.compress,bz2.decompress)
+
+
+def schema_fingerprint(typcls):
+    """Calculate a fingerprint for the wire structure of a type class.
+
+    The fingerprint is a string digest that depends on the primitive types,
+    tags and subtypes of the given type class, but not on the names that it
+    uses for its types or fields.  Two type classes with equal fingerprints
+    will read and write identical bytestreams.
+    """
+    return hashlib.sha1(_describe_type(typcls,{})).digest()
+
+def _describe_type(typcls,seen):
+    """Build a string describing the wire structure of a type class."""
+    try:
+        return "@%d" % (seen[typcls],)
+    except KeyError:
+        seen[typcls] = len(seen)
+    for base in typcls.__mro__:
+        if base.__module__ == types.__name__:
+            kind = base.__name__
+            break
+    else:
+        kind = typcls.__name__
+    desc = "%s:%d:%d" % (kind,typcls._ep_primtype,typcls._ep_tag)
+    subdescs = [_describe_type(t,seen) for t in typcls._types]
+    return desc + "(" + ",".join(subdescs) + ")"
+
+
+class _Header(types.Message):
+    """Header message written at the start of every container file."""
+    fingerprint = types.Field(types.String)
+    codec = types.Field(types.String)
+    sync = types.Field(types.String)
+    metadata = types.Field(types.Assoc.build(types.String,types.String))
+
+class _BlockHeader(types.Message):
+    """Header message written after the sync marker of every block."""
+    count = types.Field(types.Int)
+    length = types.Field(types.Int)
+    checksum = types.Field(types.Long)
+
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class ContainerWriter(object):
+    """Write extprot values of a given type into a container file.
+
+    Values are buffered in memory until 'block_records' values or roughly
+    'block_size' bytes of encoded data have been collected, at which point
+    they are compressed and written out as a single block.  Call flush()
+    to force out the current block, and close() when you're done writing.
+    """
+
+    def __init__(self,file,typcls,codec="zlib",block_records=1000,
+                 block_size=1024*1024,metadata=None):
+        try:
+            (self._compress,_) = CODECS[codec]
+        except KeyError:
+            raise ValueError("unknown codec: " + repr(codec))
+        self.file = file
+        self.typcls = typcls
+        self.codec = codec
+        self.block_records = block_records
+        self.block_size = block_size
+        self.sync = os.urandom(SYNC_SIZE)
+        self.closed = False
+        self._pending = []
+        self._pending_size = 0
+        header = _Header(schema_fingerprint(typcls),codec,self.sync,metadata)
+        self.file.write(MAGIC)
+        self.file.write(header.to_string())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def write(self,value):
+        """Add the given value to the container."""
+        if self.closed:
+            raise ValueError("write to closed ContainerWriter")
+        data = serialize.to_string(value,self.typcls)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if len(self._pending) >= self.block_records:
+            self.flush()
+        elif self._pending_size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Write out any pending values as a new block."""
+        if self._pending:
+            data = self._compress("".join(self._pending))
+            header = _BlockHeader(len(self._pending),len(data),_checksum(data))
+            self.file.write(self.sync)
+            self.file.write(header.to_string())
+            self.file.write(data)
+            self._pending = []
+            self._pending_size = 0
+        try:
+            self.file.flush()
+        except AttributeError:
+            pass
+
+    def close(self):
+        """Write out any pending values and close the writer.
+
+        The underlying file object is not closed.
+        """
+        if not self.closed:
+            self.flush()
+            self.closed = True
+
+
+class Block(object):
+    """A single block of records in a container file.
+
+    Block objects give the position of the block in the file and the
+    details from its header, but don't read the block data until it is
+    requested by calling read_data() or records().
+    """
+
+    def __init__(self,reader,offset,count,length,checksum,data_offset):
+        self.reader = reader
+        self.offset = offset
+        self.count = count
+        self.length = length
+        self.checksum = checksum
+        self.data_offset = data_offset
+        self.corrupt = False
+
+    @property
+    def end_offset(self):
+        return self.data_offset + self.length
+
+    def read_data(self):
+        """Read, verify and decompress the data for this block."""
+        file = self.reader.file
+        file.seek(self.data_offset)
+        data = file.read(self.length)
+        if len(data) < self.length:
+            raise UnexpectedEOFError
+        if _checksum(data) != self.checksum:
+            raise ChecksumError("bad checksum in block at %d" % (self.offset,))
+        try:
+            return self.reader._decompress(data)
+        except Exception, e:
+            raise ParseError("could not decompress block: " + str(e))
+
+    def records(self):
+        """Return a list of the records contained in this block."""
+        s = serialize.StringStream(self.read_data(),self.reader.interner)
+        typdesc = self.reader.typcls._ep_typedesc
+        try:
+            return [s.read_value(typdesc) for _ in xrange(self.count)]
+        except EOFError:
+            raise UnexpectedEOFError
+
+
+
+class ContainerReader(object):
+    """Read extprot values of a given type from a container file.
+
+    Iterating over a ContainerReader produces the values in the file; use
+    the blocks() method to get at the individual blocks.
+
+    To process a section of a file, give 'start' and 'end' byte offsets.
+    The reader will produce every block whose sync marker starts in the
+    range [start,end), so you can give each worker an equal-sized chunk of
+    the file and each block will be processed exactly once.
+
+    If 'skip_corrupt' is true, corrupted blocks are skipped by scanning
+    ahead for the next sync marker and their offsets are recorded in the
+    'corrupt_offsets' attribute.  Otherwise they raise ParseError.
+
+    If an InternTable is given as 'interner', it will be used to
+    de-duplicate the values parsed from every block.
+
+    If 'strict' is true, a ParseError is raised if the file was written
+    using a different schema to the one given.  This is false by default
+    since extprot schemas can usually read data from older versions.
+    """
+
+    def __init__(self,file,typcls,start=None,end=None,skip_corrupt=False,
+                 interner=None,strict=False):
+        self.file = file
+        self.typcls = typcls
+        self.interner = interner
+        self.skip_corrupt = skip_corrupt
+        self.corrupt_offsets = []
+        self.file.seek(0)
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ParseError("not an extprot container file")
+        header = _Header.from_file(self.file)
+        self.fingerprint = header.fingerprint
+        self.codec = header.codec
+        self.sync = header.sync
+        self.metadata = header.metadata
+        if strict and self.fingerprint != schema_fingerprint(typcls):
+            raise ParseError("container file has a different schema")
+        try:
+            (_,self._decompress) = CODECS[self.codec]
+        except KeyError:
+            raise ParseError("unknown codec: " + repr(self.codec))
+        if start is None or start <= self.file.tell():
+            self._start = self.file.tell()
+        else:
+            self._start = self._find_sync(start)
+        self._end = end
+
+    def __iter__(self):
+        for block in self.blocks():
+            try:
+                records = block.records()
+            except ParseError:
+                if not self.skip_corrupt:
+                    raise
+                self.corrupt_offsets.append(block.offset)
+                block.corrupt = True
+                continue
+            for record in records:
+                yield record
+
+    def blocks(self):
+        """Iterate over the blocks in the file.
+
+        The data in each block is not read unless requested, so this can
+        be used to efficiently skip over large sections of the file.
+        """
+        offset = self._start
+        while offset is not None:
+            if self._end is not None and offset >= self._end:
+                break
+            try:
+                block = self._read_block(offset)
+            except EOFError:
+                break
+            except ParseError:
+                if not self.skip_corrupt:
+                    raise
+                self.corrupt_offsets.append(offset)
+                offset = self._find_sync(offset + 1)
+                continue
+            yield block
+            if block.corrupt:
+                #  The block length can't be trusted, so look for the
+                #  next sync marker instead.
+                offset = self._find_sync(block.offset + 1)
+            else:
+                offset = block.end_offset
+
+    def _read_block(self,offset):
+        """Read the block starting at the given offset."""
+        self.file.seek(offset)
+        sync = self.file.read(SYNC_SIZE)
+        if not sync:
+            raise EOFError
+        if sync != self.sync:
+            raise ParseError("missing sync marker at %d" % (offset,))
+        try:
+            header = _BlockHeader.from_file(self.file)
+        except (EOFError,ValueError):
+            raise ParseError("bad block header at %d" % (offset,))
+        if header.count < 0 or header.length < 0:
+            raise ParseError("bad block header at %d" % (offset,))
+        return Block(self,offset,header.count,header.length,header.checksum,
+                     self.file.tell())
+
+    def _find_sync(self,offset,chunk_size=64*1024):
+        """Find offset of first sync marker at or after the given offset.
+
+        If there are no more sync markers in the file, None is returned.
+        """
+        self.file.seek(offset)
+        data = ""
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                return None
+            data += chunk
+            idx = data.find(self.sync)
+            if idx >= 0:
+                return offset + idx
+            #  Keep enough data to match a marker split across chunks.
+            keep = min(SYNC_SIZE - 1,len(data))
+            offset += len(data) - keep
+            data = data[len(data)-keep:]
@@ -0,0 +1,227 @@
+"""
+
+  extprot.edit:  modify serialized extprot messages without decoding them
+
+This module provides functions for making small changes to serialized
+extprot messages by working directly on the encoded bytes.  Since extprot
+data is self-delimiting, the position of any field within a message can be
+found by skipping over the fields that come before it, without having to
+parse their contents.  For example, to change a single field of a large
+message you can do this:
+
+    data = extprot.patch(data,person,{"name":"Guido"})
+
+and get the same result as this:
+
+    p = person.from_string(data)
+    p.name = "Guido"
+    data = p.to_string()
+
+but only the new field value is encoded, and the rest of the message is
+copied through untouched.  The length prefixes of all enclosing messages
+are updated to account for the change in size.  Likewise, new items can be
+added to the end of a list field like so:
+
+    data = extprot.edit.extend_list(data,person,"emails",[email])
+
+which encodes only the new items and updates the list's item count.
+
+If the data doesn't have the expected structure (for example, because it
+was written by an older version of the protocol with fewer fields) these
+functions fall back to decoding and re-encoding the entire message.
+
+"""
+
+from extprot.errors import *
+from extprot import types
+from extprot.types import serialize
+
+
+TYPE_VINT = serialize.TYPE_VINT
+TYPE_BITS8 = serialize.TYPE_BITS8
+TYPE_BITS32 = serialize.TYPE_BITS32
+TYPE_BITS64_LONG = serialize.TYPE_BITS64_LONG
+TYPE_BITS64_FLOAT = serialize.TYPE_BITS64_FLOAT
+TYPE_ENUM = serialize.TYPE_ENUM
+TYPE_TUPLE = serialize.TYPE_TUPLE
+TYPE_HTUPLE = serialize.TYPE_HTUPLE
+
+
+class _StructureMismatch(Exception):
+    """Raised internally when the data can't be edited in-place."""
+    pass
+
+
+def patch(data,typcls,changes):
+    """Replace field values in the serialized message 'data'.
+
+    The argument 'changes' must map dotted field paths to new values, e.g.
+    {"address.city":"Melbourne"}.  Every name in the path except the last
+    must refer to a field of message type.  The new serialized message is
+    returned, and is the same as decoding 'data' as an instance of 'typcls',
+    assigning the new values and encoding it again.  The one exception is
+    that fields unknown to 'typcls' are preserved rather than discarded.
+    """
+    #  Sorting ensures that a change to a parent message is applied before
+    #  any changes to its children, as would happen with attribute access.
+    for (path,value) in sorted(changes.iteritems()):
+        names = path.split(".")
+        try:
+            (frames,start,end,ftype) = _find_field(data,typcls,names)
+        except _StructureMismatch:
+            msg = typcls.from_string(data)
+            (parent,field) = _resolve_path(msg,names)
+            _set_field(parent,field,value)
+            data = msg.to_string()
+        else:
+            encoded = serialize.to_string(ftype._ep_convert(value),ftype)
+            data = _rewrite(data,frames,[(start,end,encoded)])
+    return data
+
+
+def extend_list(data,typcls,path,values):
+    """Append items to a list field in the serialized message 'data'.
+
+    The argument 'path' gives the dotted path to a List or Array field, and
+    'values' is an iterable of items to append to it.  The new serialized
+    message is returned, and is the same as decoding 'data' as an instance
+    of 'typcls', extending the list and encoding it again.
+    """
+    names = path.split(".")
+    try:
+        (frames,start,end,ltype) = _find_field(data,typcls,names)
+        if not types._issubclass(ltype,(types.List,types.Array)):
+            raise ValueError("not a list type: %r" % (ltype,))
+        (prefix,offset) = serialize.decode_vint(data,start)
+        if prefix != (ltype._ep_tag << 4 | TYPE_HTUPLE):
+            raise _StructureMismatch
+        (length,body) = serialize.decode_vint(data,offset)
+        (nitems,items) = serialize.decode_vint(data,body)
+    except _StructureMismatch:
+        msg = typcls.from_string(data)
+        (parent,field) = _resolve_path(msg,names)
+        if not types._issubclass(field._ep_type,(types.List,types.Array)):
+            raise ValueError("not a list type: %r" % (field._ep_type,))
+        field.__get__(parent).extend(values)
+        return msg.to_string()
+    subtypes = ltype._types
+    ntypes = len(subtypes)
+    encoded = []
+    for v in values:
+        t = subtypes[(nitems + len(encoded)) % ntypes]
+        encoded.append(serialize.to_string(t._ep_convert(v),t))
+    if not encoded:
+        return data
+    frames.append((offset,body,length))
+    count = serialize.encode_vint(nitems + len(encoded))
+    edits = [(body,items,count),(end,end,"".join(encoded))]
+    return _rewrite(data,frames,edits)
+
+
+def _get_field(typcls,name):
+    """Get the Field object with the given name from a message class."""
+    if not types._issubclass(typcls,types.Message):
+        raise ValueError("not a message type: %r" % (typcls,))
+    for f in typcls._ep_fields:
+        if f._ep_name == name:
+            return f
+    raise ValueError("%s has no field %r" % (typcls.__name__,name))
+
+
+def _resolve_path(msg,names):
+    """Get the message and Field object at the given path within 'msg'."""
+    for name in names[:-1]:
+        msg = _get_field(msg.__class__,name).__get__(msg)
+    return (msg,_get_field(msg.__class__,names[-1]))
+
+
+def _set_field(msg,field,value):
+    """Set a field on a decoded message, ignoring its mutability."""
+    value = field._ep_type._ep_convert(value)
+    field._ep_slot.__set__(msg,value)
+    msg._ep_encoded = None
+    try:
+        msg._ep_cache[field._ep_index] = None
+    except AttributeError:
+        pass
+
+
+def _find_field(data,typcls,names):
+    """Find the byte range of a field within a serialized message.
+
+    This returns a tuple (frames,start,end,ftype) where 'start' and 'end'
+    delimit the field, 'ftype' is its type class and 'frames' is a list
+    of (len_start,body_start,length) tuples describing the length prefix
+    of each enclosing message, from the outermost inwards.
+    """
+    frames = []
+    offset = 0
+    for name in names:
+        field = _get_field(typcls,name)
+        (prefix,offset) = serialize.decode_vint(data,offset)
+        if prefix != (typcls._ep_tag << 4 | TYPE_TUPLE):
+            raise _StructureMismatch
+        (length,body) = serialize.decode_vint(data,offset)
+        frames.append((offset,body,length))
+        (nitems,offset) = serialize.decode_vint(data,body)
+        if field._ep_index >= nitems:
+            raise _StructureMismatch
+        for _ in xrange(field._ep_index):
+            offset = _skip(data,offset)
+        typcls = field._ep_type
+    return (frames,offset,_skip(data,offset),typcls)
+
+
+def _skip(data,offset):
+    """Skip over the value starting at the given offset.
+
+    This is the equivalent of Stream.skip_value() for an offset into a
+    string, returning the offset just past the end of the value.
+    """
+    (prefix,offset) = serialize.decode_vint(data,offset)
+    type = prefix & 0xf
+    if type & 0x01:
+        (length,offset) = serialize.decode_vint(data,offset)
+        offset += length
+    elif type == TYPE_VINT:
+        (_,offset) = serialize.decode_vint(data,offset)
+    elif type == TYPE_BITS8:
+        offset += 1
+    elif type == TYPE_BITS32:
+        offset += 4
+    elif type == TYPE_BITS64_LONG:
+        offset += 8
+    elif type == TYPE_BITS64_FLOAT:
+        offset += 8
+    elif type == TYPE_ENUM:
+        pass
+    else:
+        raise UnexpectedWireTypeError
+    if offset > len(data):
+        raise UnexpectedEOFError
+    return offset
+
+
+def _rewrite(data,frames,edits):
+    """Apply a list of edits to the body of the innermost frame.
+
+    Each edit is a tuple (start,end,replacement).  The length prefixes of
+    the enclosing frames are re-encoded to account for the change in size,
+    which may itself change the size of the prefixes.
+    """
+    delta = 0
+    for (start,end,new) in edits:
+        delta += len(new) - (end - start)
+    for (len_start,body_start,length) in reversed(frames):
+        new = serialize.encode_vint(length + delta)
+        edits.append((len_start,body_start,new))
+        delta += len(new) - (body_start - len_start)
+    edits.sort()
+    chunks = []
+    offset = 0
+    for (start,end,new) in edits:
+        chunks.append(data[offset:start])
+        chunks.append(new)
+        offset = end
+    chunks.append(data[offset:])
+    return "".join(chunks)
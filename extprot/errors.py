@@ -32,3 +32,7 @@ class UndefinedDefaultError(Error):
     """Error raised when a default is needed, but not provided."""
     pass
 
+
+class ChecksumError(ParseError):
+    """Error when a checksum does not match the data it covers."""
+    pass
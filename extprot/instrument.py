@@ -0,0 +1,186 @@
+"""
+
+  extprot.instrument:  counters and timing hooks for serialization
+
+This module provides an optional instrumentation layer for the extprot
+serialization engines, to find out which types are costing the most time
+and bytes.  It's switched off by default, and costs essentially nothing
+until it's switched on like so:
+
+    from extprot import instrument
+    stats = instrument.enable()
+    ...serialize lots of things...
+    print stats.snapshot()
+
+For each type class, the following events are counted:
+
+    from_string, from_file:  top-level calls to parse a value of the type
+    to_string, to_file:      top-level calls to serialize a value of the type
+    read, write:             message and union values parsed or serialized
+                             as part of some larger value
+
+and for each event it keeps the number of calls, the number of bytes read
+or written, the cumulative time taken and the number of calls that failed
+with an error.  Bytes are counted only for streams whose position can be
+determined.
+
+To collect more detailed data, such as latency histograms, add a hook
+function with the Instrumentation.add_hook() method.  It will be called as
+hook(typcls,event,nbytes,elapsed,failed) after each event.
+
+"""
+
+import threading
+
+from extprot import serialize
+try:
+    from extprot import _serialize
+except ImportError:
+    _serialize = None
+
+
+EVENTS = ("from_string","from_file","to_string","to_file","read","write")
+
+
+class Instrumentation(object):
+    """Collects serialization counters for each type class.
+
+    An instance of this class is passed to the serialization engines by the
+    enable() function, which calls its record() method for each event.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def record(self,typcls,event,nbytes,elapsed,failed):
+        """Record a single serialization event."""
+        with self._lock:
+            try:
+                counts = self.counters[(typcls,event)]
+            except KeyError:
+                counts = self.counters[(typcls,event)] = [0,0,0.0,0]
+            counts[0] += 1
+            counts[1] += nbytes
+            counts[2] += elapsed
+            if failed:
+                counts[3] += 1
+        for hook in self.hooks:
+            hook(typcls,event,nbytes,elapsed,failed)
+
+    def add_hook(self,hook):
+        """Add a function to be called after each event."""
+        self.hooks.append(hook)
+
+    def remove_hook(self,hook):
+        """Remove a function added with add_hook()."""
+        self.hooks.remove(hook)
+
+    def reset(self):
+        """Discard all the counters collected so far."""
+        with self._lock:
+            self.counters.clear()
+
+    def snapshot(self):
+        """Get the current counters as a dict.
+
+        The result maps the name of each type class to a dict of events,
+        each of which is a dict giving the "calls", "bytes", "time" and
+        "errors" for that event.  Type classes with the same name are
+        combined.
+        """
+        snapshot = {}
+        with self._lock:
+            items = self.counters.items()
+        for ((typcls,event),counts) in items:
+            events = snapshot.setdefault(type_name(typcls),{})
+            try:
+                stats = events[event]
+            except KeyError:
+                stats = events[event] = {"calls":0,"bytes":0,
+                                         "time":0.0,"errors":0}
+            stats["calls"] += counts[0]
+            stats["bytes"] += counts[1]
+            stats["time"] += counts[2]
+            stats["errors"] += counts[3]
+        return snapshot
+
+
+class LatencyHistogram(object):
+    """Hook that collects a histogram of latencies for each type and event.
+
+    Latencies are counted in buckets whose upper bounds are successive
+    powers of two microseconds.  Add an instance to an Instrumentation
+    object like so:
+
+        hist = LatencyHistogram()
+        instrument.enable().add_hook(hist)
+
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def __call__(self,typcls,event,nbytes,elapsed,failed):
+        bucket = 1 << int(elapsed * 1e6).bit_length()
+        with self._lock:
+            counts = self.buckets.setdefault((typcls,event),{})
+            counts[bucket] = counts.get(bucket,0) + 1
+
+    def snapshot(self):
+        """Get the histograms as a dict.
+
+        The result maps the name of each type class to a dict of events,
+        each of which maps the upper bound of each bucket in microseconds to
+        the number of events in that bucket.
+        """
+        snapshot = {}
+        with self._lock:
+            items = self.buckets.items()
+        for ((typcls,event),counts) in items:
+            hist = snapshot.setdefault(type_name(typcls),{})
+            hist = hist.setdefault(event,{})
+            for (bucket,count) in counts.iteritems():
+                hist[bucket] = hist.get(bucket,0) + count
+        return snapshot
+
+
+def type_name(typcls):
+    """Get the name used to report on the given type class."""
+    if typcls is None:
+        return "<unknown>"
+    return typcls.__module__ + "." + typcls.__name__
+
+
+_current = None
+
+def enable(instrumentation=None):
+    """Switch on instrumentation for both serialization engines.
+
+    If no Instrumentation object is given, a new one is created.  The
+    object in use is returned.
+    """
+    global _current
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    _current = instrumentation
+    serialize.set_instrumentation(instrumentation)
+    if _serialize is not None:
+        _serialize.set_instrumentation(instrumentation)
+    return instrumentation
+
+
+def disable():
+    """Switch off instrumentation for both serialization engines."""
+    global _current
+    _current = None
+    serialize.set_instrumentation(None)
+    if _serialize is not None:
+        _serialize.set_instrumentation(None)
+
+
+def current():
+    """Get the Instrumentation object currently in use, or None."""
+    return _current
@@ -0,0 +1,199 @@
+"""
+
+  extprot.resolution:  decode plans for reading other protocol versions
+
+Extprot data can be read by a different version of its protocol than the
+one that wrote it: fields missing from the end of a message get their
+default value, extra fields are skipped, and primitive values are promoted
+to the first item of a tuple or union.  Normally all this is worked out
+again for each value, by checking lengths and calling default_value() as
+the data is parsed.
+
+If you know which version of a protocol wrote some data, you can do that
+work once in advance.  Load both versions of the protocol and build a
+DecodePlan from the type you want to read and the type that was written:
+
+    plan = resolve(person_v2,person_v1)
+    p = plan.from_string(data)
+
+The plan contains a copy of the reader's typedescs where each message or
+tuple has its defaults precomputed, computing those that can be safely
+shared just once, and where unions know in advance which option to promote
+primitive values to.  Types are matched up by position, and union options by tag,
+just as they are on the wire.  The values produced are instances of the
+reader's type classes.
+
+"""
+
+import weakref
+
+from extprot.errors import *
+from extprot.types import serialize, Type, Message, Union
+from extprot.types import _issubclass, _default_values
+
+
+class DecodePlan(object):
+    """Precomputed plan for reading values written as a different type.
+
+    This object can be passed in place of a type class to the low-level
+    functions in extprot.serialize, as it provides the "_ep_typedesc"
+    attribute used to direct parsing.
+
+    The plan only holds a weak reference to the writer's type, which isn't
+    needed once the plan has been built, so that cached plans don't keep
+    old protocol versions alive.
+    """
+
+    def __init__(self,reader,writer):
+        self.reader = reader
+        self._writer = weakref.ref(writer)
+        self._ep_typedesc = _resolve(reader,writer,{})
+
+    @property
+    def writer(self):
+        """The writer's type, or None if it no longer exists."""
+        return self._writer()
+
+    def from_string(self,string,interner=None,blob_threshold=None):
+        """Read a value written as the writer's type from a string."""
+        return serialize.from_string(string,self,interner,blob_threshold)
+
+    def from_file(self,file,interner=None,blob_threshold=None):
+        """Read a value written as the writer's type from a file."""
+        return serialize.from_file(file,self,interner,blob_threshold)
+
+
+def resolve(reader,writer):
+    """Get a DecodePlan for reading 'writer' values as type 'reader'.
+
+    Plans are cached, so this can be called freely for each value.  The
+    cache is kept on the reader's type and is keyed weakly on the writer's
+    type, so plans go away along with the types they were built from.
+    """
+    try:
+        plans = reader.__dict__["_ep_plans"]
+    except KeyError:
+        plans = weakref.WeakKeyDictionary()
+        reader._ep_plans = plans
+    try:
+        return plans[writer]
+    except KeyError:
+        plan = plans[writer] = DecodePlan(reader,writer)
+        return plan
+
+
+def _resolve(reader,writer,memo):
+    """Get the typedesc for reading 'writer' values as type 'reader'.
+
+    Typedescs are shared between types, so 'memo' maps (reader,writer)
+    pairs to the typedescs already created for them.  This also takes
+    care of recursive types.
+    """
+    typdesc = reader._ep_typedesc
+    if reader is writer or not _issubclass(writer,Type):
+        return typdesc
+    if not reader._types:
+        return typdesc
+    try:
+        return memo[(reader,writer)]
+    except KeyError:
+        pass
+    if _issubclass(reader,Union):
+        return _resolve_union(reader,writer,memo)
+    new = _copy_typedesc(typdesc,typdesc.__class__)
+    memo[(reader,writer)] = new
+    #  Missing items are filled in from these when parsing, whether they
+    #  were missing from the writer's tuple or it was a promoted primitive.
+    if _issubclass(reader,Message):
+        new.defaults = reader._ep_make_defaults()
+    elif reader._ep_primtype == serialize.TYPE_TUPLE:
+        new.defaults = tuple(_default_values(reader._types))
+    subtypes = []
+    for (i,t) in enumerate(reader._types):
+        if i < len(writer._types):
+            subtypes.append(_resolve(t,writer._types[i],memo))
+        else:
+            subtypes.append(t._ep_typedesc)
+    new.subtypes = {(new.type,new.tag):tuple(subtypes)}
+    return new
+
+
+def _resolve_union(reader,writer,memo):
+    """Get the typedesc for reading 'writer' values as Union 'reader'."""
+    typdesc = reader._ep_typedesc
+    #  If the writer's type isn't a union, each value must be promoted to
+    #  the first non-constant option, so we prepare to do that directly.
+    promote = None
+    if not _issubclass(writer,Union):
+        for opt in reader._types:
+            if opt._types:
+                try:
+                    promote = (opt,_default_values(opt._types[1:],True))
+                except UndefinedDefaultError:
+                    pass
+                break
+    if promote is None:
+        new = _copy_typedesc(typdesc,typdesc.__class__)
+    else:
+        new = _copy_typedesc(typdesc,_union_promoter(typdesc))
+    memo[(reader,writer)] = new
+    woptions = {}
+    if _issubclass(writer,Union):
+        for opt in writer._types:
+            woptions[(opt._ep_primtype,opt._ep_tag)] = opt
+    options = []
+    subtypes = {}
+    for opt in reader._types:
+        key = (opt._ep_primtype,opt._ep_tag)
+        try:
+            t = _resolve(opt,woptions[key],memo)
+        except KeyError:
+            t = opt._ep_typedesc
+        options.append(t)
+        if key in typdesc.subtypes:
+            #  Constant options declared without '_types' have no subtypes
+            #  entry of their own, only the one in the union's typedesc.
+            try:
+                subtypes[key] = t.subtypes[key]
+            except KeyError:
+                subtypes[key] = typdesc.subtypes[key]
+    if promote is not None:
+        (opt,defaults) = promote
+        t = options[list(reader._types).index(opt)]
+        new.promote = (t,t.subtypes[(t.type,t.tag)][0],defaults)
+    new.subtypes = subtypes
+    new.set_options(options)
+    return new
+
+
+def _copy_typedesc(typdesc,typdesc_class):
+    """Create a copy of the given typedesc as an instance of a new class."""
+    new = typdesc_class()
+    new.type = typdesc.type
+    new.tag = typdesc.tag
+    new.collection_constructor = dict(typdesc.collection_constructor)
+    new.subtypes = dict(typdesc.subtypes)
+    return new
+
+
+def _union_promoter(typdesc):
+    """Create a typedesc class for unions whose values are all promoted.
+
+    Instances must have their 'promote' attribute set to a tuple giving the
+    typedesc of the option to promote to, the typedesc for its first item,
+    and the precomputed defaults for its other items.
+    """
+    base = typdesc.__class__
+    class resolved_typedesc(base):
+        def parse_value(self,value,type,tag):
+            if type == serialize.TYPE_TUPLE or type == serialize.TYPE_ENUM:
+                return base.parse_value(self,value,type,tag)
+            (t,first,defaults) = self.promote
+            values = [first.parse_value(value,type,tag)]
+            for (value,default) in defaults:
+                if default is None:
+                    values.append(value)
+                else:
+                    values.append(default.default_value())
+            return t.parse_value(values,t.type,t.tag)
+    return resolved_typedesc
@@ -7,16 +7,20 @@ bytestreams.  It's the pure-python "baseline" version; you should also have
 a Cython-generated version of this module named "_serialize" which is much
 faster.
 
+In-memory strings are parsed in place by offset rather than through a
+filelike object, and rendered into a bytearray, since that's where almost
+all the time is spent when the Cython version isn't available.
+
 """
 
 
 import struct
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import hashlib
+from operator import itemgetter
+from timeit import default_timer
 
 from extprot.errors import *
+from extprot.utils import TypedList, TypedDict, Blob, _view, _blob_data
 
 TYPE_VINT = 0
 TYPE_BITS8 = 2
@@ -29,33 +33,114 @@ TYPE_BYTES = 3
 TYPE_HTUPLE = 5
 TYPE_ASSOC = 7
 
+#  This is a pseudo-type that can be returned by TypeDesc.render_value to
+#  write a string of already-serialized data directly into the stream.
+TYPE_PRERENDERED = 16
+
 
 _S_BITS32 = struct.Struct("<L")
 _S_BITS64_LONG = struct.Struct("<Q")
 _S_BITS64_FLOAT = struct.Struct("<d")
 
 
-def from_string(string,typcls):
-    """Parse an instance of the given typeclass from the given string."""
-    s = StringStream(string)
+def from_string(string,typcls,interner=None,blob_threshold=None):
+    """Parse an instance of the given typeclass from the given string.
+
+    If an InternTable is given as 'interner', parsed values will be
+    de-duplicated using that table.  If 'blob_threshold' is given, String
+    values at least that long are returned as zero-copy views into the
+    string, which may also be an mmap or other buffer object.
+    """
+    s = StringStream(string,interner,blob_threshold=blob_threshold)
+    if _instrument is not None:
+        return _instrumented("from_string",StringStream._read_using,s,
+                             _parse,typcls._ep_typedesc)
     return s.read_value(typcls._ep_typedesc)
 
-def from_file(file,typcls):
-    """Parse an instance of the given typeclass from the given file."""
-    s = Stream(file)
+def from_file(file,typcls,interner=None,blob_threshold=None):
+    """Parse an instance of the given typeclass from the given file.
+
+    If an InternTable is given as 'interner', parsed values will be
+    de-duplicated using that table.  If 'blob_threshold' is given, String
+    values at least that long are returned as lazy Blob handles giving
+    their position in the file.
+    """
+    s = Stream(file,interner,blob_threshold=blob_threshold)
+    if _instrument is not None:
+        return _instrumented("from_file",_read_value,s,typcls._ep_typedesc)
     return s.read_value(typcls._ep_typedesc)
 
-def to_string(value,typcls):
-    """Render an instance of the given typeclass into a string."""
-    s = StringStream()
+def to_string(value,typcls,canonical=False):
+    """Render an instance of the given typeclass into a string.
+
+    If 'canonical' is true, the entries of each Assoc are written in order
+    of their serialized keys, so that equal values always produce the same
+    string.
+    """
+    s = StringStream(canonical=canonical)
+    if _instrument is not None:
+        _instrumented("to_string",StringStream._write_using,s,
+                      _render,value,typcls._ep_typedesc)
+    else:
+        s.write_value(value,typcls._ep_typedesc)
+    return s.getstring()
+
+def _to_string(value,typcls,canonical=False):
+    """Render a value into a string as part of rendering a larger value.
+
+    This is like to_string(), but doesn't record a top-level event with the
+    active instrumentation.  It's used to render the fields of incremental
+    messages and the pieces of a list written by extprot.streaming, whose
+    output is covered by the event for the value as a whole, if any.
+    """
+    s = StringStream(canonical=canonical)
     s.write_value(value,typcls._ep_typedesc)
     return s.getstring()
 
-def to_file(file,value,typcls):
+def to_file(file,value,typcls,canonical=False):
     """Render an instance of the given typeclass into a file."""
-    s = Stream(file)
+    s = Stream(file,canonical=canonical)
+    if _instrument is not None:
+        _instrumented("to_file",_write_value,s,value,typcls._ep_typedesc)
+    else:
+        s.write_value(value,typcls._ep_typedesc)
+
+def fingerprint(value,typcls,algorithm="sha1"):
+    """Calculate a digest of the canonical form of the given value.
+
+    Equal values always have the same fingerprint, regardless of the order
+    of any Assoc entries.  The value is fed into the hash incrementally, so
+    its serialized form is never built in memory.  To make this possible,
+    the length prefixes of Tuples, Lists and Assocs are omitted from the
+    hashed data.
+    """
+    s = HashStream(hashlib.new(algorithm))
     s.write_value(value,typcls._ep_typedesc)
+    return s.digest()
 
+def encode_vint(x):
+    """Encode an integer in vint format, returning a string."""
+    out = bytearray()
+    _write_vint(out,x)
+    return str(out)
+
+def decode_vint(string,offset=0):
+    """Decode a vint from the given string, starting at the given offset.
+
+    The return value is a tuple giving the decoded integer and the offset
+    just past its end.
+    """
+    try:
+        b = ord(string[offset])
+        x = e = 0
+        while b >= 128:
+            x += (b - 128) << e
+            e += 7
+            offset += 1
+            b = ord(string[offset])
+    except IndexError:
+        raise UnexpectedEOFError
+    return (x + (b << e),offset + 1)
 
 
 class TypeDesc(object):
@@ -96,6 +181,9 @@ class TypeDesc(object):
         This method will be called when a value is about to be written out.
         It must convert the value to something renderable, and return a
         3-tuple giving the value, type and tag.
+
+        If the type is given as TYPE_PRERENDERED, the value must be a string
+        of already-serialized data that will be written out unchanged.
         """
         raise NotImplementedError
 
@@ -121,6 +209,10 @@ class SingleTypeDesc(TypeDesc):
     collection_constructor = {}
     subtypes = {}
 
+    #  Optional tuple of precomputed defaults for the subtypes of composed
+    #  types, as used by _fill_defaults().
+    defaults = None
+
     def parse_value(self,value,type,tag):
         if type != self.type:
             raise UnexpectedWireTypeError
@@ -130,6 +222,26 @@ class SingleTypeDesc(TypeDesc):
         return (value,self.type,self.tag)
 
 
+def _fill_defaults(typdesc,values,subtypes):
+    """Append default values for the items missing from a parsed value.
+
+    The typedesc may have a tuple of precomputed 'defaults', one for each
+    subtype, giving either a (value,None) pair for a default that can be
+    shared or a (None,typdesc) pair for one that must be created each time.
+    Otherwise default_value() is called on each missing subtype.
+    """
+    defaults = typdesc.defaults
+    if defaults is None:
+        for t in subtypes[len(values):]:
+            values.append(t.default_value())
+    else:
+        for (value,t) in defaults[len(values):]:
+            if t is None:
+                values.append(value)
+            else:
+                values.append(t.default_value())
+
+
 class BoolTypeDesc(SingleTypeDesc):
     """TypeDesc class for boolean-like types."""
 
@@ -174,8 +286,7 @@ class TupleTypeDesc(SingleTypeDesc):
         subtypes = self.subtypes[(self.type,self.tag)]
         if type == self.type:
             if len(value) < len(subtypes):
-                for t in subtypes[len(value):]:
-                    value.append(t.default_value())
+                _fill_defaults(self,value,subtypes)
             return tuple(value)
         #  Try to promote it from a primitive type to the first tuple item.
         if not subtypes:
@@ -183,8 +294,7 @@ class TupleTypeDesc(SingleTypeDesc):
             raise ParseError(err)
         else:
             values = [subtypes[0].parse_value(value,type,tag)]
-            for t in subtypes[1:]:
-                values.append(t.default_value())
+            _fill_defaults(self,values,subtypes)
             return tuple(values)
 
     def default_value(self):
@@ -199,24 +309,106 @@ class MessageTypeDesc(TupleTypeDesc):
     """TypeDesc class for message types."""
 
     def parse_value(self,value,type,tag):
-        value = TupleTypeDesc.parse_value(self,value,type,tag)
-        #  Bypass typechecking by initialising the values before calling
-        #  __init__.  We already know the types are valid.
-        inst = self.type_class.__new__(self.type_class)
-        for i in xrange(min(len(inst._ep_fields),len(value))):
-            inst.__dict__[inst._ep_fields[i]._ep_name] = value[i]
-        inst._ep_initialized = True
-        inst.__init__(*value)
+        if type != self.type:
+            value = list(TupleTypeDesc.parse_value(self,value,type,tag))
+        else:
+            subtypes = self.subtypes[(self.type,self.tag)]
+            if len(value) < len(subtypes):
+                if self.defaults is None:
+                    self.defaults = self.type_class._ep_make_defaults()
+                _fill_defaults(self,value,subtypes)
+        #  Bypass typechecking and __init__ by filling in the values
+        #  directly.  We already know the types are valid.
+        cls = self.type_class
+        inst = cls.__new__(cls)
+        cls._ep_setvalues(inst,value)
+        if cls._ep_post_parse is not None:
+            inst._ep_post_parse()
         return inst
 
     def render_value(self,value):
-        value = [value.__dict__[f._ep_name] for f in self.type_class._ep_fields]
+        encoded = value._ep_encoded
+        if encoded is not None:
+            return (encoded,TYPE_PRERENDERED,0)
+        if value._ep_incremental:
+            encoded = value._ep_render_incremental()
+            return (encoded,TYPE_PRERENDERED,0)
+        try:
+            value = self.type_class._ep_getvalues(value)
+        except AttributeError:
+            #  Some fields are unset, have them filled in with defaults.
+            value = [f.__get__(value) for f in self.type_class._ep_fields]
         return TupleTypeDesc.render_value(self,value)
 
     def default_value(self):
         return self.type_class()
 
 
+class OptionTypeDesc(SingleTypeDesc):
+    """TypeDesc class for the options of a Union type."""
+
+    def parse_value(self,value,type,tag):
+        if type != self.type:
+            raise UnexpectedWireTypeError(type,self.type)
+        cls = self.type_class
+        if type == TYPE_ENUM:
+            return cls
+        subtypes = self.subtypes[(self.type,self.tag)]
+        if len(value) < len(subtypes):
+            _fill_defaults(self,value,subtypes)
+        #  Bypass typechecking and __init__ by filling in the values
+        #  directly.  We already know the types are valid.
+        inst = object.__new__(cls)
+        inst._ep_values = tuple(value)
+        return inst
+
+    def render_value(self,value):
+        if self.type == TYPE_ENUM:
+            return (value,self.type,self.tag)
+        return (value._ep_values,self.type,self.tag)
+
+
+class UnionTypeDesc(TypeDesc):
+    """TypeDesc class for Union types.
+
+    The typedescs for the options of the union are kept in a list for each
+    wire type, indexed by tag.  Values that don't match any option are
+    passed to the _ep_promote() method of the type class.
+    """
+
+    def __init__(self):
+        super(UnionTypeDesc,self).__init__()
+        self.enum_options = []
+        self.tuple_options = []
+
+    def set_options(self,options):
+        """Set the list of typedescs for the options of this union."""
+        self.enum_options = []
+        self.tuple_options = []
+        for t in options:
+            if t.type == TYPE_ENUM:
+                opts = self.enum_options
+            else:
+                opts = self.tuple_options
+            while len(opts) <= t.tag:
+                opts.append(None)
+            opts[t.tag] = t
+
+    def parse_value(self,value,type,tag):
+        if type == TYPE_TUPLE:
+            options = self.tuple_options
+        elif type == TYPE_ENUM:
+            options = self.enum_options
+        else:
+            options = ()
+        if tag < len(options) and options[tag] is not None:
+            return options[tag].parse_value(value,type,tag)
+        return self.type_class._ep_promote(value,type,tag)
+
+    def render_value(self,value):
+        return value._ep_typedesc.render_value(value)
+
+
 
 class Stream(object):
     """Base class for processing an extprot bytestream.
@@ -224,10 +416,20 @@ class Stream(object):
     Instances of this class are used to read or write objects to a generic
     filelike object.  A specialized subclass StringString is used when
     writing to an in-memory string.
+
+    If the optional argument 'interner' is given, it must be an InternTable
+    instance that will be used to de-duplicate the values read from the
+    stream.  If the optional argument 'canonical' is true, values will be
+    written in canonical form.  If the optional argument 'blob_threshold' is
+    given, String values at least that long will be returned as Blob handles
+    into the file, or as views into the string being parsed.
     """
 
-    def __init__(self,file):
+    def __init__(self,file,interner=None,canonical=False,blob_threshold=None):
         self.file = file
+        self.interner = interner
+        self.canonical = canonical
+        self.blob_threshold = blob_threshold
 
     def read_value(self,typdesc):
         """Read a generic value from the stream.
@@ -248,12 +450,19 @@ class Stream(object):
         if type & 0x01:
             length = self._read_int()
             if type == TYPE_BYTES:
-                value = self._read(length)
+                threshold = self.blob_threshold
+                if threshold is not None and length >= threshold:
+                    value = self._read_blob(length)
+                else:
+                    value = self._read(length)
+                    if self.interner is not None:
+                        if length <= self.interner.maxlength:
+                            value = self.interner.intern(value)
             else:
                 #  For small items it's quicker to read all the data into a
                 #  string and parse it in memory than to do many small reads.
                 if length < 4096 and not isinstance(self,StringStream):
-                    s = StringStream(self._read(length))
+                    s = StringStream(self._read(length),self.interner)
                 else:
                     s = self
                 try:
@@ -288,6 +497,9 @@ class Stream(object):
             else:
                 raise UnexpectedWireTypeError
         value = typdesc.parse_value(value,type,tag)
+        if type == TYPE_TUPLE and self.interner is not None:
+            if self.interner.tuples and value.__class__ is tuple:
+                value = self.interner.intern_tuple(typdesc,value)
         return value
 
     def write_value(self,value,typdesc):
@@ -297,6 +509,9 @@ class Stream(object):
         and writes that value onto the stream.
         """
         (value,type,tag) = typdesc.render_value(value)
+        if type == TYPE_PRERENDERED:
+            self._write_prerendered(value)
+            return
         self._write_int(tag << 4 | type)
         if type == TYPE_VINT:
             self._write_int(value)
@@ -306,6 +521,8 @@ class Stream(object):
         elif type == TYPE_BITS8:
             self._write(value)
         elif type == TYPE_BYTES:
+            if value.__class__ is not str:
+                value = _blob_data(value)
             self._write_int(len(value))
             self._write(value)
         elif type == TYPE_BITS32:
@@ -375,9 +592,30 @@ class Stream(object):
         if len(data) < size:
             raise UnexpectedEOFError
 
+    def _read_blob(self,size):
+        """Read a large string as a Blob recording its position in the file.
+
+        If the file can't report its position, the data is read as usual.
+        """
+        offset = self._tell()
+        if offset is None:
+            return self._read(size)
+        self.file.seek(offset + size)
+        return Blob(self.file,offset,size)
+
     def _write(self,data):
         self.file.write(data)
 
+    def _write_prerendered(self,data):
+        self._write(data)
+
+    def _tell(self):
+        """Get the current position in the stream, or None if unknown."""
+        try:
+            return self.file.tell()
+        except (AttributeError,IOError):
+            return None
+
     def _read_int(self):
         """Read an integer encoded in vint format.""" 
         b = ord(self._read(1))
@@ -415,7 +653,7 @@ class Stream(object):
 
     def _write_Tuple(self,value,subtypes):
         """Write a Tuple type to the stream."""
-        s = StringStream()
+        s = StringStream(canonical=self.canonical)
         nitems = len(value)
         s._write_int(nitems)
         ntypes = len(subtypes)
@@ -429,13 +667,20 @@ class Stream(object):
         """Read a HTuple type from the stream."""
         nitems = self._read_int()
         ntypes = len(subtypes)
-        for i in xrange(nitems):
-            items.append(self.read_value(subtypes[i % ntypes]))
+        if items.__class__ is TypedList:
+            #  The parsed values are already of the correct type, so we
+            #  can bypass the conversion done by TypedList.append.
+            values = [self.read_value(subtypes[i % ntypes])
+                      for i in xrange(nitems)]
+            list.extend(items,values)
+        else:
+            for i in xrange(nitems):
+                items.append(self.read_value(subtypes[i % ntypes]))
         return items
 
     def _write_HTuple(self,value,subtypes):
         """Write a HTuple type to the stream."""
-        s = StringStream()
+        s = StringStream(canonical=self.canonical)
         nitems = len(value)
         s._write_int(nitems)
         ntypes = len(subtypes)
@@ -449,40 +694,618 @@ class Stream(object):
         """Read an Assoc type from the stream."""
         nitems = self._read_int()
         ntypes = len(subtypes)
-        for i in xrange(nitems):
-            key = self.read_value(subtypes[(2*i) % ntypes])
-            val = self.read_value(subtypes[(2*i + 1) % ntypes])
-            items[key] = val
+        if items.__class__ is TypedDict:
+            #  The parsed values are already of the correct type, so we
+            #  can bypass the conversion done by TypedDict.__setitem__.
+            setitem = dict.__setitem__
+        else:
+            setitem = items.__class__.__setitem__
+        #  Keys must be hashable, so they are never returned as views.
+        threshold = self.blob_threshold
+        try:
+            for i in xrange(nitems):
+                self.blob_threshold = None
+                key = self.read_value(subtypes[(2*i) % ntypes])
+                self.blob_threshold = threshold
+                val = self.read_value(subtypes[(2*i + 1) % ntypes])
+                setitem(items,key,val)
+        finally:
+            self.blob_threshold = threshold
         return items
 
     def _write_Assoc(self,value,subtypes):
         """Write an Assoc type to the stream."""
-        s = StringStream()
+        s = StringStream(canonical=self.canonical)
         nitems = len(value)
         s._write_int(nitems)
         ntypes = len(subtypes)
-        for i,(key,val) in enumerate(value.iteritems()):
-            s.write_value(key,subtypes[(2*i) % ntypes])
-            s.write_value(val,subtypes[(2*i + 1) % ntypes])
+        if self.canonical:
+            items = self._sorted_items(value,subtypes)
+            for (i,(_,key,val)) in enumerate(items):
+                s.write_value(key,subtypes[(2*i) % ntypes])
+                s.write_value(val,subtypes[(2*i + 1) % ntypes])
+        else:
+            for i,(key,val) in enumerate(value.iteritems()):
+                s.write_value(key,subtypes[(2*i) % ntypes])
+                s.write_value(val,subtypes[(2*i + 1) % ntypes])
         data = s.getstring()
         self._write_int(len(data))
         self._write(data)
 
+    def _sorted_items(self,value,subtypes):
+        """Get the items of an Assoc in canonical order.
+
+        This returns a list of (data,key,value) tuples sorted by 'data',
+        the canonical serialized form of the key.
+        """
+        items = []
+        for (key,val) in value.iteritems():
+            s = StringStream(canonical=True)
+            s.write_value(key,subtypes[0])
+            items.append((s.getstring(),key,val))
+        items.sort(key=itemgetter(0))
+        return items
+
 
 
 class StringStream(Stream):
-    """Special-purpose implementation of Stream for parsing strings.
+    """Special-purpose implementation of Stream for in-memory strings.
 
-    This implementation uses cStringIO to manage the data in memory.
+    Rather than going through a filelike object, this implementation parses
+    the string in place by keeping an integer offset into it, and renders
+    into a bytearray.  Values are handled by the functions _parse_value()
+    and _render_value(), which walk nested Tuples, HTuples and Assocs in the
+    same buffer instead of creating a new stream for each.
     """
 
-    def __init__(self,value=None):
-       if value is None:
-           file = StringIO()
-       else:
-           file = StringIO(value)
-       super(StringStream,self).__init__(file)
+    def __init__(self,value=None,interner=None,canonical=False,
+                 blob_threshold=None):
+        self.file = None
+        self.interner = interner
+        self.canonical = canonical
+        self.blob_threshold = blob_threshold
+        self.pos = 0
+        if isinstance(value,basestring):
+            value = str(value)
+        #  The original value, which may be any buffer, for taking views.
+        self.source = value
+        if value is None:
+            self.data = ""
+            self.bytes = bytearray()
+            self.buffer = bytearray()
+        else:
+            #  Indexing a bytearray gives integers directly, which is
+            #  much quicker than calling ord() on each byte of the string.
+            #  So we need one copy of the data unless it's a bytearray, but
+            #  other sources are sliced through a buffer rather than being
+            #  copied a second time into a string.
+            if value.__class__ is bytearray:
+                self.bytes = value
+            else:
+                self.bytes = bytearray(value)
+            if value.__class__ is str:
+                self.data = value
+            else:
+                self.data = buffer(self.bytes)
+            self.buffer = None
+
+    def read_value(self,typdesc):
+        return self._read_using(_parse_value,typdesc)
+
+    def write_value(self,value,typdesc):
+        _render_value(self,self.buffer,value,typdesc)
+
+    def skip_value(self):
+        pos = self.pos
+        if pos >= len(self.data):
+            raise EOFError
+        try:
+            pos = _skip_value(self.bytes,pos)
+        except IndexError:
+            raise UnexpectedEOFError
+        if pos > len(self.data):
+            raise UnexpectedEOFError
+        self.pos = pos
 
     def getstring(self):
-        return self.file.getvalue()
+        return str(self.buffer)
+
+    def _read_using(self,parse,typdesc):
+        """Read a value using the given parsing function."""
+        pos = self.pos
+        if pos >= len(self.data):
+            raise EOFError
+        try:
+            (value,self.pos) = parse(self,self.data,self.bytes,pos,typdesc)
+        except IndexError:
+            raise UnexpectedEOFError
+        return value
+
+    def _write_using(self,render,value,typdesc):
+        """Write a value using the given rendering function."""
+        render(self,self.buffer,value,typdesc)
+
+    def _read(self,size):
+        pos = self.pos
+        end = pos + size
+        if end > len(self.data):
+            raise UnexpectedEOFError
+        self.pos = end
+        return self.data[pos:end]
+
+    def _skip(self,size):
+        end = self.pos + size
+        if end > len(self.data):
+            raise UnexpectedEOFError
+        self.pos = end
+
+    def _write(self,data):
+        self.buffer += data
+
+    def _tell(self):
+        if self.buffer is None:
+            return self.pos
+        return len(self.buffer)
+
+    def _read_int(self):
+        try:
+            (x,self.pos) = _read_vint(self.bytes,self.pos)
+        except IndexError:
+            raise UnexpectedEOFError
+        return x
+
+    def _write_int(self,x):
+        _write_vint(self.buffer,x)
+
+
+
+class HashStream(Stream):
+    """Special-purpose implementation of Stream for hashing values.
 
+    Values written to this stream are fed into the given hash object in
+    canonical form, but without the length prefix of each Tuple, HTuple or
+    Assoc.  Since the items in these types are self-delimiting, the output
+    is still unambiguous, and it can be generated without buffering.
+    """
+
+    def __init__(self,hash):
+        super(HashStream,self).__init__(None,canonical=True)
+        self.hash = hash
+
+    def _write(self,data):
+        self.hash.update(data)
+
+    def digest(self):
+        """Get the digest of all data written to the stream."""
+        return self.hash.digest()
+
+    def _write_prerendered(self,data):
+        self._write_unframed(StringStream(data))
+
+    def _write_unframed(self,s):
+        """Copy a value from the given stream, removing length prefixes."""
+        prefix = s._read_int()
+        self._write_int(prefix)
+        type = prefix & 0xf
+        if type == TYPE_BYTES:
+            length = s._read_int()
+            self._write_int(length)
+            self._write(s._read(length))
+        elif type & 0x01:
+            s._read_int()
+            nitems = s._read_int()
+            self._write_int(nitems)
+            if type == TYPE_ASSOC:
+                nitems = nitems * 2
+            for _ in xrange(nitems):
+                self._write_unframed(s)
+        elif type == TYPE_VINT:
+            self._write_int(s._read_int())
+        elif type == TYPE_BITS8:
+            self._write(s._read(1))
+        elif type == TYPE_BITS32:
+            self._write(s._read(4))
+        elif type == TYPE_BITS64_LONG:
+            self._write(s._read(8))
+        elif type == TYPE_BITS64_FLOAT:
+            self._write(s._read(8))
+        elif type == TYPE_ENUM:
+            pass
+        else:
+            raise UnexpectedWireTypeError
+
+    def _write_Tuple(self,value,subtypes):
+        nitems = len(value)
+        self._write_int(nitems)
+        for i in xrange(nitems):
+            self.write_value(value[i],subtypes[i])
+
+    def _write_HTuple(self,value,subtypes):
+        nitems = len(value)
+        self._write_int(nitems)
+        ntypes = len(subtypes)
+        for i in xrange(nitems):
+            self.write_value(value[i],subtypes[i % ntypes])
+
+    def _write_Assoc(self,value,subtypes):
+        self._write_int(len(value))
+        ntypes = len(subtypes)
+        items = self._sorted_items(value,subtypes)
+        for (i,(_,key,val)) in enumerate(items):
+            self.write_value(key,subtypes[(2*i) % ntypes])
+            self.write_value(val,subtypes[(2*i + 1) % ntypes])
+
+
+
+#  The functions below do the real work of StringStream.  They pass the
+#  buffer and offset around explicitly and keep everything they need in
+#  local variables, which is a lot quicker than going through the methods
+#  of a stream object for every value.  Vints that fit in a single byte,
+#  which is most of them, are decoded inline.
+
+_unpack_bits32 = _S_BITS32.unpack_from
+_unpack_bits64_long = _S_BITS64_LONG.unpack_from
+_unpack_bits64_float = _S_BITS64_FLOAT.unpack_from
+_pack_bits32 = _S_BITS32.pack
+_pack_bits64_long = _S_BITS64_LONG.pack
+_pack_bits64_float = _S_BITS64_FLOAT.pack
+
+def _read_vint(bytes,pos):
+    """Read a vint from a bytearray, returning it and the following offset.
+
+    Reading past the end of the data raises IndexError.
+    """
+    b = bytes[pos]
+    x = e = 0
+    while b >= 128:
+        x += (b - 128) << e
+        e += 7
+        pos += 1
+        b = bytes[pos]
+    return (x + (b << e),pos + 1)
+
+def _write_vint(out,x):
+    """Append an integer encoded in vint format to a bytearray."""
+    while x >= 128:
+        out.append((x & 127) | 128)
+        x = x >> 7
+    out.append(x)
+
+def _skip_value(bytes,pos):
+    """Skip the value at the given offset, returning the following offset."""
+    (prefix,pos) = _read_vint(bytes,pos)
+    type = prefix & 0xf
+    if type & 0x01:
+        (length,pos) = _read_vint(bytes,pos)
+        return pos + length
+    elif type == TYPE_VINT:
+        return _read_vint(bytes,pos)[1]
+    elif type == TYPE_BITS8:
+        return pos + 1
+    elif type == TYPE_BITS32:
+        return pos + 4
+    elif type == TYPE_BITS64_LONG:
+        return pos + 8
+    elif type == TYPE_BITS64_FLOAT:
+        return pos + 8
+    elif type == TYPE_ENUM:
+        return pos
+    else:
+        raise UnexpectedWireTypeError
+
+def _parse(stream,data,bytes,pos,typdesc):
+    """Parse a value at the given offset of an in-memory string.
+
+    Here 'data' is the string and 'bytes' is a bytearray copy of it.  The
+    return value is a tuple giving the parsed value and the offset just past
+    its end.  Running off the end of the data raises IndexError, which is
+    translated into UnexpectedEOFError by the calling StringStream.
+    """
+    prefix = bytes[pos]
+    if prefix < 128:
+        pos += 1
+    else:
+        (prefix,pos) = _read_vint(bytes,pos)
+    type = prefix & 0xf
+    tag = prefix >> 4
+    #  If the LSB of the wiretype is 1, it is length-delimited.
+    #  If not, it is a primitive type with known size.
+    if type & 0x01:
+        length = bytes[pos]
+        if length < 128:
+            pos += 1
+        else:
+            (length,pos) = _read_vint(bytes,pos)
+        end = pos + length
+        if end > len(data):
+            raise UnexpectedEOFError
+        if type == TYPE_BYTES:
+            threshold = stream.blob_threshold
+            if threshold is not None and length >= threshold:
+                value = _view(stream.source,pos,length)
+            else:
+                value = data[pos:end]
+                interner = stream.interner
+                if interner is not None and length <= interner.maxlength:
+                    value = interner.intern(value)
+        else:
+            try:
+                items = typdesc.collection_constructor[(type,tag)]()
+            except KeyError:
+                raise UnexpectedWireTypeError
+            try:
+                subtypes = typdesc.subtypes[(type,tag)]
+            except KeyError:
+                raise UnexpectedWireTypeError
+            nitems = bytes[pos]
+            if nitems < 128:
+                pos += 1
+            else:
+                (nitems,pos) = _read_vint(bytes,pos)
+            ntypes = len(subtypes)
+            parse = _parse_value
+            if type == TYPE_TUPLE:
+                append = items.append
+                #  Any items beyond those we know about are skipped over
+                #  by jumping straight to the end of the tuple.
+                for i in xrange(min(nitems,ntypes)):
+                    (item,pos) = parse(stream,data,bytes,pos,subtypes[i])
+                    append(item)
+            elif type == TYPE_HTUPLE:
+                values = []
+                append = values.append
+                if ntypes == 1:
+                    subtype = subtypes[0]
+                    for i in xrange(nitems):
+                        (item,pos) = parse(stream,data,bytes,pos,subtype)
+                        append(item)
+                else:
+                    for i in xrange(nitems):
+                        subtype = subtypes[i % ntypes]
+                        (item,pos) = parse(stream,data,bytes,pos,subtype)
+                        append(item)
+                if items.__class__ is TypedList:
+                    #  The parsed values are already of the correct type, so
+                    #  we can bypass the conversion done by TypedList.append.
+                    list.extend(items,values)
+                elif items.__class__ is list:
+                    items = values
+                else:
+                    for item in values:
+                        items.append(item)
+            elif type == TYPE_ASSOC:
+                if items.__class__ is TypedDict:
+                    #  The parsed values are already of the correct type, so
+                    #  we can bypass the conversion done by TypedDict.
+                    setitem = dict.__setitem__
+                else:
+                    setitem = items.__class__.__setitem__
+                #  Keys must be hashable, so they are never returned as views.
+                threshold = stream.blob_threshold
+                try:
+                    for i in xrange(nitems):
+                        stream.blob_threshold = None
+                        subtype = subtypes[(2*i) % ntypes]
+                        (key,pos) = parse(stream,data,bytes,pos,subtype)
+                        stream.blob_threshold = threshold
+                        subtype = subtypes[(2*i + 1) % ntypes]
+                        (val,pos) = parse(stream,data,bytes,pos,subtype)
+                        setitem(items,key,val)
+                finally:
+                    stream.blob_threshold = threshold
+            else:
+                raise UnexpectedWireTypeError
+            if pos > end:
+                raise UnexpectedEOFError
+            value = items
+        pos = end
+    elif type == TYPE_VINT:
+        value = bytes[pos]
+        if value < 128:
+            pos += 1
+        else:
+            (value,pos) = _read_vint(bytes,pos)
+    elif type == TYPE_BITS8:
+        value = data[pos]
+        pos += 1
+    elif type == TYPE_BITS32:
+        if pos + 4 > len(data):
+            raise UnexpectedEOFError
+        value = _unpack_bits32(data,pos)[0]
+        pos += 4
+    elif type == TYPE_BITS64_LONG:
+        if pos + 8 > len(data):
+            raise UnexpectedEOFError
+        value = _unpack_bits64_long(data,pos)[0]
+        pos += 8
+    elif type == TYPE_BITS64_FLOAT:
+        if pos + 8 > len(data):
+            raise UnexpectedEOFError
+        value = _unpack_bits64_float(data,pos)[0]
+        pos += 8
+    elif type == TYPE_ENUM:
+        value = None
+    else:
+        raise UnexpectedWireTypeError
+    value = typdesc.parse_value(value,type,tag)
+    if type == TYPE_TUPLE and stream.interner is not None:
+        if stream.interner.tuples and value.__class__ is tuple:
+            value = stream.interner.intern_tuple(typdesc,value)
+    return (value,pos)
+
+def _render(stream,out,value,typdesc):
+    """Render a value onto the end of the bytearray 'out'.
+
+    The length prefix of each Tuple, HTuple or Assoc is inserted in front of
+    its contents once they have been rendered, so that nested values are
+    written directly into the output rather than into temporary buffers.
+    """
+    (value,type,tag) = typdesc.render_value(value)
+    if type == TYPE_PRERENDERED:
+        out += value
+        return
+    prefix = tag << 4 | type
+    if prefix < 128:
+        out.append(prefix)
+    else:
+        _write_vint(out,prefix)
+    if type == TYPE_VINT:
+        if value < 128:
+            out.append(value)
+        else:
+            _write_vint(out,value)
+    elif type == TYPE_BYTES:
+        if value.__class__ is not str:
+            value = _blob_data(value)
+        _write_vint(out,len(value))
+        out += value
+    elif type & 0x01:
+        subtypes = typdesc.subtypes[(type,tag)]
+        start = len(out)
+        nitems = len(value)
+        _write_vint(out,nitems)
+        ntypes = len(subtypes)
+        render = _render_value
+        if type == TYPE_TUPLE:
+            for i in xrange(nitems):
+                render(stream,out,value[i],subtypes[i])
+        elif type == TYPE_HTUPLE:
+            if ntypes == 1:
+                subtype = subtypes[0]
+                for item in value:
+                    render(stream,out,item,subtype)
+            else:
+                for i in xrange(nitems):
+                    render(stream,out,value[i],subtypes[i % ntypes])
+        elif type == TYPE_ASSOC:
+            if stream.canonical:
+                items = stream._sorted_items(value,subtypes)
+                items = [(key,val) for (_,key,val) in items]
+            else:
+                items = value.iteritems()
+            for (i,(key,val)) in enumerate(items):
+                render(stream,out,key,subtypes[(2*i) % ntypes])
+                render(stream,out,val,subtypes[(2*i + 1) % ntypes])
+        else:
+            raise UnexpectedWireTypeError
+        length = len(out) - start
+        if length < 128:
+            out.insert(start,length)
+        else:
+            lenbytes = bytearray()
+            _write_vint(lenbytes,length)
+            out[start:start] = lenbytes
+    elif type == TYPE_BITS8:
+        out += value
+    elif type == TYPE_BITS32:
+        out += _pack_bits32(value)
+    elif type == TYPE_BITS64_LONG:
+        out += _pack_bits64_long(value)
+    elif type == TYPE_BITS64_FLOAT:
+        out += _pack_bits64_float(value)
+    elif type == TYPE_ENUM:
+        pass
+    else:
+        raise UnexpectedWireTypeError
+
+#  These names are used for all recursive calls, so that they can be
+#  replaced when instrumentation is switched on.
+_parse_value = _parse
+_render_value = _render
+
+
+
+#  Instrumentation is switched on by replacing the read_value() and
+#  write_value() methods of Stream, and the _parse_value() and _render_value()
+#  functions used by StringStream, with versions that record each message
+#  value, so that it costs nothing when switched off.  The top-level
+#  functions check for it once per call.  See extprot.instrument for the
+#  details of the recorded data.
+
+_instrument = None
+_read_value = Stream.__dict__["read_value"]
+_write_value = Stream.__dict__["write_value"]
+
+def set_instrumentation(instrument):
+    """Set the object used to record serialization activity.
+
+    The object must have a method record(typcls,event,nbytes,elapsed,failed)
+    as described in extprot.instrument.  Passing None switches off
+    instrumentation.
+    """
+    global _instrument, _parse_value, _render_value
+    _instrument = instrument
+    if instrument is None:
+        Stream.read_value = _read_value
+        Stream.write_value = _write_value
+        _parse_value = _parse
+        _render_value = _render
+    else:
+        Stream.read_value = _instrumented_read_value
+        Stream.write_value = _instrumented_write_value
+        _parse_value = _instrumented_parse
+        _render_value = _instrumented_render
+
+def _instrumented(event,method,stream,*args):
+    """Call a Stream method and record it with the active instrumentation.
+
+    The last argument to the method must be the typedesc of the value being
+    read or written.  The number of bytes is measured as the change in the
+    position of the stream, and is zero if the position is not available.
+    """
+    instrument = _instrument
+    typcls = getattr(args[-1],"type_class",None)
+    startpos = stream._tell()
+    start = default_timer()
+    try:
+        result = method(stream,*args)
+    except EOFError:
+        raise
+    except Exception:
+        instrument.record(typcls,event,0,default_timer() - start,True)
+        raise
+    elapsed = default_timer() - start
+    endpos = stream._tell()
+    if startpos is None or endpos is None:
+        nbytes = 0
+    else:
+        nbytes = endpos - startpos
+    instrument.record(typcls,event,nbytes,elapsed,False)
+    return result
+
+def _instrumented_read_value(self,typdesc):
+    if isinstance(typdesc,(MessageTypeDesc,UnionTypeDesc)):
+        return _instrumented("read",_read_value,self,typdesc)
+    return _read_value(self,typdesc)
+
+def _instrumented_write_value(self,value,typdesc):
+    if isinstance(typdesc,(MessageTypeDesc,UnionTypeDesc)):
+        return _instrumented("write",_write_value,self,value,typdesc)
+    return _write_value(self,value,typdesc)
+
+def _instrumented_parse(stream,data,bytes,pos,typdesc):
+    if not isinstance(typdesc,(MessageTypeDesc,UnionTypeDesc)):
+        return _parse(stream,data,bytes,pos,typdesc)
+    typcls = getattr(typdesc,"type_class",None)
+    start = default_timer()
+    try:
+        (value,end) = _parse(stream,data,bytes,pos,typdesc)
+    except Exception:
+        _instrument.record(typcls,"read",0,default_timer() - start,True)
+        raise
+    _instrument.record(typcls,"read",end - pos,default_timer() - start,False)
+    return (value,end)
+
+def _instrumented_render(stream,out,value,typdesc):
+    if not isinstance(typdesc,(MessageTypeDesc,UnionTypeDesc)):
+        return _render(stream,out,value,typdesc)
+    typcls = getattr(typdesc,"type_class",None)
+    startpos = len(out)
+    start = default_timer()
+    try:
+        _render(stream,out,value,typdesc)
+    except Exception:
+        _instrument.record(typcls,"write",0,default_timer() - start,True)
+        raise
+    elapsed = default_timer() - start
+    _instrument.record(typcls,"write",len(out) - startpos,elapsed,False)
@@ -0,0 +1,242 @@
+"""
+
+  extprot.streaming:  read and write huge list fields incrementally
+
+Encoding a message normally means building it completely in memory, which
+is no good when one of its fields is a list with millions of items.  This
+module can write such a message with the items of the list taken from an
+iterator, so that only one item needs to be held in memory at a time:
+
+    with open("export.bin","wb") as f:
+        doc = dataset(name="export")
+        write_list_field(f,doc,dataset,"rows",generate_rows())
+
+The items are encoded one at a time and either spooled into a temporary
+file or, if the iterable can be iterated more than once, measured in a
+first pass and encoded again in a second pass.  This is necessary because
+the length of the list and of each enclosing message must be written before
+its contents.  The path may name a list field of a nested message, using
+dotted names such as "body.rows".  The value of the list field in the given
+message is ignored.
+
+Such messages can be read back in the same way, with the items of the list
+produced one at a time from the file and the other fields skipped over:
+
+    with open("export.bin","rb") as f:
+        for r in iter_list_field(f,dataset,"rows"):
+            process(r)
+
+
+"""
+
+import tempfile
+
+from extprot.errors import *
+from extprot import types, utils
+from extprot.types import serialize
+from extprot.edit import _get_field
+
+
+#  Size of the chunks in which data is copied or skipped.
+CHUNK_SIZE = 64 * 1024
+
+
+def write_list_field(file,value,typcls,path,items):
+    """Write a message whose list field is fed from an iterable.
+
+    This writes 'value', a message of type 'typcls', to the given file.
+    The List or Array field at the dotted 'path' is written using the
+    values from 'items' in place of its current value.  The output is the
+    same as if the items had been stored in the field and the message
+    written in the usual way.  The number of items written is returned.
+
+    If 'items' is an iterator it is consumed only once, with the encoded
+    items spooled into a temporary file.  Otherwise it is iterated twice,
+    and must produce the same items each time.
+    """
+    names = path.split(".")
+    #  Find the message at each level of the path, and encode the fields
+    #  on either side of the next level down.
+    levels = []
+    msg = value
+    for name in names:
+        field = _get_field(typcls,name)
+        encoded = [serialize._to_string(f.__get__(msg),f._ep_type)
+                   for f in typcls._ep_fields]
+        before = "".join(encoded[:field._ep_index])
+        after = "".join(encoded[field._ep_index+1:])
+        levels.append((typcls,len(encoded),before,after))
+        typcls = field._ep_type
+        if len(levels) < len(names):
+            msg = field.__get__(msg)
+    ltype = typcls
+    if not types._issubclass(ltype,(types.List,types.Array)):
+        raise ValueError("not a list type: %r" % (ltype,))
+    if iter(items) is items:
+        spool = tempfile.TemporaryFile()
+        try:
+            (nitems,size) = _encode_items(ltype,items,spool.write)
+            spool.seek(0)
+            _write_frames(file,levels,ltype,nitems,size)
+            while True:
+                data = spool.read(CHUNK_SIZE)
+                if not data:
+                    break
+                file.write(data)
+        finally:
+            spool.close()
+    else:
+        (nitems,size) = _encode_items(ltype,items,None)
+        _write_frames(file,levels,ltype,nitems,size)
+        (nitems2,size2) = _encode_items(ltype,items,file.write)
+        if (nitems2,size2) != (nitems,size):
+            raise RenderError("items changed between iterations")
+    for (_,_,_,after) in reversed(levels):
+        file.write(after)
+    return nitems
+
+
+def _encode_items(ltype,items,write):
+    """Encode the items of a list, passing each one to 'write'.
+
+    If 'write' is None the encoded items are discarded.  The return value
+    is a tuple giving the number of items and their total encoded size.
+    """
+    t = ltype._types[0]
+    nitems = size = 0
+    for item in items:
+        data = serialize._to_string(utils.convert(t,item),t)
+        if write is not None:
+            write(data)
+        nitems += 1
+        size += len(data)
+    return (nitems,size)
+
+
+def _write_frames(file,levels,ltype,nitems,size):
+    """Write everything that comes before the items of the list.
+
+    This works out the length prefix of the list and of each enclosing
+    message from the total size of the items, then writes the headers and
+    preceding fields of each message from the outermost inwards, followed by
+    the header of the list itself.
+    """
+    count = serialize.encode_vint(nitems)
+    size += len(count)
+    headers = [serialize.encode_vint(ltype._ep_tag << 4 | ltype._ep_primtype)
+               + serialize.encode_vint(size) + count]
+    size += len(headers[0]) - len(count)
+    for (typcls,nfields,before,after) in reversed(levels):
+        count = serialize.encode_vint(nfields)
+        size += len(count) + len(before) + len(after)
+        prefix = typcls._ep_tag << 4 | typcls._ep_primtype
+        header = serialize.encode_vint(prefix) + serialize.encode_vint(size)
+        headers.append(header + count + before)
+        size += len(header)
+    for header in reversed(headers):
+        file.write(header)
+
+
+def iter_list_field(file,typcls,path,interner=None):
+    """Iterate over the items of a list field in a message read from a file.
+
+    This reads a message of type 'typcls' from the given file, yielding the
+    items of the List or Array field at the dotted 'path' one at a time.
+    Other fields are skipped using their length prefixes, by seeking if the
+    file supports it.  If the field is missing from the data then nothing
+    is yielded.
+
+    Once all the items have been yielded, the rest of the message is skipped
+    so that the file is positioned at the start of the next value.  If an
+    InternTable is given as 'interner', it is used to de-duplicate the
+    parsed items.
+    """
+    names = path.split(".")
+    try:
+        prefix = _read_vint(file)
+    except UnexpectedEOFError:
+        raise EOFError
+    remaining = []
+    for name in names:
+        field = _get_field(typcls,name)
+        if prefix & 0xf != serialize.TYPE_TUPLE:
+            raise UnexpectedWireTypeError((prefix & 0xf,prefix >> 4))
+        _read_vint(file)
+        nfields = _read_vint(file)
+        if field._ep_index >= nfields:
+            _skip_values(file,nfields)
+            _skip_remaining(file,remaining)
+            return
+        _skip_values(file,field._ep_index)
+        remaining.append(nfields - field._ep_index - 1)
+        typcls = field._ep_type
+        prefix = _read_vint(file)
+    if not types._issubclass(typcls,(types.List,types.Array)):
+        raise ValueError("not a list type: %r" % (typcls,))
+    if prefix & 0xf != serialize.TYPE_HTUPLE:
+        raise UnexpectedWireTypeError((prefix & 0xf,prefix >> 4))
+    _read_vint(file)
+    nitems = _read_vint(file)
+    stream = serialize.Stream(file,interner)
+    typdesc = typcls._types[0]._ep_typedesc
+    for i in xrange(nitems):
+        try:
+            yield stream.read_value(typdesc)
+        except EOFError:
+            raise UnexpectedEOFError
+    _skip_remaining(file,remaining)
+
+
+def _read_vint(file):
+    """Read an integer encoded in vint format from a file."""
+    x = e = 0
+    while True:
+        c = file.read(1)
+        if not c:
+            raise UnexpectedEOFError
+        b = ord(c)
+        if b < 128:
+            return x + (b << e)
+        x += (b - 128) << e
+        e += 7
+
+
+def _skip(file,size):
+    """Skip the given number of bytes in a file.
+
+    This seeks over the data if possible, and otherwise reads and discards
+    it in chunks so that large values are never held in memory.
+    """
+    try:
+        file.seek(size,1)
+    except (AttributeError,IOError):
+        while size > 0:
+            data = file.read(min(size,CHUNK_SIZE))
+            if not data:
+                raise UnexpectedEOFError
+            size -= len(data)
+
+
+def _skip_values(file,count):
+    """Skip the given number of values in a file."""
+    for _ in xrange(count):
+        prefix = _read_vint(file)
+        type = prefix & 0xf
+        if type & 0x01:
+            _skip(file,_read_vint(file))
+        elif type == serialize.TYPE_VINT:
+            _read_vint(file)
+        elif type == serialize.TYPE_BITS8:
+            _skip(file,1)
+        elif type == serialize.TYPE_BITS32:
+            _skip(file,4)
+        elif type in (serialize.TYPE_BITS64_LONG,serialize.TYPE_BITS64_FLOAT):
+            _skip(file,8)
+        elif type != serialize.TYPE_ENUM:
+            raise UnexpectedWireTypeError((type,prefix >> 4))
+
+
+def _skip_remaining(file,remaining):
+    """Skip the fields after the list in each enclosing message."""
+    for count in reversed(remaining):
+        _skip_values(file,count)
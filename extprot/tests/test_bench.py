@@ -0,0 +1,44 @@
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from extprot import bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run(cases=["small","deep"],min_time=0.001,repeat=1)
+        self.assertEquals(len(results),2 * len(bench.OPERATIONS))
+        for r in results:
+            self.assertEquals(r["engine"],bench.current_engine())
+            assert r["case"] in ("small","deep")
+            assert r["ops_per_sec"] > 0
+            self.assertEquals(r["bytes_per_sec"],r["ops_per_sec"] * r["size"])
+        decodes = [r for r in results if r["op"] == "decode"]
+        (small,deep) = [r["objects_per_op"] for r in decodes]
+        assert 0 < small < deep
+        for r in decodes:
+            assert r["retained_bytes"] > 0
+        for r in results:
+            if r["op"] == "skip":
+                assert r["retained_bytes"] < 1
+
+    def test_json_report(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tdir,"bench.json")
+            argv = ["--engine",bench.current_engine(),"--case","small",
+                    "--op","encode","--min-time","0.001","--json",fn]
+            self.assertEquals(bench.main(argv),0)
+            with open(fn) as f:
+                report = json.load(f)
+            self.assertEquals(len(report["results"]),1)
+            self.assertEquals(report["results"][0]["op"],"encode")
+            table = bench.format_results(report["results"],report)
+            assert table.splitlines()[1].endswith("1.00x")
+        finally:
+            shutil.rmtree(tdir)
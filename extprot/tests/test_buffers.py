@@ -0,0 +1,68 @@
+
+import unittest
+
+import extprot
+from extprot import types
+from extprot.errors import *
+from extprot.buffers import to_buffers
+
+
+class part(types.Message):
+    name = types.Field(types.String)
+    size = types.Field(types.Int)
+    data = types.Field(types.String)
+
+class mail(types.Message):
+    subject = types.Field(types.String)
+    parts = types.Field(types.List.build(part))
+    headers = types.Field(types.Assoc.build(types.String,types.String))
+    score = types.Field(types.Float)
+    flagged = types.Field(types.Bool)
+
+
+def _join(buffers):
+    data = bytearray()
+    for buf in buffers:
+        data += buf
+    return str(data)
+
+
+class TestBuffers(unittest.TestCase):
+
+    def setUp(self):
+        self.big = "x" * 10000
+        self.parts = [part("a.txt",-7,"small"),part("b.bin",10000,self.big)]
+        self.m = mail("hello",self.parts,{"to":"bob"},1.5,True)
+
+    def test_to_buffers(self):
+        buffers = to_buffers(self.m,mail)
+        self.assertEquals(_join(buffers),self.m.to_string())
+        #  The large string is included as-is between two small chunks.
+        self.assertEquals(len(buffers),3)
+        self.assertTrue(buffers[1] is self.big)
+        self.assertTrue(len(buffers[0]) < 100)
+        #  With a smaller threshold, more strings are referenced in place.
+        buffers = to_buffers(self.m,mail,threshold=5)
+        self.assertEquals(_join(buffers),self.m.to_string())
+        self.assertTrue("small" in buffers)
+        self.assertEquals(extprot.to_buffers(self.m,mail,5),buffers)
+        #  A value without large strings gives a single chunk.
+        self.assertEquals(to_buffers(self.parts[0],part),
+                          [self.parts[0].to_string()])
+
+    def test_to_buffers_views(self):
+        data = self.m.to_string()
+        m2 = mail.from_string(data,blob_threshold=1000)
+        buffers = to_buffers(m2,mail)
+        self.assertEquals(_join(buffers),data)
+        self.assertTrue(isinstance(buffers[1],memoryview))
+        #  Frozen messages are written out in their serialized form.
+        p = self.parts[1]
+        p.freeze()
+        buffers = to_buffers(p,part,100)
+        self.assertEquals(buffers,[p.to_string()])
+        m = mail("frozen",[p],{},0.0,False)
+        buffers = to_buffers(m,mail,100)
+        self.assertEquals(_join(buffers),m.to_string())
+        self.assertEquals(len(buffers),3)
+
@@ -0,0 +1,93 @@
+
+
+import unittest
+from cStringIO import StringIO
+
+from extprot import types
+from extprot.errors import *
+from extprot.container import ContainerWriter, ContainerReader
+from extprot.container import schema_fingerprint, MAGIC
+
+
+class entry(types.Message):
+    id = types.Field(types.Int)
+    text = types.Field(types.String)
+
+class other_entry(types.Message):
+    ident = types.Field(types.Int)
+    data = types.Field(types.String)
+
+class wider_entry(types.Message):
+    id = types.Field(types.Int)
+    text = types.Field(types.String)
+    extra = types.Field(types.List.build(types.Int))
+
+
+class TestContainer(unittest.TestCase):
+
+    def _make_file(self,n=100,**kwds):
+        f = StringIO()
+        w = ContainerWriter(f,entry,block_records=10,**kwds)
+        for i in xrange(n):
+            w.write(entry(i,"entry number %d" % (i,)))
+        w.close()
+        return f
+
+    def test_roundtrip(self):
+        for codec in ("null","zlib"):
+            f = self._make_file(codec=codec,metadata={"source":"tests"})
+            r = ContainerReader(f,entry)
+            self.assertEquals(r.codec,codec)
+            self.assertEquals(r.metadata,{"source":"tests"})
+            values = list(r)
+            self.assertEquals(len(values),100)
+            self.assertEquals(values[42],entry(42,"entry number 42"))
+
+    def test_compression(self):
+        f1 = self._make_file(codec="null")
+        f2 = self._make_file(codec="zlib")
+        assert len(f2.getvalue()) < len(f1.getvalue())
+
+    def test_skip_blocks(self):
+        r = ContainerReader(self._make_file(),entry)
+        blocks = list(r.blocks())
+        self.assertEquals(len(blocks),10)
+        self.assertEquals(sum(b.count for b in blocks),100)
+        self.assertEquals(blocks[7].records()[3],entry(73,"entry number 73"))
+
+    def test_split(self):
+        f = self._make_file()
+        size = len(f.getvalue())
+        bounds = [0,size//3,size//2,size]
+        values = []
+        for (start,end) in zip(bounds[:-1],bounds[1:]):
+            values.extend(ContainerReader(f,entry,start,end))
+        self.assertEquals([v.id for v in values],range(100))
+
+    def test_corruption(self):
+        f = self._make_file(codec="null")
+        r = ContainerReader(f,entry)
+        block = list(r.blocks())[4]
+        data = f.getvalue()
+        pos = block.data_offset + 2
+        f = StringIO(data[:pos] + "X" + data[pos+1:])
+        self.assertRaises(ChecksumError,list,ContainerReader(f,entry))
+        r = ContainerReader(f,entry,skip_corrupt=True)
+        values = list(r)
+        self.assertEquals(len(values),90)
+        self.assertEquals(r.corrupt_offsets,[block.offset])
+        #  Damage the sync marker, so the block header can't be found.
+        pos = block.offset + 2
+        f = StringIO(data[:pos] + "X" + data[pos+1:])
+        r = ContainerReader(f,entry,skip_corrupt=True)
+        self.assertEquals(len(list(r)),90)
+
+    def test_schema(self):
+        self.assertEquals(schema_fingerprint(entry),
+                          schema_fingerprint(other_entry))
+        self.assertNotEquals(schema_fingerprint(entry),
+                             schema_fingerprint(wider_entry))
+        f = self._make_file()
+        self.assertEquals(len(list(ContainerReader(f,wider_entry))),100)
+        self.assertRaises(ParseError,ContainerReader,f,wider_entry,strict=True)
+        self.assertRaises(ParseError,ContainerReader,StringIO("junk"),entry)
@@ -0,0 +1,95 @@
+
+
+import unittest
+
+import extprot
+from extprot import types
+from extprot.errors import *
+from extprot.edit import extend_list
+
+
+class address(types.Message):
+    street = types.Field(types.String,mutable=True)
+    city = types.Field(types.String,mutable=True)
+    postcode = types.Field(types.Int,mutable=True)
+
+class customer(types.Message):
+    id = types.Field(types.Int,mutable=True)
+    name = types.Field(types.String,mutable=True)
+    address = types.Field(address)
+    notes = types.Field(types.List.build(types.String))
+
+class old_customer(types.Message):
+    id = types.Field(types.Int)
+    name = types.Field(types.String)
+
+class new_customer(old_customer):
+    tags = types.Field(types.List.build(types.String))
+
+
+class TestPatch(unittest.TestCase):
+
+    def _make_customer(self):
+        addr = address("1 Main St","Melbourne",3000)
+        return customer(7,"Ryan",addr,["note %d" % (i,) for i in xrange(200)])
+
+    def test_patch_field(self):
+        c = self._make_customer()
+        data = extprot.patch(c.to_string(),customer,{"name":"Bob"})
+        c.name = "Bob"
+        self.assertEquals(data,c.to_string())
+
+    def test_patch_nested_field(self):
+        c = self._make_customer()
+        changes = {"address.city":"A much longer city name " * 10,
+                   "id":2**40}
+        data = extprot.patch(c.to_string(),customer,changes)
+        c.address.city = changes["address.city"]
+        c.id = 2**40
+        self.assertEquals(data,c.to_string())
+        self.assertEquals(customer.from_string(data),c)
+
+    def test_patch_old_data(self):
+        data = old_customer(7,"Ryan").to_string()
+        data = extprot.patch(data,new_customer,{"tags":["vip"]})
+        self.assertEquals(new_customer.from_string(data),
+                          new_customer(7,"Ryan",["vip"]))
+
+    def test_patch_errors(self):
+        data = self._make_customer().to_string()
+        self.assertRaises(ValueError,extprot.patch,data,customer,{"age":7})
+        self.assertRaises(ValueError,extprot.patch,data,customer,{"id":"7"})
+        self.assertRaises(ValueError,extprot.patch,data,customer,
+                          {"name.first":"Bob"})
+
+
+class TestExtendList(unittest.TestCase):
+
+    def test_extend_list(self):
+        c = customer(7,"Ryan",address("1 Main St","Melbourne",3000),["a"])
+        data = c.to_string()
+        for i in xrange(200):
+            data = extend_list(data,customer,"notes",["note %d" % (i,)])
+            c.notes.append("note %d" % (i,))
+            self.assertEquals(data,c.to_string())
+        data = extend_list(data,customer,"notes",[])
+        self.assertEquals(data,c.to_string())
+
+    def test_extend_nested_list(self):
+        class history(types.Message):
+            owner = types.Field(customer)
+        h = history(customer(7,"Ryan",address("1 Main St","Melbourne",3000)))
+        data = extend_list(h.to_string(),history,"owner.notes",["x","y"])
+        h.owner.notes.extend(["x","y"])
+        self.assertEquals(data,h.to_string())
+
+    def test_extend_old_data(self):
+        data = old_customer(7,"Ryan").to_string()
+        data = extend_list(data,new_customer,"tags",["vip"])
+        self.assertEquals(new_customer.from_string(data),
+                          new_customer(7,"Ryan",["vip"]))
+
+    def test_extend_errors(self):
+        data = customer(7,"Ryan",address("","",0)).to_string()
+        self.assertRaises(ValueError,extend_list,data,customer,"notes",[7])
+        self.assertRaises(ValueError,extend_list,data,customer,"name",["x"])
@@ -1,9 +1,15 @@
 
 #  Encoding tests based on examples from doc/encoding.md
 
+import mmap
+import tempfile
 import unittest
+from StringIO import StringIO
 
+from extprot.errors import ParseError
 from extprot.types import *
+from extprot import types, serialize
+from extprot.utils import Blob
 
 
 class a_bool(Message):
@@ -35,6 +41,15 @@ class a_bool_and_int(Message):
     i = Field(Int)
 
 
+class attachment(Message):
+    name = Field(String)
+    data = Field(String)
+    parts = Field(List.build(String))
+
+class headers(Message):
+    values = Field(Assoc.build(String,String))
+
+
 class Test_Encoding(unittest.TestCase):
 
     def assertEncEquals(self,msg,enc):
@@ -65,3 +80,98 @@ class Test_Encoding(unittest.TestCase):
         bi = a_bool_and_int(a_bool(True),-1)
         self.assertEncEquals(bi,[1,8,2,1,3,1,2,1,0,1])
 
+
+    def test_large_values(self):
+        #  Lengths and counts that need multi-byte vints, and values big
+        #  enough to be parsed directly from a file rather than in memory.
+        si = some_ints_l(range(-3000,3000))
+        data = si.to_string()
+        self.assertEquals(some_ints_l.from_string(data),si)
+        self.assertEquals(some_ints_l.from_file(StringIO(data)),si)
+        out = StringIO()
+        si.to_file(out)
+        self.assertEquals(out.getvalue(),data)
+
+    def test_blobs(self):
+        a = attachment("a.bin","x" * 5000,["y" * 100,"z" * 6000])
+        data = a.to_string()
+        #  From a string, large values are views into the string.
+        a2 = attachment.from_string(data,blob_threshold=1000)
+        self.assertEquals(a2.name.__class__,str)
+        self.assertEquals(a2.parts[0].__class__,str)
+        self.assertEquals(a2.data.__class__,memoryview)
+        self.assertEquals(a2.data.tobytes(),a.data)
+        self.assertEquals(a2.parts[1].tobytes(),a.parts[1])
+        self.assertEquals(a2.to_string(),data)
+        #  A unicode string is encoded before it is parsed.
+        a3 = attachment("a.bin","x" * 60,[])
+        u = unicode(a3.to_string())
+        self.assertEquals(attachment.from_string(u),a3)
+        a2 = attachment.from_string(u,blob_threshold=50)
+        self.assertEquals(a2.data.tobytes(),a3.data)
+        #  From an mmap, they are buffers into the mapped file.
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+        m = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        a2 = attachment.from_string(m,blob_threshold=1000)
+        self.assertEquals(str(a2.data),a.data)
+        self.assertEquals(a2.to_string(),data)
+        self.assertEquals(attachment.from_string(m),a)
+        #  A bytearray can be parsed too, and the pure-python engine parses
+        #  it in place and makes just one copy of other sources.
+        a2 = attachment.from_string(bytearray(data),blob_threshold=1000)
+        self.assertEquals(a2.data.tobytes(),a.data)
+        self.assertEquals(a2.to_string(),data)
+        if types.serialize is serialize:
+            source = bytearray(data)
+            assert serialize.StringStream(source).bytes is source
+            self.assertEquals(serialize.StringStream(m).data.__class__,buffer)
+        #  From a file, they are Blob handles.
+        f.seek(0)
+        a2 = attachment.from_file(f,blob_threshold=1000)
+        self.assertEquals(f.tell(),len(data))
+        self.assertTrue(isinstance(a2.data,Blob))
+        self.assertEquals(len(a2.data),5000)
+        self.assertEquals(a2,a)
+        self.assertEquals(a2.to_string(),data)
+        #  Views and blobs can be stored in String fields.
+        a3 = attachment(memoryview("b.bin"),a2.data,[])
+        a3 = attachment.from_string(a3.to_string())
+        self.assertEquals(a3,attachment("b.bin",a.data,[]))
+
+    def test_blob_assoc_keys(self):
+        #  Assoc keys are always strings, so that they can be hashed.
+        h = headers({"a" * 5000:"b" * 5000,"c":"d" * 10})
+        data = h.to_string()
+        h2 = headers.from_string(data,blob_threshold=3)
+        self.assertEquals(sorted(map(type,h2.values)),[str,str])
+        self.assertEquals(h2.values["c"].tobytes(),"d" * 10)
+        self.assertEquals(h2.values["a" * 5000].tobytes(),"b" * 5000)
+        self.assertEquals(h2.to_string(),data)
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(0)
+        h2 = headers.from_file(f,blob_threshold=3)
+        self.assertEquals(sorted(map(type,h2.values)),[str,str])
+        self.assertTrue(isinstance(h2.values["a" * 5000],Blob))
+        self.assertEquals(h2,h)
+
+    def test_extra_tuple_items(self):
+        #  Items beyond those known to the reader are skipped.
+        data = "".join(map(chr,[1,13,3,1,3,1,2,1,0,2,3,3])) + "abc"
+        self.assertEquals(a_bool_and_int.from_string(data).i,1)
+
+    def test_pure_parse_errors(self):
+        #  Typedescs are only compatible with the engine that created them.
+        if types.serialize is not serialize:
+            return
+        data = a_bool_and_int(a_bool(True),-1).to_string()
+        for i in xrange(1,len(data)):
+            self.assertRaises(ParseError,serialize.from_string,
+                              data[:i],a_bool_and_int)
+        self.assertRaises(EOFError,serialize.from_string,"",a_bool_and_int)
+        self.assertEquals(serialize.decode_vint("\x80\x01x",0),(128,2))
+        self.assertRaises(ParseError,serialize.decode_vint,"\x80",0)
+        self.assertEquals(serialize.encode_vint(300),"\xac\x02")
+
@@ -38,5 +38,25 @@ class TestExtensions(unittest.TestCase):
             value = types.Field(types.String)
         self.assertRaises(types.ParseError,M2.from_string,M3("hello").to_string())
 
-
-
+    def test_option_extension(self):
+        class Shape1(types.Union):
+            class Dot(types.Option):
+                pass
+            class Circle(types.Option):
+                _types = (types.Int,)
+        class Shape2(types.Union):
+            class Dot(types.Option):
+                pass
+            class Circle(types.Option):
+                _types = (types.Int,types.List.build(types.String))
+        class M1(types.Message):
+            shapes = types.Field(types.List.build(Shape1))
+        class M2(types.Message):
+            shapes = types.Field(types.List.build(Shape2))
+        m1 = M1([Shape1.Circle(3),Shape1.Dot])
+        m2 = M2.from_string(m1.to_string())
+        self.assertEquals(m2.shapes,[Shape2.Circle(3,[]),Shape2.Dot])
+        assert m2.shapes[1] is Shape2.Dot
+        m2.shapes[0] = Shape2.Circle(4,["red"])
+        self.assertEquals(M1.from_string(m2.to_string()),
+                          M1([Shape1.Circle(4),Shape1.Dot]))
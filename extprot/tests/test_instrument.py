@@ -0,0 +1,98 @@
+
+import unittest
+from StringIO import StringIO
+
+from extprot import types
+from extprot import instrument
+from extprot.errors import *
+
+
+class actor(types.Message):
+    name = types.Field(types.String)
+
+class movie(types.Message):
+    title = types.Field(types.String)
+    actors = types.Field(types.List.build(actor))
+
+class draft(types.Message):
+    version = types.Field(types.Int,mutable=True)
+    title = types.Field(types.String,mutable=True)
+    lead = types.Field(actor)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def tearDown(self):
+        instrument.disable()
+
+    def test_counters(self):
+        m = movie("Bad Eggs",[actor("Mick Molloy"),actor("Judith Lucy")])
+        data = m.to_string()
+        stats = instrument.enable()
+        self.assertEquals(m.to_string(),data)
+        self.assertEquals(movie.from_string(data),m)
+        f = StringIO()
+        m.to_file(f)
+        f.seek(0)
+        self.assertEquals(movie.from_file(f),m)
+        counts = stats.snapshot()
+        mname = instrument.type_name(movie)
+        aname = instrument.type_name(actor)
+        self.assertEquals(sorted(counts),sorted([mname,aname]))
+        for event in ("from_string","to_string","from_file","to_file"):
+            self.assertEquals(counts[mname][event]["calls"],1)
+            self.assertEquals(counts[mname][event]["bytes"],len(data))
+            self.assertEquals(counts[mname][event]["errors"],0)
+            assert counts[mname][event]["time"] >= 0
+        self.assertEquals(counts[aname]["read"]["calls"],4)
+        self.assertEquals(counts[aname]["write"]["calls"],4)
+        self.assertEquals(counts[aname]["read"]["bytes"],
+                          2 * len(actor("Mick Molloy").to_string()) +
+                          2 * len(actor("Judith Lucy").to_string()))
+        stats.reset()
+        self.assertEquals(stats.snapshot(),{})
+
+    def test_incremental_messages(self):
+        d = draft(1,"q",actor("Mick Molloy"))
+        data = d.to_string()
+        stats = instrument.enable()
+        d.version = 2
+        data = d.to_string()
+        f = StringIO()
+        d.to_file(f)
+        self.assertEquals(f.getvalue(),data)
+        counts = stats.snapshot()
+        dname = instrument.type_name(draft)
+        #  Fields are rendered as part of the message, not as top-level
+        #  events of their own, and unchanged fields aren't rendered at all.
+        self.assertEquals(sorted(counts),[dname])
+        for event in ("to_string","to_file"):
+            self.assertEquals(counts[dname][event]["calls"],1)
+            self.assertEquals(counts[dname][event]["bytes"],len(data))
+
+    def test_errors(self):
+        stats = instrument.enable()
+        self.assertRaises(ParseError,movie.from_string,"\x00\x01")
+        counts = stats.snapshot()[instrument.type_name(movie)]
+        self.assertEquals(counts["from_string"],
+                          {"calls":1,"bytes":0,"errors":1,
+                           "time":counts["from_string"]["time"]})
+
+    def test_hooks(self):
+        events = []
+        hist = instrument.LatencyHistogram()
+        stats = instrument.enable()
+        stats.add_hook(lambda *args: events.append(args[:3]))
+        stats.add_hook(hist)
+        data = movie("Bad Eggs").to_string()
+        self.assertEquals(events,[(movie,"to_string",len(data))])
+        counts = hist.snapshot()[instrument.type_name(movie)]["to_string"]
+        self.assertEquals(sum(counts.values()),1)
+
+    def test_disable(self):
+        stats = instrument.enable()
+        self.assert_(instrument.current() is stats)
+        instrument.disable()
+        self.assert_(instrument.current() is None)
+        movie("Bad Eggs").to_string()
+        self.assertEquals(stats.snapshot(),{})
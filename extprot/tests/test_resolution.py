@@ -0,0 +1,151 @@
+
+import gc
+import unittest
+import weakref
+
+import extprot
+from extprot import types
+from extprot.types import serialize
+from extprot.errors import *
+from extprot.resolution import resolve, DecodePlan
+
+
+#  Version 1 of the protocol.
+
+class point1(types.Message):
+    x = types.Field(types.Int)
+
+class shape1(types.Union):
+    class Dot(types.Option):
+        _types = ()
+    class Circle(types.Option):
+        _types = (types.Int,)
+
+class drawing1(types.Message):
+    name = types.Field(types.String)
+    points = types.Field(types.List.build(point1))
+    size = types.Field(types.Int)
+    kind = types.Field(types.Int)
+    shape = types.Field(shape1)
+
+
+#  Version 2 of the protocol, which adds fields and tuple items and
+#  promotes some primitives to tuples and unions.
+
+class point2(types.Message):
+    x = types.Field(types.Int)
+    visible = types.Field(types.Bool)
+    labels = types.Field(types.List.build(types.String))
+
+class shape2(types.Union):
+    class Dot(types.Option):
+        _types = ()
+    class Circle(types.Option):
+        _types = (types.Int,types.Bool)
+
+class kind2(types.Union):
+    class Unknown(types.Option):
+        _types = ()
+    class Known(types.Option):
+        _types = (types.Int,types.Bool)
+
+class drawing2(types.Message):
+    name = types.Field(types.String)
+    points = types.Field(types.List.build(point2))
+    size = types.Field(types.Tuple.build(types.Int,types.Bool))
+    kind = types.Field(kind2)
+    shape = types.Field(shape2)
+    notes = types.Field(types.List.build(types.String))
+    hidden = types.Field(types.Bool)
+
+#  A version with constant options declared without '_types'.
+
+class shape3(types.Union):
+    class Dot(types.Option):
+        pass
+    class Circle(types.Option):
+        _types = (types.Int,types.Bool)
+
+class drawing3(types.Message):
+    name = types.Field(types.String)
+    points = types.Field(types.List.build(point1))
+    size = types.Field(types.Int)
+    kind = types.Field(types.Int)
+    shape = types.Field(shape3)
+
+
+class TestResolution(unittest.TestCase):
+
+    def setUp(self):
+        self.d1 = drawing1("sketch",[point1(1),point1(-2)],7,3,
+                           shape1.Circle(5))
+
+    def test_read_older(self):
+        data = self.d1.to_string()
+        plan = resolve(drawing2,drawing1)
+        d2 = plan.from_string(data)
+        self.assertEquals(d2,drawing2.from_string(data))
+        self.assertEquals(d2.name,"sketch")
+        self.assertEquals([p.x for p in d2.points],[1,-2])
+        self.assertEquals(d2.points[0].visible,False)
+        self.assertEquals(d2.points[0].labels,[])
+        self.assertEquals(d2.size,(7,False))
+        self.assertEquals(d2.kind,kind2.Known(3,False))
+        self.assertEquals(d2.shape,shape2.Circle(5,False))
+        self.assertEquals(d2.hidden,False)
+        self.assertEquals(d2.notes,[])
+        #  Mutable defaults must not be shared between values.
+        self.assertFalse(d2.points[0].labels is d2.points[1].labels)
+        d2b = plan.from_string(data)
+        self.assertFalse(d2.notes is d2b.notes)
+        #  Values in the current version are still read correctly.
+        d2.points[0].labels.append("start")
+        d2 = drawing2(d2.name,d2.points,d2.size,d2.kind,d2.shape,["x"],True)
+        self.assertEquals(plan.from_string(d2.to_string()),d2)
+        d2 = plan.from_string(data,blob_threshold=2)
+        self.assertEquals(d2.name.tobytes(),"sketch")
+
+    def test_read_newer(self):
+        d2 = drawing2.from_string(self.d1.to_string())
+        p2 = point2(-2,True,["end"])
+        p1 = resolve(point1,point2).from_string(p2.to_string())
+        self.assertEquals(p1,point1(-2))
+        data = serialize.to_string(d2.shape,shape2)
+        s1 = resolve(shape1,shape2).from_string(data)
+        self.assertEquals(s1,shape1.Circle(5))
+
+    def test_constant_options(self):
+        plan = resolve(shape3,shape1)
+        data = serialize.to_string(shape1.Dot(),shape1)
+        self.assertEquals(plan.from_string(data),shape3.Dot())
+        data = serialize.to_string(shape1.Circle(5),shape1)
+        self.assertEquals(plan.from_string(data),shape3.Circle(5,False))
+        d3 = resolve(drawing3,drawing1).from_string(self.d1.to_string())
+        self.assertEquals(d3.shape,shape3.Circle(5,False))
+
+    def test_plan_cache(self):
+        self.assertTrue(resolve(drawing2,drawing1) is
+                        extprot.resolve(drawing2,drawing1))
+        self.assertFalse(resolve(drawing2,drawing1) is
+                         DecodePlan(drawing2,drawing1))
+        #  Cached plans don't keep either of their types alive.
+        class temp_point(types.Message):
+            x = types.Field(types.Int)
+            y = types.Field(types.Int)
+        plan = resolve(point1,temp_point)
+        self.assertTrue(plan.writer is temp_point)
+        ref = weakref.ref(temp_point)
+        del temp_point, plan
+        gc.collect()
+        self.assertTrue(ref() is None)
+        class temp_point(types.Message):
+            x = types.Field(types.Int)
+        resolve(temp_point,point1)
+        ref = weakref.ref(temp_point)
+        del temp_point
+        gc.collect()
+        self.assertTrue(ref() is None)
+        #  Resolving a type against itself uses its own typedesc.
+        plan = resolve(drawing2,drawing2)
+        self.assertTrue(plan._ep_typedesc is drawing2._ep_typedesc)
+
@@ -0,0 +1,122 @@
+
+import unittest
+from StringIO import StringIO
+
+from extprot import types
+from extprot import instrument
+from extprot.errors import *
+from extprot.streaming import write_list_field, iter_list_field
+
+
+class row(types.Message):
+    key = types.Field(types.String)
+    value = types.Field(types.Int)
+
+class old_table(types.Message):
+    name = types.Field(types.String)
+
+class table(types.Message):
+    name = types.Field(types.String)
+    rows = types.Field(types.List.build(row))
+    total = types.Field(types.Int)
+
+class dataset(types.Message):
+    title = types.Field(types.String)
+    body = types.Field(table)
+    ids = types.Field(types.Array.build(types.Int))
+
+
+class _Unseekable(object):
+    """File wrapper that can only be read sequentially."""
+    def __init__(self,data):
+        self._file = StringIO(data)
+    def read(self,size):
+        return self._file.read(size)
+
+
+def _rows(n):
+    for i in xrange(n):
+        yield row("key %d" % (i,),i * 1000)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_write_list_field(self):
+        t = table("big",[],42)
+        expected = table("big",list(_rows(500)),42).to_string()
+        #  From an iterator, using a spool file.
+        f = StringIO()
+        self.assertEquals(write_list_field(f,t,table,"rows",_rows(500)),500)
+        self.assertEquals(f.getvalue(),expected)
+        #  From a list, using two passes.
+        f = StringIO()
+        write_list_field(f,t,table,"rows",list(_rows(500)))
+        self.assertEquals(f.getvalue(),expected)
+        #  An empty list.
+        f = StringIO()
+        write_list_field(f,t,table,"rows",iter([]))
+        self.assertEquals(f.getvalue(),t.to_string())
+
+    def test_write_nested_list_field(self):
+        d = dataset("data",table("big",[row("old",1)],7),[1,2])
+        f = StringIO()
+        write_list_field(f,d,dataset,"body.rows",_rows(300))
+        d.body.rows[:] = list(_rows(300))
+        self.assertEquals(f.getvalue(),d.to_string())
+        self.assertEquals(dataset.from_string(f.getvalue()),d)
+        #  Items are converted like field values.
+        f = StringIO()
+        write_list_field(f,d,dataset,"ids",[3,4L,5])
+        d.ids[:] = [3,4,5]
+        self.assertEquals(f.getvalue(),d.to_string())
+
+    def test_write_list_field_instrumented(self):
+        #  Items and fields aren't recorded as top-level events of their own.
+        stats = instrument.enable()
+        try:
+            t = table("big",[],42)
+            write_list_field(StringIO(),t,table,"rows",_rows(10))
+            write_list_field(StringIO(),t,table,"rows",list(_rows(10)))
+        finally:
+            instrument.disable()
+        for counts in stats.snapshot().itervalues():
+            self.assertFalse("to_string" in counts)
+
+    def test_write_list_field_errors(self):
+        t = table("big",[],42)
+        f = StringIO()
+        self.assertRaises(ValueError,write_list_field,f,t,table,"name",[])
+        self.assertRaises(ValueError,write_list_field,f,t,table,"cols",[])
+        self.assertRaises(ValueError,write_list_field,f,t,table,"rows.x",[])
+        d = dataset("data",t,[])
+        self.assertRaises(ValueError,write_list_field,f,d,dataset,"ids",["x"])
+
+    def test_iter_list_field(self):
+        t = table("big",list(_rows(500)),42)
+        d = dataset("data",t,[1,2,3])
+        data = d.to_string() + t.to_string()
+        for f in (StringIO(data),_Unseekable(data)):
+            items = iter_list_field(f,dataset,"body.rows")
+            self.assertEquals(items.next(),row("key 0",0))
+            self.assertEquals(list(items),list(_rows(500))[1:])
+            #  The rest of the message is skipped once the list is done.
+            self.assertEquals(list(iter_list_field(f,table,"rows")),t.rows)
+            self.assertRaises(EOFError,list,iter_list_field(f,table,"rows"))
+        f = StringIO(data)
+        self.assertEquals(list(iter_list_field(f,dataset,"ids")),[1,2,3])
+        self.assertEquals(table.from_file(f),t)
+        #  A list field missing from older data is empty.
+        f = StringIO(old_table("old").to_string() + t.to_string())
+        self.assertEquals(list(iter_list_field(f,table,"rows")),[])
+        self.assertEquals(table.from_file(f),t)
+
+    def test_iter_list_field_errors(self):
+        data = table("big",list(_rows(5)),42).to_string()
+        f = StringIO(data)
+        self.assertRaises(ValueError,list,iter_list_field(f,table,"name"))
+        f = StringIO(data)
+        items = iter_list_field(f,dataset,"body.rows")
+        self.assertRaises(UnexpectedWireTypeError,list,items)
+        f = StringIO(data[:-10])
+        items = iter_list_field(f,table,"rows")
+        self.assertRaises(UnexpectedEOFError,list,items)
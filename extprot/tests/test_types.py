@@ -1,14 +1,17 @@
 
 import os
+import sys
 from os import path
 import unittest
 import pickle
 import operator
+from StringIO import StringIO
 
 from nose import SkipTest
 
 import extprot
 from extprot import types
+from extprot.utils import InternTable
 
 class movie(types.Message):
     id = types.Field(types.Int)
@@ -28,6 +31,43 @@ class IDs(types.Message):
     map = types.Field(types.Assoc.build(types.Long,types.String))
 
 
+IntAndString = types.Tuple.build(types.Int,types.String)
+
+class TwoTuples(types.Message):
+    a = types.Field(IntAndString)
+    b = types.Field(IntAndString)
+
+class MixedTuples(types.Message):
+    a = types.Field(types.Tuple.build(types.Bool,types.String))
+    b = types.Field(types.Tuple.build(types.Int,types.String))
+    c = types.Field(types.Tuple.build(types.Float,types.String))
+
+
+class CountedString(types.String):
+    num_converted = 0
+    @classmethod
+    def _ep_convert(cls,value):
+        cls.num_converted += 1
+        return super(CountedString,cls)._ep_convert(value)
+
+class CountedStrings(types.Message):
+    items = types.Field(types.List.build(CountedString))
+    map = types.Field(types.Assoc.build(CountedString,CountedString))
+
+
+class RenderedString(types.String):
+    num_rendered = 0
+    @classmethod
+    def _ep_render(cls,value):
+        cls.num_rendered += 1
+        return (value,cls._ep_primtype,cls._ep_tag)
+
+class Document(types.Message):
+    title = types.Field(RenderedString,mutable=True)
+    body = types.Field(RenderedString,mutable=True)
+    tags = types.Field(types.List.build(RenderedString))
+
+
 class BigNum(types.Message):
     value = types.Field(types.Int)
 
@@ -105,4 +145,275 @@ class TestTypes(unittest.TestCase):
             self.assertEquals(v,BigNum.from_string(BigNum(v).to_string()).value)
            
 
+    def test_interning(self):
+        m = movie(1,"Bad Eggs",["Mick Molloy","Judith Lucy","Mick Molloy"])
+        data = m.to_string()
+        m1 = movie.from_string(data)
+        assert m1.actors[0] is not m1.actors[2]
+        table = InternTable()
+        m1 = movie.from_string(data,table)
+        m2 = movie.from_string(data,table)
+        self.assertEquals(m1,m)
+        assert m1.actors[0] is m1.actors[2]
+        assert m1.title is m2.title
+        self.assertEquals(len(table),3)
+        #  Size and length limits are respected
+        table = InternTable(maxsize=1,maxlength=8)
+        m1 = movie.from_string(data,table)
+        m2 = movie.from_string(data,table)
+        assert m1.title is m2.title
+        assert m1.actors[0] is not m2.actors[0]
+        #  Tuples are interned only on request
+        data = TwoTuples((1,"a"),(1,"a")).to_string()
+        v = TwoTuples.from_string(data,InternTable())
+        assert v.a is not v.b
+        v = TwoTuples.from_string(data,InternTable(tuples=True))
+        assert v.a is v.b
+        #  Equal tuples of different types are kept apart
+        table = InternTable(tuples=True)
+        data = MixedTuples((True,"x"),(1,"x"),(1.0,"x")).to_string()
+        for _ in xrange(2):
+            v = MixedTuples.from_string(data,table)
+            self.assertEquals(map(type,v.a + v.b + v.c),
+                              [bool,str,int,str,float,str])
+
+    def test_slot_storage(self):
+        m1 = movie(1,"Bad Eggs",["Mick Molloy","Judith Lucy"])
+        assert not hasattr(m1,"__dict__")
+        self.assertRaises(AttributeError,setattr,m1,"rating",5)
+        #  Overriding a field shifts the position of later inherited fields
+        class Remake(movie):
+            title = types.Field(types.Int)
+        m2 = Remake(2,["Mick Molloy"],2)
+        self.assertEquals(m2.actors,["Mick Molloy"])
+        self.assertEquals(m2.title,2)
+        self.assertEquals(Remake.from_string(m2.to_string()),m2)
+        self.assertEquals(movie.from_string(m1.to_string()),m1)
+        self.assertEquals(m1.actors,["Mick Molloy","Judith Lucy"])
+        #  Fields can be inherited along several paths from a common base,
+        #  but not from two unrelated message types.
+        class Sequel(Remake,movie):
+            pass
+        self.assertEquals(Sequel._ep_fields,Remake._ep_fields)
+        class Rating(types.Message):
+            stars = types.Field(types.Int)
+        try:
+            class RatedMovie(movie,Rating):
+                pass
+        except TypeError, e:
+            assert "more than one unrelated message type" in str(e)
+        else:
+            assert False, "multiple inheritance should fail"
+
+    def test_parsing_skips_conversion(self):
+        m1 = CountedStrings(["a","b","c"],{"d":"e"})
+        self.assertEquals(CountedString.num_converted,5)
+        m2 = CountedStrings.from_string(m1.to_string())
+        self.assertEquals(m1,m2)
+        self.assertEquals(CountedString.num_converted,5)
+        #  Mutation is still type-checked
+        self.assertRaises(ValueError,m2.items.append,7)
+        self.assertRaises(ValueError,operator.setitem,m2.map,"f",7)
+
+    def test_post_parse_hook(self):
+        class Tracked(types.Message):
+            name = types.Field(types.String)
+            num_inits = 0
+            def __init__(self,*args,**kwds):
+                Tracked.num_inits += 1
+                super(Tracked,self).__init__(*args,**kwds)
+        class Labelled(Tracked):
+            __slots__ = ("label",)
+            def _ep_post_parse(self):
+                self.label = self.name.upper()
+        t = Tracked.from_string(Tracked("hello").to_string())
+        self.assertEquals(t.name,"hello")
+        self.assertEquals(Tracked.num_inits,1)
+        l = Labelled.from_string(Labelled("hello").to_string())
+        self.assertEquals(l.label,"HELLO")
+        self.assertEquals(Tracked.num_inits,2)
+
+    def test_frozen_messages(self):
+        m1 = movie(1,"Bad Eggs",["Mick Molloy","Judith Lucy"])
+        self.assertEquals(len(set([m1,movie.from_string(m1.to_string())])),2)
+        assert not m1.frozen
+        assert m1.freeze() is m1
+        assert m1.frozen
+        self.assertRaises(AttributeError,setattr,m1,"title","Good Eggs")
+        data = m1.to_string()
+        assert m1.to_string() is data
+        m2 = movie.from_string(data).freeze()
+        self.assertEquals(m1,m2)
+        self.assertEquals(hash(m1),hash(m2))
+        self.assertEquals(len(set([m1,m2])),1)
+        #  Frozen children are spliced into the parent's output
+        c1 = recording.CD("Delta's Greatest Hits").freeze()
+        c2 = recording.CD("Delta's Greatest Hits")
+        class Collection(types.Message):
+            items = types.Field(types.List.build(recording))
+        self.assertEquals(Collection([c1]).to_string(),
+                          Collection([c2]).to_string())
+        self.assertEquals(Collection.from_string(Collection([c1]).to_string()),
+                          Collection([c2]))
+        #  Mutable fields can't be changed once frozen
+        class Counter(types.Message):
+            count = types.Field(types.Int,mutable=True)
+        c = Counter(1)
+        c.count = 2
+        c.freeze()
+        self.assertRaises(AttributeError,setattr,c,"count",3)
+        self.assertEquals(Counter.from_string(c.to_string()).count,2)
+
+    def test_incremental_encoding(self):
+        assert Document._ep_incremental
+        assert not movie._ep_incremental
+        d = Document("title","body",["tag"])
+        data = d.to_string()
+        self.assertEquals(data,types.serialize.to_string(d,Document))
+        RenderedString.num_rendered = 0
+        d.to_string()
+        #  Only the list field is rendered again
+        self.assertEquals(RenderedString.num_rendered,1)
+        d.title = "new title"
+        d.tags.append("another tag")
+        RenderedString.num_rendered = 0
+        data = d.to_string()
+        self.assertEquals(RenderedString.num_rendered,3)
+        self.assertEquals(Document.from_string(data),
+                          Document("new title","body",["tag","another tag"]))
+        #  Incremental messages are spliced into the parent's output
+        class Folder(types.Message):
+            docs = types.Field(types.List.build(Document))
+        f = Folder([d])
+        RenderedString.num_rendered = 0
+        self.assertEquals(Folder.from_string(f.to_string()),f)
+        self.assertEquals(RenderedString.num_rendered,2)
+        #  Custom render hooks on the message itself are respected
+        class Shouted(types.Message):
+            text = types.Field(types.String,mutable=True)
+            @classmethod
+            def _ep_render(cls,value):
+                values = [value.text.upper()]
+                return (values,types.serialize.TYPE_TUPLE,0)
+        data = Shouted("hello").to_string()
+        self.assertEquals(Shouted.from_string(data).text,"HELLO")
+        out = StringIO()
+        Shouted("hello").to_file(out)
+        self.assertEquals(out.getvalue(),data)
+
+    def test_canonical_encoding(self):
+        #  Colliding keys iterate in insertion order
+        m1 = IDs({0:"zero",8:"eight"})
+        m2 = IDs({8:"eight",0:"zero"})
+        self.assertEquals(m1,m2)
+        self.assertNotEquals(m1.to_string(),m2.to_string())
+        self.assertEquals(m1.to_string(canonical=True),
+                          m2.to_string(canonical=True))
+        self.assertEquals(IDs.from_string(m1.to_string(canonical=True)),m1)
+        self.assertEquals(hash(m1.freeze()),hash(m2.freeze()))
+
+    def test_fingerprint(self):
+        m1 = IDs({0:"zero",8:"eight"})
+        m2 = IDs({8:"eight",0:"zero"})
+        self.assertEquals(extprot.fingerprint(m1,IDs),
+                          extprot.fingerprint(m2,IDs))
+        self.assertNotEquals(extprot.fingerprint(m1,IDs),
+                             extprot.fingerprint(IDs({0:"zero"}),IDs))
+        #  Pre-rendered values don't change the fingerprint
+        class Catalogue(types.Message):
+            movies = types.Field(types.List.build(movie))
+            ids = types.Field(IDs)
+        movies = [movie(i,"movie %d" % (i,)) for i in xrange(10)]
+        c1 = Catalogue(movies,m1)
+        fp = extprot.fingerprint(c1,Catalogue)
+        c2 = Catalogue([m.freeze() for m in movies],m2.freeze())
+        self.assertEquals(extprot.fingerprint(c2,Catalogue),fp)
+        self.assertEquals(extprot.fingerprint(c1,Catalogue,"md5"),
+                          extprot.fingerprint(c2,Catalogue,"md5"))
+
+    def test_engines_agree(self):
+        from extprot import serialize
+        values = [0,1,-1,63,-64,2**31,-2**31,2**62,-2**63,2**63-1,2**64,-2**70]
+        for v in values:
+            m = BigNum(v)
+            self.assertEquals(m.to_string(),serialize.to_string(m,BigNum))
+            self.assertEquals(BigNum.from_string(m.to_string()),m)
+        m = movie(1,"Bad Eggs",["Mick Molloy","Judith Lucy"])
+        self.assertEquals(m.to_string(),serialize.to_string(m,movie))
+        for r in (recording.CD("Delta's Greatest Hits"),OnOff(True)):
+            self.assertEquals(r.to_string(),serialize.to_string(r,r.__class__))
+
+    def test_validation_policy(self):
+        from extprot.utils import validation, set_validation
+        from extprot.utils import VALIDATE_FULL, VALIDATE_SHALLOW, VALIDATE_NONE
+        self.assertRaises(ValueError,movie,1,"Bad Eggs",[7])
+        self.assertRaises(ValueError,set_validation,"sometimes")
+        try:
+            with validation(VALIDATE_SHALLOW):
+                m = movie(1,"Bad Eggs",[7])
+                self.assertEquals(m.actors,[7])
+                self.assertRaises(ValueError,movie,1,"Bad Eggs",7)
+                self.assertRaises(ValueError,movie,"one","Bad Eggs")
+            with validation(VALIDATE_NONE):
+                m = movie("one","Bad Eggs")
+                self.assertEquals(m.id,"one")
+            self.assertRaises(ValueError,movie,"one","Bad Eggs")
+            #  Per-type policies apply outside of any context
+            set_validation(VALIDATE_NONE,types.Int)
+            m = movie("one","Bad Eggs")
+            self.assertEquals(m.id,"one")
+            self.assertRaises(ValueError,movie,1,7)
+            with validation(VALIDATE_FULL):
+                self.assertRaises(ValueError,movie,"one","Bad Eggs")
+            #  Values that pass validation encode identically
+            set_validation(VALIDATE_SHALLOW)
+            m = movie(1,"Bad Eggs",["Mick Molloy"])
+            self.assertEquals(m.to_string(),
+                              movie(1,"Bad Eggs",["Mick Molloy"]).to_string())
+        finally:
+            types.Int._ep_validation = None
+            set_validation(VALIDATE_FULL)
+
+    def test_deep_sizeof(self):
+        from extprot.utils import deep_sizeof
+        m = movie(1,"Bad Eggs",["Mick Molloy","Judith Lucy"])
+        size = deep_sizeof(m)
+        assert size > sys.getsizeof(m) + deep_sizeof(m.actors)
+        #  Shared values are only counted once
+        self.assertEquals(deep_sizeof([m,m]),deep_sizeof([m]) + 8)
+        #  Interning reduces the size of parsed values
+        data = m.to_string()
+        ms = [movie.from_string(data) for _ in xrange(10)]
+        interner = InternTable()
+        ims = [movie.from_string(data,interner) for _ in xrange(10)]
+        assert deep_sizeof(ims) < deep_sizeof(ms)
+        #  Constant options and type classes are free
+        self.assertEquals(deep_sizeof(recording),0)
+        self.assertEquals(deep_sizeof(types.List.build(movie)),0)
 
+    def test_lazy_defaults(self):
+        import copy
+        m1 = movie(1,"Bad Eggs")
+        m2 = movie(2,"Crackerjack")
+        #  Empty containers are shared until accessed.
+        self.assertTrue(movie.actors._ep_slot.__get__(m1) is types._EMPTY)
+        self.assertEquals(m1.to_string(),movie(1,"Bad Eggs",[]).to_string())
+        m3 = copy.deepcopy(m2)
+        m1.actors.append("Mick Molloy")
+        self.assertEquals(m1.actors,["Mick Molloy"])
+        self.assertEquals(m2.actors,[])
+        self.assertEquals(m3.actors,[])
+        self.assertRaises(ValueError,m2.actors.append,7)
+        #  The same goes for fields missing from parsed data.
+        class Empty(types.Message):
+            pass
+        ids = IDs.from_string(Empty().to_string())
+        self.assertTrue(IDs.map._ep_slot.__get__(ids) is types._EMPTY)
+        self.assertEquals(ids.to_string(),IDs({}).to_string())
+        ids.map[7] = "seven"
+        self.assertEquals(IDs.from_string(ids.to_string()).map,{7:"seven"})
+        #  Constant defaults are cached on their type.
+        self.assertEquals(types._get_default(OnOff.is_on._ep_type),False)
+        self.assertTrue("_ep_default_cache" in types.Bool.__dict__)
+        self.assertRaises(extprot.UndefinedDefaultError,
+                          types._get_default,types.Int)
@@ -0,0 +1,109 @@
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from extprot import types
+from extprot import container
+from extprot import wiresize
+
+
+class phone(types.Union):
+    class Home(types.Option):
+        pass
+    class Work(types.Option):
+        _types = (types.Int,)
+
+class person(types.Message):
+    name = types.Field(types.String)
+    id = types.Field(types.Long)
+    age = types.Field(types.Int)
+    phones = types.Field(types.List.build(phone))
+
+class person_v2(types.Message):
+    name = types.Field(types.String)
+    id = types.Field(types.Long)
+    age = types.Field(types.Int)
+    phones = types.Field(types.List.build(phone))
+    emails = types.Field(types.Assoc.build(types.String,types.Bool))
+
+people = [person("Ryan",1,33,[phone.Home,phone.Work(2)]),
+          person("Lauren",2,130,[]),
+          person("Zoe",3,-4,[phone.Work(7)])]
+
+
+class TestWireSize(unittest.TestCase):
+
+    def test_paths(self):
+        p = wiresize.WireProfile(person)
+        for value in people:
+            p.add_value(value)
+        data = "".join(value.to_string() for value in people)
+        self.assertEquals(p.records,3)
+        self.assertEquals(p.total,len(data))
+        stats = dict((s.path,s) for s in p.paths())
+        self.assertEquals(sorted(stats),["","age","id","name","phones",
+                                         "phones[]","phones[].Work.0"])
+        self.assertEquals(stats["name"].count,3)
+        self.assertEquals(stats["name"].payload,len("RyanLaurenZoe"))
+        self.assertEquals(stats["name"].header,6)
+        self.assertEquals(stats["id"].payload,24)
+        self.assertEquals(stats["phones[]"].count,3)
+        self.assertEquals(stats["phones[].Work.0"].count,2)
+        #  Composite payloads include the full size of their items
+        self.assertEquals(stats[""].payload,
+                          sum(stats[path].total for path in
+                              ("name","id","age","phones")))
+
+    def test_suggestions(self):
+        p = wiresize.WireProfile(person)
+        p.add_file(StringIO("".join(value.to_string() for value in people)))
+        suggestions = dict((path,(msg,saving)) for (path,msg,saving)
+                           in p.suggestions())
+        #  Each id would take 1 byte as a vint instead of 8
+        self.assertEquals(suggestions["id"][1],21)
+        #  Ages don't fit in a byte, but the phone numbers do
+        assert "age" not in suggestions
+        assert "phones[].Work.0" not in suggestions
+        assert "Int" in suggestions["id"][0]
+        p = wiresize.WireProfile(person)
+        p.add_value(person("Old",4,2**62,[phone.Work(200)]))
+        suggestions = dict((path,(msg,saving)) for (path,msg,saving)
+                           in p.suggestions())
+        #  A large Int takes 10 bytes as a vint
+        self.assertEquals(suggestions["age"],
+                          ("Int values would be smaller as Long",2))
+        self.assertEquals(suggestions["phones[].Work.0"],
+                          ("Int values would all fit in a Byte",1))
+
+    def test_unknown_fields(self):
+        p = wiresize.WireProfile(person)
+        p.add_string(person_v2("Ryan",1,33,[],{"ryan@rfk.id.au":True}).to_string())
+        stats = dict((s.path,s) for s in p.paths())
+        self.assertEquals(stats["<4>"].count,1)
+        self.assertEquals(stats["<4>{key}"].count,1)
+        self.assertEquals(stats["<4>{key}"].payload,len("ryan@rfk.id.au"))
+        self.assertEquals(stats["<4>{value}"].count,1)
+
+    def test_container_and_script(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tdir,"people.epc")
+            with open(fn,"wb") as f:
+                w = container.ContainerWriter(f,person)
+                for value in people:
+                    w.write(value)
+                w.close()
+            p = wiresize.WireProfile(person)
+            with open(fn,"rb") as f:
+                p.add_container(container.ContainerReader(f,person))
+            self.assertEquals(p.records,3)
+            report = p.report()
+            assert "(record)" in report
+            assert "Long values would be smaller as Int" in report
+            self.assertEquals(json.loads(json.dumps(p.to_dict()))["records"],3)
+        finally:
+            shutil.rmtree(tdir)
@@ -29,9 +29,13 @@ this object structure automatically from a .proto source file.
 import sys
 import struct
 from itertools import izip
+from operator import attrgetter
 
 from extprot.errors import *
+from extprot import utils
 from extprot.utils import TypedList, TypedDict
+from extprot.utils import VALIDATE_FULL, VALIDATE_SHALLOW, VALIDATE_NONE
+from extprot.utils import set_validation, get_validation, validation
 
 try:
     from extprot import _serialize as serialize
@@ -57,6 +61,10 @@ class _TypeMetaclass(type):
     """
 
     def __new__(mcls,name,bases,attrs):
+        #  A per-type validation policy must switch on policy lookups.
+        if attrs.get("_ep_validation") is not None:
+            utils._check_validation_level(attrs["_ep_validation"])
+            utils._validation_active = True
         cls = super(_TypeMetaclass,mcls).__new__(mcls,name,bases,attrs)
         cls._ep_make_typedesc()
         #  Now that the class dict has been processed, we can give it
@@ -130,6 +138,7 @@ class Type(object):
     interesting class-level methods:
 
         _ep_convert:        convert a python value to standard type repr
+        _ep_convert_shallow: convert without checking any contained values
         _ep_default:        get the default value for type, if any
 
     And these interesting hooks for customizing the serialization process:
@@ -146,6 +155,7 @@ class Type(object):
     """
 
     __metaclass__ = _TypeMetaclass
+    __slots__ = ()
 
     _types = ()
     _unbound_types = ()
@@ -153,12 +163,22 @@ class Type(object):
     _ep_typedesc_class = serialize.SingleTypeDesc
     _ep_primtype = 0
     _ep_tag = 0
+    _ep_validation = None
 
     @classmethod
     def _ep_convert(cls,value):
         """Convert a python value into internal representation."""
         return value
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        """Convert a python value without checking its contents.
+
+        This is used under the VALIDATE_SHALLOW policy.  For types that
+        don't contain other values it's the same as _ep_convert.
+        """
+        return cls._ep_convert(value)
+
     @classmethod
     def _ep_convert_types(cls,values,types=None):
         """Convert a sequence of values using a type tuple.
@@ -173,9 +193,9 @@ class Type(object):
             try:
                 v = values.next()
             except StopIteration:
-                yield t._ep_default()
+                yield _get_default(t)
             else:
-                yield t._ep_convert(v)
+                yield utils.convert(t,v)
         try:
             values.next()
         except StopIteration:
@@ -191,14 +211,24 @@ class Type(object):
         return Anon
 
     @classmethod
-    def from_string(cls,string):
-        """Read a value of this type from a string."""
-        return serialize.from_string(string,cls)
+    def from_string(cls,string,interner=None,blob_threshold=None):
+        """Read a value of this type from a string.
+
+        If an InternTable is given as 'interner', parsed values will be
+        de-duplicated using that table.  If 'blob_threshold' is given, String
+        values at least that long are returned as views into the string.
+        """
+        return serialize.from_string(string,cls,interner,blob_threshold)
 
     @classmethod
-    def from_file(cls,file):
-        """Read a value of this type from a file-like object."""
-        return serialize.from_file(file,cls)
+    def from_file(cls,file,interner=None,blob_threshold=None):
+        """Read a value of this type from a file-like object.
+
+        If an InternTable is given as 'interner', parsed values will be
+        de-duplicated using that table.  If 'blob_threshold' is given, String
+        values at least that long are returned as lazy utils.Blob handles.
+        """
+        return serialize.from_file(file,cls,interner,blob_threshold)
 
     def __eq__(self,other):
         return self is other
@@ -292,7 +322,7 @@ class String(Type):
     def _ep_convert(cls,value):
         if isinstance(value,unicode):
             value = value.encode("ascii")
-        elif not isinstance(value,str):
+        elif not isinstance(value,(str,memoryview,buffer,utils.Blob)):
             raise ValueError("not a valid String: " + repr(value))
         return value
 
@@ -319,6 +349,12 @@ class Tuple(Type):
         except TypeError:
             raise ValueError("not a valid Tuple")
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        if isinstance(value,tuple) and len(value) == len(cls._types):
+            return value
+        return cls._ep_convert(value)
+
     @classmethod
     def _ep_collection(cls):
         return []
@@ -344,6 +380,13 @@ class List(Type):
         except TypeError:
             raise ValueError("not a valid List")
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        try:
+            return TypedList(cls._types[0],value,trusted=True)
+        except TypeError:
+            raise ValueError("not a valid List")
+
     @classmethod
     def _ep_default(cls):
         return TypedList(cls._types[0])
@@ -374,6 +417,13 @@ class Array(Type):
         except TypeError:
             raise ValueError("not a valid List")
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        try:
+            return TypedList(cls._types[0],value,trusted=True)
+        except TypeError:
+            raise ValueError("not a valid List")
+
     @classmethod
     def _ep_default(cls):
         return TypedList(cls._types[0])
@@ -404,6 +454,13 @@ class Assoc(Type):
         except TypeError:
             raise ValueError("not a valid Dict")
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        try:
+            return TypedDict(cls._types[0],cls._types[1],value,trusted=True)
+        except (TypeError,ValueError):
+            raise ValueError("not a valid Dict")
+
     @classmethod
     def _ep_default(cls):
         return TypedDict(cls._types[0],cls._types[1])
@@ -413,13 +470,21 @@ class Assoc(Type):
         return TypedDict(cls._types[0],cls._types[1])
 
 
+#  Fields whose type uses one of these default methods are filled with the
+#  shared _EMPTY placeholder; see Field._ep_is_lazy().
+_lazy_defaults = (List.__dict__["_ep_default"].__func__,
+                  Array.__dict__["_ep_default"].__func__,
+                  Assoc.__dict__["_ep_default"].__func__,)
+
+
 
 class _OptionMetaclass(_TypeMetaclass):
     """Metaclass for Option type.
 
     This metaclass is responsible for populating Option._ep_creation_order with
     an increasing number indicating the order in which subclasses were created,
-    and setting _ep_primtype to either TYPE_TUPLE or TYPE_ENUM.
+    and setting _ep_primtype to either TYPE_TUPLE or TYPE_ENUM.  Like messages,
+    option instances keep their values in a slot rather than an instance dict.
     """
 
     _ep_creation_counter = 0
@@ -429,6 +494,7 @@ class _OptionMetaclass(_TypeMetaclass):
             attrs["_ep_primtype"] = serialize.TYPE_ENUM
         else:
             attrs["_ep_primtype"] = serialize.TYPE_TUPLE
+        attrs.setdefault("__slots__",())
         cls = super(_OptionMetaclass,mcls).__new__(mcls,name,bases,attrs)
         cls._ep_creation_order = mcls._ep_creation_counter
         mcls._ep_creation_counter += 1
@@ -451,6 +517,8 @@ class Option(Type):
     """
 
     __metaclass__ = _OptionMetaclass
+    __slots__ = ("_ep_values",)
+    _ep_typedesc_class = serialize.OptionTypeDesc
 
     def __new__(cls,*values):
         """Custom instance constructor to special-case constant options.
@@ -472,7 +540,7 @@ class Option(Type):
         return self._ep_values[index]
 
     def __setitem__(self,index,value):
-        self._ep_values[index] = self._types[index]._ep_convert(value)
+        self._ep_values[index] = utils.convert(self._types[index],value)
 
     def __len__(self):
         return len(self._ep_values)
@@ -480,6 +548,12 @@ class Option(Type):
     def __eq__(self,other):
         return self._ep_values == other._ep_values
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        if isinstance(value,cls) or value is cls:
+            return value
+        return cls._ep_convert(value)
+
     @classmethod
     def _ep_convert(cls,value):
         if isinstance(value,cls):
@@ -512,15 +586,6 @@ class Option(Type):
                 value = (value,)
         return cls(*value)
 
-    @classmethod
-    def _ep_parse(cls,value,type,tag):
-        if type != cls._ep_primtype:
-            raise UnexpectedWireTypeError(type,cls._ep_primtype)
-        if not cls._types:
-            return cls
-        else:
-            return cls(*value)
-
     @classmethod
     def _ep_collection(cls):
         return []
@@ -540,7 +605,8 @@ class Field(object):
 
     Through some metaclass magic on the Message class, Field instances come
     to know the name (self._ep_name) and index (self._ep_index) by which they
-    are attached to a message.
+    are attached to a message, and the slot descriptor (self._ep_slot) in
+    which their value is stored.
     """
 
     _ep_creation_counter = 0
@@ -555,22 +621,86 @@ class Field(object):
         if obj is None:
             return self
         try:
-            value = obj.__dict__[self._ep_name]
-        except KeyError:
+            value = self._ep_slot.__get__(obj,type)
+        except AttributeError:
+            value = _get_default(self._ep_type)
+            self._ep_slot.__set__(obj,value)
+            return value
+        #  Empty containers are only created when first accessed.
+        if value is _EMPTY:
             value = self._ep_type._ep_default()
-            obj.__dict__[self._ep_name] = value
+            self._ep_slot.__set__(obj,value)
         return value
 
     def __set__(self,obj,value):
-        if not self.mutable and obj._ep_initialized:
+        try:
+            initialized = obj._ep_initialized
+            frozen = obj._ep_encoded is not None
+        except AttributeError:
+            initialized = frozen = False
+        if frozen:
+            raise AttributeError("Message is frozen")
+        if initialized and not self.mutable:
             raise AttributeError("Field '"+self._ep_name+"' is not mutable")
-        if value is None:
+        if value is None and self._ep_is_lazy():
+            value = _EMPTY
+        else:
+            if value is None:
+                try:
+                    value = _get_default(self._ep_type)
+                except UndefinedDefaultError:
+                    msg = "value required for field " + self._ep_name
+                    raise UndefinedDefaultError(msg)
+            if utils._validation_active:
+                value = utils.convert(self._ep_type,value)
+            else:
+                value = self._ep_type._ep_convert(value)
+        self._ep_slot.__set__(obj,value)
+        #  Invalidate any cached serialization of the field.
+        if initialized and obj._ep_incremental:
+            try:
+                cache = obj._ep_cache
+            except AttributeError:
+                pass
+            else:
+                cache[self._ep_index] = None
+
+    def _ep_is_cacheable(self):
+        """Check whether the serialized value of this field can be cached.
+
+        This is true if the field's value cannot be modified in-place, so
+        the only way to change it is via Field.__set__.
+        """
+        try:
+            return self._ep_cacheable
+        except AttributeError:
+            self._ep_cacheable = _is_immutable_type(self._ep_type)
+            return self._ep_cacheable
+
+    def _ep_is_lazy(self):
+        """Check whether the default value of this field is created lazily.
+
+        This is true for fields of List, Array and Assoc types that use the
+        standard empty default.  They are filled in with the shared _EMPTY
+        placeholder, which is replaced by a real container on first access.
+        """
+        try:
+            return self._ep_lazy
+        except AttributeError:
             try:
-                value = self._ep_type._ep_default()
-            except UndefinedDefaultError:
-                msg = "value required for field " + self._ep_name
-                raise UndefinedDefaultError(msg)
-        obj.__dict__[self._ep_name] = self._ep_type._ep_convert(value)
+                default = self._ep_type._ep_default.im_func
+            except AttributeError:
+                self._ep_lazy = False
+            else:
+                self._ep_lazy = default in _lazy_defaults
+            return self._ep_lazy
+
+    def _ep_copy(self):
+        """Make a copy of this field, for re-use in another message."""
+        f = self.__class__(self._ep_type,mutable=self.mutable)
+        f._ep_creation_order = self._ep_creation_order
+        f._ep_name = self._ep_name
+        return f
 
 
 
@@ -581,6 +711,13 @@ class _MessageMetaclass(_TypeMetaclass):
     with an increasing number indicating the order in which subclasses were
     created, setting the _ep_name and _ep_index properties on contained Field
     instances, and creating cls._types as a tuple of contained field types.
+
+    Field values are stored in slots named "_ep_field<index>" rather than in
+    an instance dict, so this metaclass also generates cls.__slots__ for any
+    fields not covered by the slots of the base classes.  Messages that are
+    serialized incrementally get an additional slot "_ep_cache".  As a
+    result, a message type can't have two unrelated message base classes
+    that both have fields.
     """
 
     _ep_creation_counter = 0
@@ -591,24 +728,48 @@ class _MessageMetaclass(_TypeMetaclass):
         names = {}
         for (nm,val) in attrs.iteritems():
             if isinstance(val,Field):
+                val._ep_name = nm
                 fields.append((val._ep_creation_order,nm,val))
                 names[nm] = True
         fields.sort()
         #  Find all base Field instances that haven't been overridden.
         bfields = []
+        nslots = 0
         for base in bases:
             if issubclass(base,Message):
+                nslots = max(nslots,len(base._ep_fields))
                 for f in base._ep_fields:
                     if f._ep_name not in names:
                         bfields.append(f)
                         names[f._ep_name] = True
-        #  Merge fields and bfields into the final fields tuple.
-        attrs["_ep_fields"] = tuple(f for f in bfields)
-        attrs["_ep_fields"] = attrs["_ep_fields"]+tuple(f for (_,_,f) in fields)
-        #  Label each field with its name and index in the message
-        for (i,(_,nm,f)) in enumerate(fields):
-            f._ep_index = i + len(bfields)
-            f._ep_name = nm
+        #  Merge fields and bfields into the final fields list.
+        all_fields = bfields + [f for (_,_,f) in fields]
+        #  Label each field with its index in the message.  Inherited fields
+        #  that have changed position must be copied, since the base class
+        #  still expects to find them at their original index.
+        for (i,f) in enumerate(all_fields):
+            if i < len(bfields) and f._ep_index != i:
+                f = f._ep_copy()
+                attrs[f._ep_name] = f
+                all_fields[i] = f
+            f._ep_index = i
+        attrs["_ep_fields"] = tuple(all_fields)
+        #  Generate slots for any fields not covered by the base classes.
+        slots = attrs.get("__slots__",())
+        if isinstance(slots,basestring):
+            slots = (slots,)
+        slots = tuple(slots)
+        for i in xrange(nslots,len(all_fields)):
+            slots += (_field_slot_name(i),)
+        if "_ep_incremental" not in attrs:
+            attrs["_ep_incremental"] = any(f.mutable for f in all_fields)
+        if attrs["_ep_incremental"]:
+            for base in bases:
+                if hasattr(base,"_ep_cache"):
+                    break
+            else:
+                slots += ("_ep_cache",)
+        attrs["__slots__"] = slots
         #  Add the field types to cls._types
         attrs["_types"] = tuple(f._ep_type for f in attrs["_ep_fields"])
         #  Ensure it gets a new TypeDesc object
@@ -620,13 +781,81 @@ class _MessageMetaclass(_TypeMetaclass):
                     pass
                 else:
                     break
-        #  Finally we can create the class
-        cls = super(_MessageMetaclass,mcls).__new__(mcls,name,bases,attrs)
+        #  Finally we can create the class.  Since each message type has its
+        #  own slot layout, it can't inherit from two unrelated message types
+        #  that both have fields.
+        try:
+            cls = super(_MessageMetaclass,mcls).__new__(mcls,name,bases,attrs)
+        except TypeError:
+            mbases = [b for b in bases if issubclass(b,Message)]
+            if len(mbases) > 1:
+                msg = "message type %s can't inherit fields from more than"
+                msg += " one unrelated message type: %s"
+                msg = msg % (name,", ".join(b.__name__ for b in mbases))
+                raise TypeError(msg)
+            raise
+        for f in cls._ep_fields:
+            f._ep_slot = getattr(cls,_field_slot_name(f._ep_index))
+        cls._ep_getvalues = staticmethod(_values_getter(len(cls._ep_fields)))
+        cls._ep_setvalues = staticmethod(_values_setter(len(cls._ep_fields)))
         cls._ep_creation_order = mcls._ep_creation_counter
         mcls._ep_creation_counter += 1
         return cls
 
 
+def _field_slot_name(index):
+    """Get the name of the slot used to store the field at given index."""
+    return "_ep_field%d" % (index,)
+
+
+_values_getters = {}
+
+def _values_getter(nfields):
+    """Get a function returning the tuple of field values from a message.
+
+    This is used to quickly extract all values for rendering.  If any field
+    has not been set, it will raise AttributeError.
+    """
+    try:
+        return _values_getters[nfields]
+    except KeyError:
+        names = [_field_slot_name(i) for i in xrange(nfields)]
+        if nfields == 0:
+            getter = lambda obj: ()
+        elif nfields == 1:
+            getter1 = attrgetter(names[0])
+            getter = lambda obj: (getter1(obj),)
+        else:
+            getter = attrgetter(*names)
+        _values_getters[nfields] = getter
+        return getter
+
+
+_values_setters = {}
+
+def _values_setter(nfields):
+    """Get a function that initializes a message from a list of values.
+
+    This is used to quickly fill in a new message instance when parsing.
+    It sets each field slot directly, without any conversion, and marks
+    the message as initialized and not frozen.
+    """
+    try:
+        return _values_setters[nfields]
+    except KeyError:
+        src = ["def _ep_setvalues(inst,values):"]
+        if nfields:
+            names = ["inst."+_field_slot_name(i) for i in xrange(nfields)]
+            src.append("    (%s,) = values" % (",".join(names),))
+        src.append("    inst._ep_initialized = True")
+        src.append("    inst._ep_encoded = None")
+        namespace = {}
+        exec "\n".join(src) in namespace
+        setter = namespace["_ep_setvalues"]
+        _values_setters[nfields] = setter
+        return setter
+
+
 class Message(Type):
     """Fake composed message type.
 
@@ -643,31 +872,57 @@ class Message(Type):
 
     This is the basic unit of data transfer in extprot, and is basically
     a set of typed key-value pairs.
+
+    Field values are stored in slots rather than an instance dict, so you
+    can't set arbitrary attributes on a message instance.  If you need to,
+    declare them in the __slots__ attribute of your subclass.
+
+    Messages parsed from a bytestream are constructed directly, without
+    calling __init__.  If your subclass needs to do some processing on
+    parsed instances, define a method named "_ep_post_parse" and it will
+    be called on each instance after its fields have been filled in.
+
+    Messages hash by identity unless they have been frozen by calling the
+    freeze() method, after which none of their fields can be changed and
+    they hash by value.  Freeze a message before adding it to a set or dict.
+
+    Messages with mutable fields are serialized incrementally: the output
+    for each field is cached, and only fields that have been changed since
+    the last call to to_string() are serialized again.  Fields containing
+    mutable values such as lists are always serialized in full.  To turn
+    this on or off explicitly, set "_ep_incremental" in the class body.
     """
 
     __metaclass__ = _MessageMetaclass
+    __slots__ = ("_ep_initialized","_ep_encoded",)
 
     _ep_primtype = serialize.TYPE_TUPLE
     _ep_typedesc_class = serialize.MessageTypeDesc
-    _ep_initialized = False
+    _ep_post_parse = None
 
     def __init__(self,*args,**kwds):
-        if not self._ep_initialized:
-            #  Process positional and keyword arguments as Field values
-            if len(args) > len(self._types):
-                raise TypeError("too many positional arguments to Message")
-            for (f,v) in izip(self._ep_fields,args):
+        try:
+            if self._ep_initialized:
+                return
+        except AttributeError:
+            pass
+        self._ep_initialized = False
+        self._ep_encoded = None
+        #  Process positional and keyword arguments as Field values
+        if len(args) > len(self._types):
+            raise TypeError("too many positional arguments to Message")
+        for (f,v) in izip(self._ep_fields,args):
+            f.__set__(self,v)
+        for f in self._ep_fields[len(args):]:
+            try:
+                v = kwds.pop(f._ep_name)
+            except KeyError:
+                f.__set__(self,None)
+            else:
                 f.__set__(self,v)
-            for f in self._ep_fields[len(args):]:
-                try:
-                    v = kwds.pop(f._ep_name)
-                except KeyError:
-                    f.__set__(self,None)
-                else:
-                    f.__set__(self,v)
-            if kwds:
-                raise TypeError("too many keyword arguments to Message")
-            self._ep_initialized = True
+        if kwds:
+            raise TypeError("too many keyword arguments to Message")
+        self._ep_initialized = True
 
     @classmethod
     def _ep_convert(cls,value):
@@ -687,17 +942,114 @@ class Message(Type):
     def _ep_collection(cls):
         return []
 
-    def to_string(self):
-        """Serialize this message to a string."""
-        return serialize.to_string(self,self.__class__)
+    @classmethod
+    def _ep_make_defaults(cls):
+        """Precompute the values used to fill in fields missing when parsing.
+
+        This is called by the typedesc the first time it needs a default,
+        and returns a tuple suitable for its "defaults" attribute.
+        """
+        defaults = []
+        for f in cls._ep_fields:
+            if f._ep_is_lazy():
+                defaults.append((_EMPTY,None))
+            else:
+                defaults.extend(_default_values((f._ep_type,)))
+        return tuple(defaults)
+
+    def to_string(self,canonical=False):
+        """Serialize this message to a string.
+
+        If 'canonical' is true, the entries of any Assoc fields are written
+        in a fixed order so that equal messages give identical strings.
+        Frozen messages and messages with mutable fields are always written
+        in canonical form, whatever the value of 'canonical'.
+        """
+        if self._ep_encoded is not None:
+            return self._ep_encoded
+        return serialize.to_string(self,self.__class__,canonical)
+
+    def to_file(self,file,canonical=False):
+        """Serialize this message to a file-like object.
+
+        As with to_string(), frozen messages and messages with mutable
+        fields are always written in canonical form.
+        """
+        if self._ep_encoded is not None:
+            file.write(self._ep_encoded)
+        else:
+            serialize.to_file(file,self,self.__class__,canonical)
+
+    def _ep_render_incremental(self):
+        """Serialize this message, re-using cached output for each field.
 
-    def to_file(self,file):
-        """Serialize this message to a file-like object."""
-        serialize.to_file(file,self,self.__class__)
+        The serialized form of each cacheable field is kept in the slot
+        "_ep_cache", and Field.__set__ clears the entry for a field when
+        its value changes.  Only the missing entries need to be rendered,
+        after which the pieces are joined to form the complete message.
+
+        The output is always in canonical form, so that it can be spliced
+        into the output of a canonical stream.
+        """
+        fields = self._ep_fields
+        try:
+            cache = self._ep_cache
+        except AttributeError:
+            cache = self._ep_cache = [None] * len(fields)
+        chunks = [None,None,serialize.encode_vint(len(fields))]
+        length = len(chunks[2])
+        for (i,f) in enumerate(fields):
+            data = cache[i]
+            if data is None:
+                value = f.__get__(self)
+                data = serialize._to_string(value,f._ep_type,True)
+                if f._ep_is_cacheable():
+                    cache[i] = data
+            chunks.append(data)
+            length += len(data)
+        chunks[0] = serialize.encode_vint(self._ep_tag << 4 | self._ep_primtype)
+        chunks[1] = serialize.encode_vint(length)
+        return "".join(chunks)
+
+    def freeze(self):
+        """Make this message immutable, and memoize its serialized form.
+
+        After calling this method, attempts to set any field on the message
+        will raise AttributeError.  The message is serialized once and the
+        result is re-used by every subsequent call to to_string(), and is
+        spliced directly into the output when the message is rendered as
+        part of a larger structure.  Frozen messages hash by value, and are
+        serialized in canonical form so that equal messages hash equally.
+        Other messages hash by identity, so a message's hash changes when it
+        is frozen; freeze it before adding it to a set or dict.
+
+        It's up to you not to modify any lists or other mutable containers
+        in a frozen message; such changes would not be reflected in its
+        serialized form.
+
+        For convenience, the message itself is returned.
+        """
+        if self._ep_encoded is None:
+            self._ep_encoded = serialize.to_string(self,self.__class__,True)
+        return self
+
+    @property
+    def frozen(self):
+        """True if freeze() has been called on this message."""
+        return self._ep_encoded is not None
+
+    def __hash__(self):
+        #  Unfrozen messages hash by identity, as they always have.
+        if self._ep_encoded is None:
+            return object.__hash__(self)
+        return hash(self._ep_encoded)
 
     def __eq__(self,msg):
         if self.__class__ != msg.__class__:
             return False
+        if self._ep_encoded is not None:
+            if self._ep_encoded == msg._ep_encoded:
+                return True
         for f in self._ep_fields:
             if f.__get__(self) != f.__get__(msg):
                 return False
@@ -717,6 +1069,121 @@ class Message(Type):
         return (_unpickle_message,args)
 
 
+def _is_immutable_type(typ,seen=None):
+    """Check whether values of the given type are immutable.
+
+    Primitive types are immutable, as are composed types that contain only
+    immutable types.  Lists and Assocs are always mutable, as are messages
+    with mutable fields.
+    """
+    if seen is None:
+        seen = set()
+    if typ in seen:
+        return True
+    seen.add(typ)
+    if not _issubclass(typ,Type):
+        return False
+    if issubclass(typ,(List,Array,Assoc)):
+        return False
+    if issubclass(typ,Message):
+        for f in typ._ep_fields:
+            if f.mutable:
+                return False
+    for t in typ._types:
+        if not _is_immutable_type(t,seen):
+            return False
+    return True
+
+
+class _EmptyContainer(tuple):
+    """Shared placeholder for the empty default value of a container field.
+
+    Message fields of List, Array or Assoc type start out holding the single
+    instance _EMPTY rather than a new empty container, which Field.__get__
+    replaces with a real one when the field is first accessed.  It renders
+    as an empty HTuple or Assoc, so untouched fields cost nothing.
+    """
+
+    __slots__ = ()
+
+    def iteritems(self):
+        return iter(())
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self,memo):
+        return self
+
+    def __reduce__(self):
+        return "_EMPTY"
+
+_EMPTY = _EmptyContainer()
+
+
+def _get_default(typ):
+    """Get the default value for the given type.
+
+    Defaults that can be safely shared, such as those of primitive types or
+    the constant option of a Union, are computed once and cached on the type.
+    """
+    try:
+        (value,shared) = typ.__dict__["_ep_default_cache"]
+    except KeyError:
+        try:
+            value = typ._ep_default()
+        except UndefinedDefaultError:
+            typ._ep_default_cache = (None,False)
+            raise
+        shared = _is_constant(value)
+        typ._ep_default_cache = (value,shared)
+        return value
+    if shared:
+        return value
+    return typ._ep_default()
+
+
+def _default_values(types,strict=False):
+    """Precompute the default values for the given types.
+
+    This returns a list of (value,typdesc) pairs, as used for the "defaults"
+    attribute of typedescs.  Defaults that can safely be shared are computed
+    now and given with a typdesc of None; the rest must be created each time
+    by calling typdesc.default_value().  If 'strict' is true, types without
+    a default raise UndefinedDefaultError rather than waiting until one is
+    needed.
+    """
+    defaults = []
+    for t in types:
+        try:
+            value = _get_default(t)
+        except UndefinedDefaultError:
+            if strict:
+                raise
+            defaults.append((None,t._ep_typedesc))
+        else:
+            if _is_constant(value):
+                defaults.append((value,None))
+            else:
+                defaults.append((None,t._ep_typedesc))
+    return defaults
+
+
+def _is_constant(value):
+    """Check whether a default value can be shared between values."""
+    if value is None or isinstance(value,(bool,int,long,float,basestring)):
+        return True
+    #  Constant options of a union are represented by their class.
+    if isinstance(value,type):
+        return True
+    if value.__class__ is tuple:
+        for item in value:
+            if not _is_constant(item):
+                return False
+        return True
+    return False
+
+
 def _unpickle_message(module,name,data):
     """Helper function for unpickling of Message insances."""
     mname = module.split(".")[-1]
@@ -733,7 +1200,9 @@ class _UnionMetaclass(_TypeMetaclass):
 
     This metaclass is responsible for populating Union._types with a tuple
     of the declared option types, and Union._ep_tag_map with a mapping from
-    (type,tag) values to individual Option or Message type classes.
+    (type,tag) values to individual Option or Message type classes.  The
+    typedesc of each option is also registered with the union's typedesc,
+    which uses them to dispatch parsing without going through Python code.
     """
 
     def __new__(mcls,name,bases,attrs):
@@ -799,6 +1268,7 @@ class _UnionMetaclass(_TypeMetaclass):
         super(_UnionMetaclass,cls)._ep_make_typedesc()
         cls._ep_typedesc.collection_constructor = collection_constructor
         cls._ep_typedesc.subtypes = subtypes
+        cls._ep_typedesc.set_options([t._ep_typedesc for t in cls._types])
 
 
 
@@ -837,6 +1307,7 @@ class Union(Type):
     """
 
     __metaclass__ = _UnionMetaclass
+    _ep_typedesc_class = serialize.UnionTypeDesc
 
     @classmethod
     def _ep_convert(cls,value):
@@ -850,6 +1321,13 @@ class Union(Type):
         msg += " to Union type " + repr(cls)
         raise ValueError(msg)
 
+    @classmethod
+    def _ep_convert_shallow(cls,value):
+        for t in cls._types:
+            if isinstance(value,t) or value is t:
+                return value
+        return cls._ep_convert(value)
+
     @classmethod
     def _ep_default(cls):
         for t in cls._types:
@@ -860,30 +1338,24 @@ class Union(Type):
         raise UndefinedDefaultError
 
     @classmethod
-    def _ep_parse(cls,value,type,tag):
-        try:
-            subtype = cls._ep_tag_map[(type,tag)]
-        except KeyError:
-            #  Try to promote it from a primitive type to the first
-            #  non-constant option in this union.
-            for opt in cls._types:
-                if opt._types:
-                    items = [opt._types[0]._ep_parse(value,type,tag)]
-                    try:
-                        items.extend(t._ep_default() for t in opt._types[1:])
-                    except UndefinedDefaultError:
-                        err = "could not promote primitive to Union type"
-                        raise ParseError(err)
-                    return opt(*items)
-            else:
-                err = "could not promote primitive to Union type"
-                raise ParseError(err)
-        else:
-            return subtype._ep_parse(value,type,tag)
+    def _ep_promote(cls,value,type,tag):
+        """Parse a value whose (type,tag) doesn't match any of our options.
 
-    @classmethod
-    def _ep_render(cls,value):
-        return value._ep_typedesc.render_value(value)
+        This tries to promote it from a primitive type to the first
+        non-constant option in this union.
+        """
+        for opt in cls._types:
+            if opt._types:
+                items = [opt._types[0]._ep_parse(value,type,tag)]
+                try:
+                    items.extend(_get_default(t) for t in opt._types[1:])
+                except UndefinedDefaultError:
+                    err = "could not promote primitive to Union type"
+                    raise ParseError(err)
+                return opt(*items)
+        else:
+            err = "could not promote primitive to Union type"
+            raise ParseError(err)
 
    
 class Unbound(Type):
@@ -5,21 +5,124 @@
 
 """
 
+import sys
+import threading
+from contextlib import contextmanager
+
+from extprot.errors import UnexpectedEOFError
+
+
+#  Validation policies for converting values into their internal repr.
+VALIDATE_FULL = "full"
+VALIDATE_SHALLOW = "shallow"
+VALIDATE_NONE = "none"
+
+_default_validation = VALIDATE_FULL
+
+#  This is false until a non-default policy has been requested, so that
+#  convert() can skip the policy lookup in the common case.
+_validation_active = False
+
+class _ValidationState(threading.local):
+    """Per-thread state for the validation() context manager."""
+    level = None
+
+_validation_state = _ValidationState()
+
+
+def _check_validation_level(level):
+    if level not in (VALIDATE_FULL,VALIDATE_SHALLOW,VALIDATE_NONE):
+        raise ValueError("unknown validation level: " + repr(level))
+
+
+def set_validation(level,typcls=None):
+    """Set the validation policy used when converting values.
+
+    The level must be one of VALIDATE_FULL, VALIDATE_SHALLOW or VALIDATE_NONE.
+    With full validation (the default) every value stored in a message or
+    container is converted and type-checked, including the contents of any
+    containers.  With shallow validation only the value itself is checked,
+    and containers are built without checking their items.  With no
+    validation values are stored exactly as given.
+
+    If 'typcls' is given then the policy applies only to values of that type,
+    otherwise it applies to all types that don't have their own policy.
+    """
+    global _default_validation, _validation_active
+    _check_validation_level(level)
+    if typcls is None:
+        _default_validation = level
+    else:
+        typcls._ep_validation = level
+    _validation_active = True
+
+
+def get_validation(typcls):
+    """Get the validation policy in effect for the given type."""
+    level = _validation_state.level
+    if level is None:
+        level = typcls._ep_validation
+        if level is None:
+            level = _default_validation
+    return level
+
+
+@contextmanager
+def validation(level):
+    """Context manager to set the validation policy for the current thread.
+
+    Within the context, the given policy applies to all types, overriding
+    any global or per-type policy:
+
+        with validation(VALIDATE_NONE):
+            msg = person(7,"Guido")
+
+    """
+    global _validation_active
+    _check_validation_level(level)
+    _validation_active = True
+    old_level = _validation_state.level
+    _validation_state.level = level
+    try:
+        yield
+    finally:
+        _validation_state.level = old_level
+
+
+def convert(typcls,value):
+    """Convert a value to the given type, according to validation policy."""
+    if not _validation_active:
+        return typcls._ep_convert(value)
+    level = get_validation(typcls)
+    if level == VALIDATE_FULL:
+        return typcls._ep_convert(value)
+    if level == VALIDATE_SHALLOW:
+        return typcls._ep_convert_shallow(value)
+    return value
+
 
 class TypedList(list):
     """Subclass of built-in list type that contains type-checked values.
 
     Instances of TypedList are the canonical internal representation
-    for the List and Array extprot types.
+    for the List and Array extprot types.  If 'trusted' is true, the
+    initial items are not checked.
     """
 
-    def __init__(self,type,items=()):
+    def __init__(self,type,items=(),trusted=False):
         self._type = type
-        items = [self._type._ep_convert(i) for i in items]
+        #  Items from a TypedList of the same type are known to be valid.
+        if trusted:
+            pass
+        elif not isinstance(items,TypedList) or items._type is not type:
+            if _validation_active:
+                items = [convert(type,i) for i in items]
+            else:
+                items = [type._ep_convert(i) for i in items]
         super(TypedList,self).__init__(items)
 
     def _store(self,value):
-        return self._type._ep_convert(value)
+        return convert(self._type,value)
 
     def __setitem__(self,key,value):
         if isinstance(key,slice):
@@ -64,20 +167,29 @@ class TypedDict(dict):
     """Subclass of built-in dict type that contains type-checked values.
 
     Instances of TypedDict are the canonical internal representation
-    for the Assoc extprot type.
+    for the Assoc extprot type.  If 'trusted' is true, the initial items
+    are not checked.
     """
 
-    def __init__(self,ktype,vtype,items=()):
-        items = [(ktype._ep_convert(k),vtype._ep_convert(v)) for (k,v) in dict(items).iteritems()]
+    def __init__(self,ktype,vtype,items=(),trusted=False):
+        #  Items from a TypedDict of the same type are known to be valid.
+        if trusted:
+            pass
+        elif not isinstance(items,TypedDict) or items._ktype is not ktype \
+                                             or items._vtype is not vtype:
+            if _validation_active:
+                items = [(convert(ktype,k),convert(vtype,v)) for (k,v) in dict(items).iteritems()]
+            else:
+                items = [(ktype._ep_convert(k),vtype._ep_convert(v)) for (k,v) in dict(items).iteritems()]
         super(TypedDict,self).__init__(items)
         self._ktype = ktype
         self._vtype = vtype
 
     def _kstore(self,key):
-        return self._ktype._ep_convert(key)
+        return convert(self._ktype,key)
 
     def _vstore(self,value):
-        return self._vtype._ep_convert(value)
+        return convert(self._vtype,value)
 
     def __setitem__(self,key,value):
         super(TypedDict,self).__setitem__(self._kstore(key),self._vstore(value))
@@ -97,3 +209,178 @@ class TypedDict(dict):
         for (k,v) in kwds:
             self[k] = v
 
+
+
+
+class InternTable(object):
+    """Table of canonical values, for de-duplicating values during parsing.
+
+    Pass an InternTable to from_string() or from_file() and every String
+    value parsed will be replaced by an equal value from the table, if
+    there is one.  If 'tuples' is true then Tuple values will also be
+    interned, as long as they are hashable.  Tuples are only shared between
+    values of the same type, since equal tuples may hold different types of
+    item, such as (True,"x") and (1.0,"x").  Re-use the same table across
+    a batch of calls to share values between all the parsed objects.
+
+    To avoid unbounded memory growth, strings longer than 'maxlength' are
+    never interned and the table stops accepting new values once it holds
+    'maxsize' of them; existing values continue to be shared.
+    """
+
+    def __init__(self,maxsize=100000,maxlength=128,tuples=False):
+        self.maxsize = maxsize
+        self.maxlength = maxlength
+        self.tuples = tuples
+        self.table = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def intern(self,value):
+        """Get the canonical instance of the given value."""
+        try:
+            return self.table[value]
+        except KeyError:
+            if len(self.table) < self.maxsize:
+                self.table[value] = value
+            return value
+        except TypeError:
+            return value
+
+    def intern_tuple(self,typdesc,value):
+        """Get the canonical instance of a tuple parsed by 'typdesc'."""
+        key = (typdesc,value)
+        try:
+            return self.table[key]
+        except KeyError:
+            if len(self.table) < self.maxsize:
+                self.table[key] = value
+            return value
+        except TypeError:
+            return value
+
+    def clear(self):
+        """Remove all values from the table."""
+        #  This must operate in-place, since parsers may hold a reference
+        #  to the underlying dict.
+        self.table.clear()
+
+
+class Blob(object):
+    """Lazy handle for a large String value stored in a file.
+
+    Pass a 'blob_threshold' to from_file() and every String value at least
+    that long will be parsed as a Blob, which records only the file, offset
+    and length of the data rather than reading it into memory.  Call the
+    tobytes() method to read the data; the file must remain open until then.
+    Blobs can be stored in String fields and are written out like any other
+    string value.
+    """
+
+    __slots__ = ("file","offset","length")
+
+    def __init__(self,file,offset,length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "<Blob of %d bytes at offset %d>" % (self.length,self.offset)
+
+    def __eq__(self,other):
+        if isinstance(other,Blob):
+            other = other.tobytes()
+        elif not isinstance(other,str):
+            return NotImplemented
+        return self.tobytes() == other
+
+    def __ne__(self,other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None
+
+    def tobytes(self):
+        """Read the data of the blob, as a string."""
+        pos = self.file.tell()
+        try:
+            self.file.seek(self.offset)
+            data = self.file.read(self.length)
+        finally:
+            self.file.seek(pos)
+        if len(data) < self.length:
+            raise UnexpectedEOFError
+        return data
+
+
+def _view(source,offset,length):
+    """Get a zero-copy view of part of a string or other buffer.
+
+    This is a memoryview if the source supports it, and otherwise a buffer
+    object for sources such as mmap that have only the old buffer interface.
+    """
+    try:
+        return memoryview(source)[offset:offset+length]
+    except TypeError:
+        return buffer(source,offset,length)
+
+
+def _blob_data(value):
+    """Get the contents of a String value held as a view or Blob."""
+    if isinstance(value,buffer):
+        return str(value)
+    return value.tobytes()
+
+
+def deep_sizeof(value,seen=None):
+    """Get the total memory used by a value and all the objects it contains.
+
+    This follows the items of containers such as TypedList and TypedDict,
+    along with the slots and __dict__ of objects such as Message and Option
+    instances, and adds up sys.getsizeof() for each object found.  Objects
+    that are reachable along several paths, such as interned strings, are
+    counted only once.  Classes are not counted, so constant Options and the
+    type classes referenced by containers are free.
+
+    To measure several values while counting their shared objects only once,
+    pass the same set of object ids as 'seen' to each call.
+    """
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj,type):
+            continue
+        total += sys.getsizeof(obj)
+        if isinstance(obj,dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj,(list,tuple,set,frozenset)):
+            stack.extend(obj)
+        try:
+            stack.append(obj.__dict__)
+        except AttributeError:
+            pass
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get("__slots__",())
+            if isinstance(slots,basestring):
+                slots = (slots,)
+            for name in slots:
+                if name in ("__dict__","__weakref__"):
+                    continue
+                try:
+                    stack.append(getattr(obj,name))
+                except AttributeError:
+                    pass
+    return total
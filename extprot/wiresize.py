@@ -0,0 +1,410 @@
+"""
+
+  extprot.wiresize:  find out where the bytes go in serialized extprot data
+
+This module attributes the size of serialized extprot data to the field
+paths of its protocol, to show which parts of a message are taking up the
+most space.  Feed it some data and ask for a report like so:
+
+    p = WireProfile(address_book)
+    p.add_file(open("address_books.dat","rb"))
+    print p.report()
+
+Paths are made from field names, with "[]" for the items of a list or
+array, "{key}" and "{value}" for the entries of an assoc, and numbers for
+the items of a tuple.  The items of a union option are prefixed with the
+name of the option.  For example, "persons[].phones[].0" is the first item
+of each phone tuple of each person in an address book.  Items that aren't
+described by the protocol, e.g. fields added by a newer version, are shown
+as "<N>" where N is their index.
+
+For every path the profile counts the number of values, the bytes taken up
+by their headers (the type prefix, length prefix and item count) and the
+bytes taken up by their payload.  The payload of a Tuple, List or Assoc
+includes the complete size of each item it contains.
+
+The profile also looks for fields that would be smaller with a different
+encoding, such as a Long field holding small values that would be smaller
+as a variable-length Int.  See WireProfile.suggestions() for details.
+
+This module can also be run as a script, giving a protocol file, the name
+of the top-level type and the data files to profile:
+
+    $ python -m extprot.wiresize address_book.proto address_book data.bin
+
+Data files may contain either concatenated records or a container file as
+written by extprot.container.
+
+"""
+
+import sys
+import json
+import struct
+import optparse
+
+import extprot
+from extprot.errors import *
+from extprot import types
+from extprot import container
+from extprot.types import serialize
+
+
+TYPE_VINT = serialize.TYPE_VINT
+TYPE_BITS8 = serialize.TYPE_BITS8
+TYPE_BITS32 = serialize.TYPE_BITS32
+TYPE_BITS64_LONG = serialize.TYPE_BITS64_LONG
+TYPE_BITS64_FLOAT = serialize.TYPE_BITS64_FLOAT
+TYPE_ENUM = serialize.TYPE_ENUM
+TYPE_TUPLE = serialize.TYPE_TUPLE
+TYPE_BYTES = serialize.TYPE_BYTES
+TYPE_HTUPLE = serialize.TYPE_HTUPLE
+TYPE_ASSOC = serialize.TYPE_ASSOC
+
+_S_BITS64_LONG = struct.Struct("<q")
+
+#  Sizes of the payload of fixed-size primitive types.
+_FIXED_SIZES = {
+    TYPE_BITS8: 1,
+    TYPE_BITS32: 4,
+    TYPE_BITS64_LONG: 8,
+    TYPE_BITS64_FLOAT: 8,
+    TYPE_ENUM: 0,
+}
+
+
+def vint_size(x):
+    """Get the number of bytes needed to encode 'x' in vint format."""
+    size = 1
+    while x >= 128:
+        x = x >> 7
+        size += 1
+    return size
+
+
+def zigzag(x):
+    """Apply the zigzag encoding used to store signed integers as vints."""
+    if x < 0:
+        return (-x << 1) - 1
+    return x << 1
+
+
+class PathStats(object):
+    """Size statistics for the values at a single field path.
+
+    Integer fields also track the size their values would have under
+    alternative encodings, for use in making suggestions:
+
+        vint_bytes:    payload size if encoded as a zigzag vint (Int)
+        fits_byte:     whether every value would fit in a Byte
+
+    """
+
+    __slots__ = ("path","typcls","count","header","payload",
+                 "vint_bytes","fits_byte",)
+
+    def __init__(self,path,typcls):
+        self.path = path
+        self.typcls = typcls
+        self.count = 0
+        self.header = 0
+        self.payload = 0
+        self.vint_bytes = 0
+        self.fits_byte = True
+
+    @property
+    def total(self):
+        return self.header + self.payload
+
+    @property
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / float(self.count)
+
+    def to_dict(self):
+        if self.typcls is None:
+            typname = None
+        else:
+            typname = self.typcls.__name__
+        return {"path":self.path,"type":typname,"count":self.count,
+                "header":self.header,"payload":self.payload,
+                "total":self.total,"average":self.average}
+
+
+class WireProfile(object):
+    """Profile of the encoded size of values of a given type.
+
+    Add data to the profile with the add_* methods, then get the results
+    from paths(), suggestions() or report().
+    """
+
+    def __init__(self,typcls):
+        self.typcls = typcls
+        self.records = 0
+        self._stats = {}
+        self._order = []
+
+    def add_string(self,data):
+        """Add all the records in a string of concatenated records."""
+        offset = 0
+        while offset < len(data):
+            offset = self._walk(data,offset,self.typcls,"")
+            self.records += 1
+
+    def add_value(self,value):
+        """Add a single value, by serializing it."""
+        self.add_string(serialize.to_string(value,self.typcls))
+
+    def add_file(self,file):
+        """Add all the records in a file of concatenated records."""
+        self.add_string(file.read())
+
+    def add_container(self,reader):
+        """Add all the records from a container.ContainerReader."""
+        for block in reader.blocks():
+            self.add_string(block.read_data())
+
+    @property
+    def total(self):
+        """Total number of bytes in the profiled records."""
+        try:
+            return self._stats[""].total
+        except KeyError:
+            return 0
+
+    def paths(self):
+        """Get the PathStats for every path, in the order first seen."""
+        return [self._stats[path] for path in self._order]
+
+    def suggestions(self):
+        """Get a list of fields that would be smaller with another encoding.
+
+        Each suggestion is a tuple (path,message,saving) where 'saving' is
+        the number of bytes that would have been saved on the profiled data.
+        The following are checked:
+
+            * Long fields whose values would take fewer bytes as an Int
+            * Int fields whose values would take fewer bytes as a Long
+            * Int fields whose values would all fit in a Byte
+
+        """
+        suggestions = []
+        for stats in self.paths():
+            if not stats.count:
+                continue
+            if types._issubclass(stats.typcls,types.Long):
+                saving = stats.payload - stats.vint_bytes
+                if saving > 0:
+                    msg = "Long values would be smaller as Int"
+                    suggestions.append((stats.path,msg,saving))
+            elif types._issubclass(stats.typcls,types.Int):
+                saving = stats.payload - 8 * stats.count
+                if saving > 0:
+                    msg = "Int values would be smaller as Long"
+                    suggestions.append((stats.path,msg,saving))
+                saving = stats.payload - stats.count
+                if stats.fits_byte and saving > 0:
+                    msg = "Int values would all fit in a Byte"
+                    suggestions.append((stats.path,msg,saving))
+        suggestions.sort(key=lambda s: -s[2])
+        return suggestions
+
+    def to_dict(self):
+        """Get the results of the profile as a JSON-compatible dict."""
+        return {
+            "records": self.records,
+            "total": self.total,
+            "paths": [stats.to_dict() for stats in self.paths()],
+            "suggestions": [{"path":path,"message":msg,"saving":saving}
+                            for (path,msg,saving) in self.suggestions()],
+        }
+
+    def report(self):
+        """Get the results of the profile as a human-readable table."""
+        total = self.total or 1
+        lines = ["%d records, %d bytes" % (self.records,self.total),""]
+        lines.append("%-40s %8s %10s %8s %10s %10s %6s" % ("path","count",
+                     "total","avg","header","payload","%"))
+        for stats in self.paths():
+            lines.append("%-40s %8d %10d %8.1f %10d %10d %5.1f%%" % (
+                         stats.path or "(record)",stats.count,stats.total,
+                         stats.average,stats.header,stats.payload,
+                         100.0 * stats.total / total))
+        suggestions = self.suggestions()
+        if suggestions:
+            lines.append("")
+            for (path,msg,saving) in suggestions:
+                lines.append("%s: %s (saves %d bytes)" % (path,msg,saving))
+        return "\n".join(lines)
+
+    def _get_stats(self,path,typcls):
+        try:
+            return self._stats[path]
+        except KeyError:
+            stats = self._stats[path] = PathStats(path,typcls)
+            self._order.append(path)
+            return stats
+
+    def _walk(self,data,offset,typcls,path):
+        """Profile the value starting at 'offset', returning its end offset.
+
+        The structure of the value is taken from the data; the type class is
+        used only to name its parts and to interpret primitive values.
+        """
+        start = offset
+        (prefix,offset) = serialize.decode_vint(data,offset)
+        type = prefix & 0xf
+        tag = prefix >> 4
+        stats = self._get_stats(path,typcls)
+        stats.count += 1
+        if types._issubclass(typcls,types.Union):
+            typcls = _find_option(typcls,type,tag)
+            if typcls is not None:
+                path = _join(path,_option_name(typcls))
+        if type & 0x01:
+            (length,body) = serialize.decode_vint(data,offset)
+            end = body + length
+            if end > len(data):
+                raise UnexpectedEOFError
+            if type == TYPE_BYTES:
+                stats.header += body - start
+                stats.payload += length
+                return end
+            (nitems,offset) = serialize.decode_vint(data,body)
+            stats.header += offset - start
+            stats.payload += end - offset
+            if type == TYPE_ASSOC:
+                nitems = nitems * 2
+            children = _children(typcls,type,path)
+            for i in xrange(nitems):
+                (cpath,ctype) = children(i)
+                offset = self._walk(data,offset,ctype,cpath)
+            if offset != end:
+                raise ParseError("bad length prefix at offset %d" % (start,))
+            return end
+        stats.header += offset - start
+        if type == TYPE_VINT:
+            (x,end) = serialize.decode_vint(data,offset)
+            size = end - offset
+            if x & 1:
+                value = -((x + 1) >> 1)
+            else:
+                value = x >> 1
+            stats.vint_bytes += size
+        else:
+            try:
+                size = _FIXED_SIZES[type]
+            except KeyError:
+                raise UnexpectedWireTypeError
+            end = offset + size
+            if end > len(data):
+                raise UnexpectedEOFError
+            if type == TYPE_BITS64_LONG:
+                value = _S_BITS64_LONG.unpack(data[offset:end])[0]
+                stats.vint_bytes += vint_size(zigzag(value))
+            else:
+                value = None
+        if value is None or not (0 <= value < 256):
+            stats.fits_byte = False
+        stats.payload += size
+        return end
+
+
+def _join(path,name):
+    """Join a field path and the name of a child item."""
+    if not path:
+        return name
+    if name.startswith("[") or name.startswith("{"):
+        return path + name
+    return path + "." + name
+
+
+def _find_option(typcls,type,tag):
+    """Find the option of a Union matching the given wire type and tag."""
+    for option in typcls._types:
+        if option._ep_tag == tag and option._ep_primtype == type:
+            return option
+    return None
+
+
+def _option_name(option):
+    """Get the name of a union option.
+
+    Options of a polymorphic union are bound by creating anonymous
+    subclasses, so this looks for the name of the original class.
+    """
+    for cls in option.__mro__:
+        if cls.__name__ not in ("btype","Anon"):
+            return cls.__name__
+    return option.__name__
+
+
+def _children(typcls,type,path):
+    """Get a function giving the (path,typcls) of each item of a value."""
+    if type == TYPE_TUPLE:
+        if types._issubclass(typcls,types.Message):
+            names = [f._ep_name for f in typcls._ep_fields]
+            ctypes = [f._ep_type for f in typcls._ep_fields]
+        elif types._issubclass(typcls,(types.Tuple,types.Option)):
+            names = [str(i) for i in xrange(len(typcls._types))]
+            ctypes = typcls._types
+        else:
+            names = ctypes = ()
+        paths = [_join(path,name) for name in names]
+        def children(i):
+            if i < len(paths):
+                return (paths[i],ctypes[i])
+            return (_join(path,"<%d>" % (i,)),None)
+    elif type == TYPE_HTUPLE:
+        cpath = _join(path,"[]")
+        if types._issubclass(typcls,(types.List,types.Array)):
+            ctypes = typcls._types
+        else:
+            ctypes = (None,)
+        def children(i):
+            return (cpath,ctypes[i % len(ctypes)])
+    elif type == TYPE_ASSOC:
+        cpaths = (_join(path,"{key}"),_join(path,"{value}"))
+        if types._issubclass(typcls,types.Assoc):
+            ctypes = typcls._types
+        else:
+            ctypes = (None,None)
+        def children(i):
+            return (cpaths[i % 2],ctypes[i % 2])
+    else:
+        raise UnexpectedWireTypeError
+    return children
+
+
+def main(argv=None):
+    """Command-line entry point for profiling data files."""
+    parser = optparse.OptionParser(
+        usage="python -m extprot.wiresize [options] PROTOFILE TYPE DATAFILE...")
+    parser.add_option("--json",action="store_true",
+                      help="print the results in JSON format")
+    (opts,args) = parser.parse_args(argv)
+    if len(args) < 3:
+        parser.error("must give a protocol file, type name and data files")
+    namespace = {}
+    extprot.import_protocol(args[0],namespace)
+    try:
+        typcls = namespace[args[1]]
+    except KeyError:
+        parser.error("no such type in protocol: " + args[1])
+    p = WireProfile(typcls)
+    for filename in args[2:]:
+        with open(filename,"rb") as f:
+            if f.read(len(container.MAGIC)) == container.MAGIC:
+                p.add_container(container.ContainerReader(f,typcls))
+            else:
+                f.seek(0)
+                p.add_file(f)
+    if opts.json:
+        print json.dumps(p.to_dict(),indent=2,sort_keys=True)
+    else:
+        print p.report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())